@@ -29,14 +29,12 @@ VER = "3.1"
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import paho.mqtt.client as paho
+import importlib.util
 
-try:
-    from jsonpath_rw import jsonpath, parse
-
-    module_jsonpath_rw = True
-except ImportError:
-    module_jsonpath_rw = False
+# paho is imported once the arguments are parsed, and jsonpath_rw (with the
+# ply parser under it) only when a message is matched against --jsonpath, so
+# --help, --version and argument errors return without importing either.
+module_jsonpath_rw = importlib.util.find_spec("jsonpath_rw") is not None
 try:
     import json
 
@@ -48,7 +46,6 @@ import time
 import sys
 import os
 import argparse
-import subprocess
 
 try:
     import math
@@ -117,7 +114,7 @@ def on_connect(mosq, userdata, flags, rc):
     """
 
     mosq.subscribe(args.check_subscription, 0)
-    mosq.loop()
+    mosq.loop_write()
 
 
 def on_publish(mosq, userdata, mid):
@@ -135,7 +132,7 @@ def on_subscribe(mosq, userdata, mid, granted_qos):
         (res, mid) = mosq.publish(
             args.check_topic, args.mqtt_payload, qos=2, retain=False
         )
-        mosq.loop()
+        mosq.loop_write()
 
 
 def on_message(mosq, userdata, msg):
@@ -152,6 +149,8 @@ def on_message(mosq, userdata, msg):
     if module_jsonpath_rw and module_json:
         if args.mqtt_jsonpath is not None:
             try:
+                from jsonpath_rw import parse
+
                 jspayload = json.loads(payload)
                 jspath = parse(args.mqtt_jsonpath)
                 extractpayload = [match.value for match in jspath.find(jspayload)]
@@ -467,12 +466,16 @@ parser.add_argument("-V", "--version", action="version", version=PROG)
 args = parser.parse_args()
 
 if args.mqtt_payload.startswith("!"):
+    import subprocess
+
     try:
         args.mqtt_payload = subprocess.check_output(args.mqtt_payload[1:], shell=True)
     except:
         pass
 
 if args.mqtt_value.startswith("!"):
+    import subprocess
+
     try:
         args.mqtt_value = subprocess.check_output(args.mqtt_value[1:], shell=True)
     except:
@@ -481,6 +484,8 @@ if args.mqtt_value.startswith("!"):
 if args.check_subscription is None:
     args.check_subscription = args.check_topic
 
+import paho.mqtt.client as paho
+
 userdata = {
     "have_response": False,
     "start_time": time.time(),
@@ -25,16 +25,10 @@
 # License    : GPLv2 (LICENSE.md / https://www.gnu.org/licenses/old-licenses/gpl-2.0.html)
 ########################################################################
 
-import pymssql
 import time
 import sys
-import tempfile
-
-try:
-    import cPickle as pickle
-except:
-    import pickle
-from optparse import OptionParser, OptionGroup
+from nagios_range import is_within_range
+from optparse import OptionParser, OptionGroup, Values
 
 BASE_QUERY = "SELECT cntr_value FROM sys.sysperfinfo WHERE counter_name='%s' AND instance_name='%%s';"
 DIVI_QUERY = "SELECT cntr_value FROM sys.sysperfinfo WHERE counter_name LIKE '%s%%%%' AND instance_name='%%s';"
@@ -130,9 +124,12 @@ def return_nagios(options, stdout="", result="", unit="", label=""):
         c = options.critical.split(":")[1]
         w = options.warning.split(":")[1]
 
-    # Check if we should invert the warning/critical (this should change someday)
-    if int(c) < int(w):
-        invert = True
+    # Check if we should invert the warning/critical (this should change someday).
+    # Ranges such as "90:" or "@10:20" already say which side alerts.
+    try:
+        invert = float(c) < float(w)
+    except ValueError:
+        pass
 
     if is_within_range(options.critical, result, invert):
         prefix = "CRITICAL: "
@@ -222,80 +219,21 @@ class MSSQLDivideQuery(MSSQLQuery):
 
 class MSSQLDeltaQuery(MSSQLQuery):
 
-    def make_pickle_name(self):
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.options.table + self.query)
-        self.picklename = "%s/mssql-%s.tmp" % (tmpdir, tmpname)
-
     def calculate_result(self):
-        self.make_pickle_name()
+        import counter_rate
 
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, "w")
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError as ValueError:
-                last_run = {"time": None, "value": None}
-        finally:
-            tmpfile.close()
-
-        if last_run["time"]:
-            old_time = last_run["time"]
-            new_time = time.time()
-            old_val = last_run["query_result"]
-            new_val = self.query_result
-            self.result = ((new_val - old_val) / (new_time - old_time)) * self.modifier
+        key = counter_rate.counter_key(self.host, self.options.table, self.query)
+        # cntr_value is a signed bigint that never wraps, a drop is a reset
+        rate = counter_rate.RateStore().update(key, self.query_result, time.time())
+        if getattr(self.options, "smooth", False):
+            rate = rate.smoothed
         else:
-            self.result = 0
+            rate = rate.rate
 
-        new_run = {"time": time.time(), "query_result": self.query_result}
-
-        # ~ Will throw IOError, leaving it to acquiesce
-        tmpfile = open(self.picklename, "w")
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
-
-
-def is_within_range(nagstring, value, invert=False):
-    if not nagstring:
-        return False
-    import re
-    import operator
-
-    first_float = r"(?P<first>(-?[0-9]+(\.[0-9]+)?))"
-    second_float = r"(?P<second>(-?[0-9]+(\.[0-9]+)?))"
-    actions = [
-        (
-            r"^%s$" % first_float,
-            lambda y: (value > float(y.group("first"))) or (value < 0),
-        ),
-        (r"^%s:$" % first_float, lambda y: value < float(y.group("first"))),
-        (r"^~:%s$" % first_float, lambda y: value > float(y.group("first"))),
-        (
-            r"^%s:%s$" % (first_float, second_float),
-            lambda y: (value < float(y.group("first")))
-            or (value > float(y.group("second"))),
-        ),
-        (
-            r"^@%s:%s$" % (first_float, second_float),
-            lambda y: not (
-                (value < float(y.group("first"))) or (value > float(y.group("second")))
-            ),
-        ),
-    ]
-    for regstr, func in actions:
-        res = re.match(regstr, nagstring)
-        if res:
-            if invert:
-                return not func(res)
-            else:
-                return func(res)
-    raise Exception("Improper warning/critical format.")
+        if rate is not None:
+            self.result = rate * self.modifier
+        else:
+            self.result = 0
 
 
 def parse_args():
@@ -316,11 +254,25 @@ def parse_args():
     connection = OptionGroup(parser, "Optional Connection Information")
     connection.add_option("-I", "--instance", help="Specify instance", default=None)
     connection.add_option("-p", "--port", help="Specify port.", default=None)
+    connection.add_option(
+        "--broker",
+        help="Run the queries on a pooled connection from the mssql_broker.py "
+        "daemon listening on this socket, logging in directly if it is not "
+        "running.",
+        default=None,
+    )
     parser.add_option_group(connection)
 
     nagios = OptionGroup(parser, "Nagios Plugin Information")
     nagios.add_option("-w", "--warning", help="Specify warning range.", default=None)
     nagios.add_option("-c", "--critical", help="Specify critical range.", default=None)
+    nagios.add_option(
+        "--smooth",
+        action="store_true",
+        help="Evaluate /sec modes on the smoothed (EWMA) rate instead of the "
+        "rate since the previous check.",
+        default=False,
+    )
     parser.add_option_group(nagios)
 
     mode = OptionGroup(parser, "Mode Options")
@@ -330,6 +282,23 @@ def parse_args():
             "--%s" % k, action="store_true", help=v.get("help"), default=False
         )
     parser.add_option_group(mode)
+
+    sweep = OptionGroup(parser, "Sweep Options")
+    sweep.add_option(
+        "--sweep",
+        action="store_true",
+        help="Check the mode on every database of the instance with one "
+        "query, instead of the database given with -T.",
+        default=False,
+    )
+    sweep.add_option(
+        "--top",
+        type="int",
+        help="With --sweep, the number of worst databases named in the "
+        "first line of output. [Default: %default]",
+        default=5,
+    )
+    parser.add_option_group(sweep)
     options, _ = parser.parse_args()
 
     if not options.hostname:
@@ -338,7 +307,7 @@ def parse_args():
         parser.error("User is a required option.")
     if not options.password:
         parser.error("Password is a required option.")
-    if not options.table:
+    if not options.table and not options.sweep:
         parser.error("Table is a required option.")
 
     if options.instance and options.port:
@@ -351,18 +320,44 @@ def parse_args():
         elif getattr(options, arg.dest):
             options.mode = arg.dest
 
+    if options.sweep and "query" not in MODES.get(options.mode, {}):
+        parser.error("--sweep needs a Mode Option that runs a query.")
+
     return options
 
 
-def connect_db(options):
+def connect_db(options, fresh=False):
+    """Log in to the server, or borrow a connection from the broker.
+
+    A fresh brokered connection is a new login timed by the broker, so
+    time2connect measures a real connect either way.
+    """
     host = options.hostname
     if options.instance:
         host += "\\" + options.instance
     elif options.port:
         host += ":" + options.port
+    database = options.table or "master"
+    if options.broker:
+        try:
+            import mssql_broker
+
+            mssql = mssql_broker.BrokerConnection(
+                options.broker,
+                host,
+                options.user,
+                options.password,
+                database,
+                fresh=fresh,
+            )
+            return mssql, mssql.time2connect, host
+        except (IOError, OSError):
+            pass
+    import pymssql
+
     start = time.time()
     mssql = pymssql.connect(
-        host=host, user=options.user, password=options.password, database=options.table
+        host=host, user=options.user, password=options.password, database=database
     )
     total = time.time() - start
     return mssql, total, host
@@ -371,36 +366,164 @@ def connect_db(options):
 def main():
     options = parse_args()
 
-    mssql, total, host = connect_db(options)
+    fresh = not options.mode or options.mode == "time2connect"
+    mssql, total, host = connect_db(options, fresh)
+
+    try:
+        if options.sweep:
+            run_sweep(mssql, options, host)
 
-    if options.mode == "test":
-        run_tests(mssql, options, host)
+        elif options.mode == "test":
+            run_tests(mssql, options, host)
 
-    elif not options.mode or options.mode == "time2connect":
-        return_nagios(
-            options,
-            stdout="Time to connect was %ss",
-            label="time",
-            unit="s",
-            result=total,
-        )
+        elif not options.mode or options.mode == "time2connect":
+            return_nagios(
+                options,
+                stdout="Time to connect was %ss",
+                label="time",
+                unit="s",
+                result=total,
+            )
 
-    else:
-        execute_query(mssql, options, host)
+        else:
+            execute_query(mssql, options, host)
+    finally:
+        mssql.close()
 
 
-def execute_query(mssql, options, host=""):
+def make_query(options, host=""):
     sql_query = MODES[options.mode]
     sql_query["options"] = options
     sql_query["host"] = host
     query_type = sql_query.get("type")
     if query_type == "delta":
-        mssql_query = MSSQLDeltaQuery(**sql_query)
+        return MSSQLDeltaQuery(**sql_query)
     elif query_type == "divide":
-        mssql_query = MSSQLDivideQuery(**sql_query)
+        return MSSQLDivideQuery(**sql_query)
     else:
-        mssql_query = MSSQLQuery(**sql_query)
-    mssql_query.do(mssql)
+        return MSSQLQuery(**sql_query)
+
+
+def execute_query(mssql, options, host=""):
+    make_query(options, host).do(mssql)
+
+
+def sweep_query(query):
+    """Turn a mode's query for one database into one for every database."""
+    query = query.replace(
+        "SELECT cntr_value", "SELECT instance_name, counter_name, cntr_value"
+    )
+    return query.replace("instance_name='%s'", "instance_name<>'_Total'") % ()
+
+
+def run_sweep(mssql, options, host):
+    """Check the mode on every database with one query.
+
+    The rows are grouped by instance_name, the database, and each group is
+    evaluated as if -T had named it, so delta modes share their previous
+    samples with single-database checks. Raises NagiosReturn with the worst
+    databases on the first line and every database's result below it.
+    """
+    cur = mssql.cursor()
+    cur.execute(sweep_query(MODES[options.mode]["query"]))
+    databases = {}
+    for database, counter, value in cur.fetchall():
+        databases.setdefault(database.rstrip(), []).append((counter.rstrip(), value))
+
+    if not databases:
+        raise NagiosReturn("UNKNOWN: sysperfinfo has no databases for this mode", 3)
+
+    results = []
+    for database, counters in databases.items():
+        database_options = Values(options.__dict__)
+        database_options.table = database
+        mssql_query = make_query(database_options, host)
+        # A ratio sorts before its base, as MSSQLDivideQuery expects them
+        values = [value for _, value in sorted(counters)]
+        if isinstance(mssql_query, MSSQLDivideQuery):
+            mssql_query.query_result = values
+        else:
+            mssql_query.query_result = values[0]
+        try:
+            mssql_query.calculate_result()
+            mssql_query.finish()
+        except NagiosReturn as e:
+            message, code = e.message, e.code
+        except Exception as e:
+            message, code = "UNKNOWN: %s" % e, 3
+        result = getattr(mssql_query, "result", None)
+        results.append((code, result, database, message))
+
+    raise NagiosReturn(*summarize_sweep(options, results))
+
+
+def summarize_sweep(options, results):
+    """Return the sweep output and the worst code of (code, result, database,
+    message) tuples, ordered worst first."""
+    # Lower values are worse when the thresholds are inverted, see return_nagios
+    lower_is_worse = False
+    if options.warning and options.critical:
+        try:
+            lower_is_worse = float(options.critical.split(":")[-1] or 0) < float(
+                options.warning.split(":")[-1] or 0
+            )
+        except ValueError:
+            pass
+
+    def severity(result):
+        code, value = result[0], result[1] or 0
+        # UNKNOWN ranks below CRITICAL and WARNING, but above OK
+        rank = {2: 3, 1: 2, 3: 1}.get(code, 0)
+        return (rank, -value if lower_is_worse else value)
+
+    results.sort(key=severity, reverse=True)
+    counts = [0, 0, 0, 0]
+    for code, _, _, _ in results:
+        counts[min(max(code, 0), 3)] += 1
+    if counts[2]:
+        code = 2
+    elif counts[1]:
+        code = 1
+    elif counts[3]:
+        code = 3
+    else:
+        code = 0
+
+    prefix = {0: "OK", 1: "WARNING", 2: "CRITICAL", 3: "UNKNOWN"}[code]
+    worst = ", ".join(
+        "%s %s%s" % (database, value, MODES[options.mode].get("unit", ""))
+        for _, value, database, _ in results[: options.top]
+    )
+    lines = []
+    perfdata = []
+    for _, _, database, message in results:
+        text, _, data = message.partition("|")
+        lines.append("%s: %s" % (database, text))
+        if data:
+            perfdata.append("'%s %s" % (database, data.replace("=", "'=", 1)))
+
+    stdout = "%s: %d CRITICAL, %d WARNING, %d UNKNOWN of %d databases; worst: %s" % (
+        prefix,
+        counts[2],
+        counts[1],
+        counts[3],
+        len(results),
+        worst,
+    )
+    stdout = "%s|%s\n%s" % (stdout, " ".join(perfdata), "\n".join(lines))
+    return stdout, code
+
+
+def connection_errors():
+    """Return the pymssql errors to report as UNKNOWN.
+
+    pymssql is only imported by a direct login or a broker error, so a
+    check that never imported it cannot have raised one.
+    """
+    pymssql = sys.modules.get("pymssql")
+    if pymssql is None:
+        return ()
+    return (pymssql.OperationalError,)
 
 
 def run_tests(mssql, options, host):
@@ -424,7 +547,7 @@ def run_tests(mssql, options, host):
 if __name__ == "__main__":
     try:
         main()
-    except pymssql.OperationalError as e:
+    except connection_errors() as e:
         print(e)
         sys.exit(3)
     except IOError as e:
@@ -25,16 +25,11 @@
 # License    : GPLv2 (LICENSE.md / https://www.gnu.org/licenses/old-licenses/gpl-2.0.html)
 ########################################################################
 
-import pymssql
+import re
 import time
 import sys
-import tempfile
-
-try:
-    import cPickle as pickle
-except:
-    import pickle
-from optparse import OptionParser, OptionGroup
+from nagios_range import is_within_range
+from optparse import OptionParser, OptionGroup, Values
 
 BASE_QUERY = (
     "SELECT cntr_value FROM sysperfinfo WHERE counter_name='%s' AND instance_name='';"
@@ -57,6 +52,14 @@ CPU_QUERY = (
     + ") as x;"
 )
 
+# Matches the sysperfinfo queries above, to collect their counters in bulk
+PERF_QUERY = re.compile(
+    r"^SELECT cntr_value FROM (?:sys\.)?sysperfinfo "
+    r"WHERE counter_name(?P<operator>=| LIKE )'(?P<counter>[^']*)'"
+    r"(?: AND instance_name='(?P<instance>[^']*)')?;$"
+)
+BULK_QUERY = "SELECT counter_name, instance_name, cntr_value FROM sysperfinfo WHERE %s;"
+
 MODES = {
     "connections": {
         "help": "Number of open connections",
@@ -296,6 +299,105 @@ class NagiosReturn(Exception):
         self.code = code
 
 
+class PerfCounters(object):
+    """The sysperfinfo counters of many modes, fetched in one query.
+
+    The counter and instance each mode needs are read from its own query, so
+    one SELECT with every counter_name replaces a scan of the view per mode.
+    Rows are indexed by (counter, instance), compared case-insensitively and
+    without the nchar padding, the way SQL Server compares them.
+    """
+
+    def __init__(self):
+        self.collected = False
+        self.rows = []
+        self.index = {}
+
+    @staticmethod
+    def parse(query):
+        """Return (counter, instance, prefix) for a sysperfinfo query, or None.
+
+        instance is None for queries over every instance, and prefix is True
+        for the LIKE queries that select a counter together with its base.
+        """
+        match = PERF_QUERY.match(query)
+        if match is None:
+            return None
+        counter = match.group("counter").lower()
+        instance = match.group("instance")
+        prefix = match.group("operator") != "="
+        if prefix:
+            counter = counter.rstrip("%")
+        if instance is not None:
+            instance = instance.lower()
+        return counter, instance, prefix
+
+    @classmethod
+    def bulk_query(cls, queries):
+        """Return one query selecting the counters of every query, or None."""
+        names = set()
+        prefixes = set()
+        for query in queries:
+            spec = cls.parse(query)
+            if spec is None:
+                continue
+            elif spec[2]:
+                prefixes.add(spec[0])
+            else:
+                names.add(spec[0])
+
+        clauses = []
+        if names:
+            clauses.append(
+                "counter_name IN (%s)"
+                % ", ".join("'%s'" % name.replace("'", "''") for name in sorted(names))
+            )
+        for prefix in sorted(prefixes):
+            clauses.append("counter_name LIKE '%s%%'" % prefix.replace("'", "''"))
+        if not clauses:
+            return None
+        return BULK_QUERY % " OR ".join(clauses)
+
+    def collect(self, connection, queries):
+        query = self.bulk_query(queries)
+        if query is None:
+            return
+        cur = connection.cursor()
+        cur.execute(query)
+        for counter, instance, value in cur.fetchall():
+            key = (counter.rstrip().lower(), instance.rstrip().lower())
+            self.rows.append((key, value))
+            # The first row wins, as with fetchone() on the mode's own query
+            self.index.setdefault(key, value)
+        self.collected = True
+
+    def covers(self, query):
+        return self.collected and self.parse(query) is not None
+
+    def value(self, query):
+        """Return the counter value a MSSQLQuery would have fetched."""
+        counter, instance, _ = self.parse(query)
+        if instance is None:
+            for key, value in self.rows:
+                if key[0] == counter:
+                    return value
+        elif (counter, instance) in self.index:
+            return self.index[(counter, instance)]
+        raise LookupError("sysperfinfo has no counter '%s'" % counter)
+
+    def values(self, query):
+        """Return the counter and its base, as a MSSQLDivideQuery fetches them."""
+        counter, instance, _ = self.parse(query)
+        values = [
+            value
+            for key, value in sorted(self.index.items())
+            if key[0].startswith(counter) and key[1] == instance
+        ]
+        if not values:
+            raise LookupError("sysperfinfo has no counter '%s'" % counter)
+        return values
+
+
 class MSSQLQuery(object):
 
     def __init__(
@@ -323,14 +425,20 @@ class MSSQLQuery(object):
         cur.execute(self.query)
         self.query_result = cur.fetchone()[0]
 
+    def run_on_counters(self, counters):
+        self.query_result = counters.value(self.query)
+
     def finish(self):
         return_nagios(self.options, self.stdout, self.result, self.unit, self.label)
 
     def calculate_result(self):
         self.result = float(self.query_result) * self.modifier
 
-    def do(self, connection):
-        self.run_on_connection(connection)
+    def do(self, connection, counters=None):
+        if counters is not None and counters.covers(self.query):
+            self.run_on_counters(counters)
+        else:
+            self.run_on_connection(connection)
         self.calculate_result()
         self.finish()
 
@@ -353,51 +461,39 @@ class MSSQLDivideQuery(MSSQLQuery):
         cur.execute(self.query)
         self.query_result = [x[0] for x in cur.fetchall()]
 
+    def run_on_counters(self, counters):
+        self.query_result = counters.values(self.query)
 
-class MSSQLDeltaQuery(MSSQLQuery):
 
-    def make_pickle_name(self):
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.query)
-        self.picklename = "%s/mssql-%s.tmp" % (tmpdir, tmpname)
+class MSSQLDeltaQuery(MSSQLQuery):
 
     def calculate_result(self):
-        self.make_pickle_name()
+        import counter_rate
 
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, "w")
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError as ValueError:
-                last_run = {"time": None, "value": None}
-        finally:
-            tmpfile.close()
-
-        if last_run["time"]:
-            old_time = last_run["time"]
-            new_time = time.time()
-            old_val = last_run["query_result"]
-            new_val = self.query_result
-            self.result = ((new_val - old_val) / (new_time - old_time)) * self.modifier
+        key = counter_rate.counter_key(self.host, "master", self.query)
+        # cntr_value is a signed bigint that never wraps, a drop is a reset
+        rate = counter_rate.RateStore().update(key, self.query_result, time.time())
+        if getattr(self.options, "smooth", False):
+            rate = rate.smoothed
+        else:
+            rate = rate.rate
+
+        if rate is not None:
+            self.result = rate * self.modifier
         else:
             self.result = None
 
-        new_run = {"time": time.time(), "query_result": self.query_result}
 
-        # ~ Will throw IOError, leaving it to acquiesce
-        tmpfile = open(self.picklename, "w")
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
+class BatchOptionParser(OptionParser):
+    """Parses batch file entries, raising ValueError instead of exiting."""
 
+    def error(self, msg):
+        raise ValueError(msg)
 
-def parse_args():
+
+def build_parser(parser_class=OptionParser):
     usage = "usage: %prog -H hostname -U user -P password -T table --mode"
-    parser = OptionParser(usage=usage)
+    parser = parser_class(usage=usage)
 
     required = OptionGroup(parser, "Required Options")
     required.add_option(
@@ -410,11 +506,25 @@ def parse_args():
     connection = OptionGroup(parser, "Optional Connection Information")
     connection.add_option("-I", "--instance", help="Specify instance", default=None)
     connection.add_option("-p", "--port", help="Specify port.", default=None)
+    connection.add_option(
+        "--broker",
+        help="Run the queries on a pooled connection from the mssql_broker.py "
+        "daemon listening on this socket, logging in directly if it is not "
+        "running.",
+        default=None,
+    )
     parser.add_option_group(connection)
 
     nagios = OptionGroup(parser, "Nagios Plugin Information")
     nagios.add_option("-w", "--warning", help="Specify warning range.", default=None)
     nagios.add_option("-c", "--critical", help="Specify critical range.", default=None)
+    nagios.add_option(
+        "--smooth",
+        action="store_true",
+        help="Evaluate /sec modes on the smoothed (EWMA) rate instead of the "
+        "rate since the previous check.",
+        default=False,
+    )
     parser.add_option_group(nagios)
 
     mode = OptionGroup(parser, "Mode Options")
@@ -424,9 +534,79 @@ def parse_args():
             "--%s" % k, action="store_true", help=v.get("help"), default=False
         )
     parser.add_option_group(mode)
+
+    batch = OptionGroup(parser, "Batch Options")
+    batch.add_option(
+        "-b",
+        "--batch",
+        help="File of modes to check over one connection, one per line as "
+        "'service description; --mode -w warning -c critical'. Prints "
+        "PROCESS_SERVICE_CHECK_RESULT lines.",
+        default=None,
+    )
+    batch.add_option(
+        "--command-file",
+        help="With --batch or --instance-list, submit the results to this "
+        "Nagios command file instead of printing them.",
+        default=None,
+    )
+    batch.add_option(
+        "--host-name",
+        help="With --batch, the Nagios host name the results belong to. "
+        "[Default: the --hostname value]",
+        default=None,
+    )
+    parser.add_option_group(batch)
+
+    fanout = OptionGroup(parser, "Fan-out Options")
+    fanout.add_option(
+        "-L",
+        "--instance-list",
+        help="File of instances to check concurrently, one per line as "
+        "'host_name [server]', where server is 'address', 'address\\instance' "
+        "or 'address:port' [Default: host_name]. Runs the Mode Option or the "
+        "--batch file on each and prints PROCESS_SERVICE_CHECK_RESULT lines.",
+        default=None,
+    )
+    fanout.add_option(
+        "--workers",
+        type="int",
+        help="With --instance-list, the number of instances checked at once. "
+        "[Default: %default]",
+        default=16,
+    )
+    fanout.add_option(
+        "--deadline",
+        type="float",
+        help="With --instance-list, seconds after which instances without a "
+        "result are reported as UNKNOWN. [Default: %default]",
+        default=50,
+    )
+    fanout.add_option(
+        "--service",
+        help="With --instance-list and a Mode Option, the service description "
+        "the results belong to. [Default: the mode]",
+        default=None,
+    )
+    parser.add_option_group(fanout)
+    return parser
+
+
+def get_mode(parser, options):
+    mode = None
+    for k in MODES:
+        if getattr(options, k) and mode:
+            parser.error("Must choose one and only Mode Option.")
+        elif getattr(options, k):
+            mode = k
+    return mode
+
+
+def parse_args():
+    parser = build_parser()
     options, _ = parser.parse_args()
 
-    if not options.hostname:
+    if not options.hostname and not options.instance_list:
         parser.error("Hostname is a required option.")
     if not options.user:
         parser.error("User is a required option.")
@@ -436,59 +616,90 @@ def parse_args():
     if options.instance and options.port:
         parser.error("Cannot specify both instance and port.")
 
-    options.mode = None
-    for arg in mode.option_list:
-        if getattr(options, arg.dest) and options.mode:
-            parser.error("Must choose one and only Mode Option.")
-        elif getattr(options, arg.dest):
-            options.mode = arg.dest
+    options.mode = get_mode(parser, options)
+    if options.batch and options.mode:
+        parser.error("Cannot specify both a batch file and a Mode Option.")
+
+    if options.instance_list:
+        if options.hostname or options.instance or options.port:
+            parser.error("Give the servers in the instance list, not with -H/-I/-p.")
+        if not options.batch and options.mode in (None, "test"):
+            parser.error("--instance-list needs a batch file or a Mode Option.")
+        if options.workers < 1:
+            parser.error("--workers must be at least 1.")
 
     return options
 
 
-def is_within_range(nagstring, value):
-    if not nagstring:
-        return False
-    import re
-    import operator
-
-    first_float = r"(?P<first>(-?[0-9]+(\.[0-9]+)?))"
-    second_float = r"(?P<second>(-?[0-9]+(\.[0-9]+)?))"
-    actions = [
-        (
-            r"^%s$" % first_float,
-            lambda y: (value > float(y.group("first"))) or (value < 0),
-        ),
-        (r"^%s:$" % first_float, lambda y: value < float(y.group("first"))),
-        (r"^~:%s$" % first_float, lambda y: value > float(y.group("first"))),
-        (
-            r"^%s:%s$" % (first_float, second_float),
-            lambda y: (value < float(y.group("first")))
-            or (value > float(y.group("second"))),
-        ),
-        (
-            r"^@%s:%s$" % (first_float, second_float),
-            lambda y: not (
-                (value < float(y.group("first"))) or (value > float(y.group("second")))
-            ),
-        ),
-    ]
-    for regstr, func in actions:
-        res = re.match(regstr, nagstring)
-        if res:
-            return func(res)
-    raise Exception("Improper warning/critical format.")
+def parse_batch_file(options):
+    """Read the batch file into a list of (service, options) pairs.
 
+    An entry that cannot be parsed is returned with its error message in
+    place of the options, so it can be reported without stopping the batch.
+    """
+    import shlex
 
-def connect_db(options):
+    parser = build_parser(BatchOptionParser)
+    entries = []
+    with open(options.batch) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            service, _, arguments = line.partition(";")
+            service = service.strip()
+            try:
+                entry, _ = parser.parse_args(shlex.split(arguments))
+                entry.mode = get_mode(parser, entry)
+                if not entry.mode:
+                    raise ValueError("expected 'service description; --mode'")
+                if entry.mode == "test" or entry.batch:
+                    raise ValueError("--test and --batch are not allowed in a batch")
+            except ValueError as e:
+                entry = "UNKNOWN: Invalid batch entry: %s" % e
+            entries.append((service, entry))
+    return entries
+
+
+def connect_db(options, fresh=False):
+    """Log in to the server, or borrow a connection from the broker.
+
+    A fresh brokered connection is a new login timed by the broker, so
+    time2connect measures a real connect either way.
+    """
     host = options.hostname
     if options.instance:
         host += "\\" + options.instance
     elif options.port:
         host += ":" + options.port
+    if options.broker:
+        try:
+            import mssql_broker
+
+            mssql = mssql_broker.BrokerConnection(
+                options.broker,
+                host,
+                options.user,
+                options.password,
+                "master",
+                fresh=fresh,
+            )
+            return mssql, mssql.time2connect, host
+        except (IOError, OSError):
+            pass
+    kwargs = {}
+    if getattr(options, "connect_timeout", None):
+        # Bound the login and every query, for instances that hang
+        kwargs["login_timeout"] = kwargs["timeout"] = options.connect_timeout
+    import pymssql
+
     start = time.time()
     mssql = pymssql.connect(
-        host=host, user=options.user, password=options.password, database="master"
+        host=host,
+        user=options.user,
+        password=options.password,
+        database="master",
+        **kwargs
     )
     total = time.time() - start
     return mssql, total, host
@@ -497,26 +708,49 @@ def connect_db(options):
 def main():
     options = parse_args()
 
-    mssql, total, host = connect_db(options)
-
-    if options.mode == "test":
-        run_tests(mssql, options, host)
+    if options.instance_list:
+        report_passive(options, run_fanout(options))
 
-    elif not options.mode or options.mode == "time2connect":
-        return_nagios(
-            options,
-            stdout="Time to connect was %ss",
-            label="time",
-            unit="s",
-            result=total,
+    if options.batch:
+        entries = parse_batch_file(options)
+        fresh = any(
+            isinstance(entry, Values) and entry.mode == "time2connect"
+            for _, entry in entries
         )
-
     else:
-        execute_query(mssql, options, host)
+        fresh = not options.mode or options.mode == "time2connect"
+
+    mssql, total, host = connect_db(options, fresh)
+
+    try:
+        if options.batch:
+            report_passive(options, run_batch(mssql, options, host, total, entries))
+
+        elif options.mode == "test":
+            run_tests(mssql, options, host)
+
+        elif not options.mode or options.mode == "time2connect":
+            return_connect_time(options, total)
+
+        else:
+            execute_query(mssql, options, host)
+    finally:
+        mssql.close()
+
+
+def return_connect_time(options, total):
+    return_nagios(
+        options,
+        stdout="Time to connect was %ss",
+        label="time",
+        unit="s",
+        result=total,
+    )
 
 
-def execute_query(mssql, options, host=""):
-    sql_query = MODES[options.mode]
+def execute_query(mssql, options, host="", counters=None):
+    # A copy, as the fan-out runs queries for many instances at once
+    sql_query = dict(MODES[options.mode])
     sql_query["options"] = options
     sql_query["host"] = host
     query_type = sql_query.get("type")
@@ -526,7 +760,199 @@ def execute_query(mssql, options, host=""):
         mssql_query = MSSQLDivideQuery(**sql_query)
     else:
         mssql_query = MSSQLQuery(**sql_query)
-    mssql_query.do(mssql)
+    mssql_query.do(mssql, counters)
+
+
+def run_batch(mssql, options, host, total, entries):
+    """Run every mode of the parsed batch file over one connection.
+
+    Returns a list of (host_name, service, stdout, code) tuples in file order.
+    """
+    host_name = options.host_name or options.hostname
+
+    # Fetch the sysperfinfo counters of every mode in one round-trip, falling
+    # back to a query per mode if that fails
+    counters = PerfCounters()
+    queries = [
+        MODES[entry.mode].get("query", "")
+        for _, entry in entries
+        if isinstance(entry, Values)
+    ]
+    try:
+        counters.collect(mssql, queries)
+    except Exception:
+        pass
+
+    results = []
+    for service, entry in entries:
+        if not isinstance(entry, Values):
+            results.append((host_name, service, entry, 3))
+            continue
+        try:
+            if entry.mode == "time2connect":
+                return_connect_time(entry, total)
+            else:
+                execute_query(mssql, entry, host, counters)
+        except NagiosReturn as e:
+            results.append((host_name, service, e.message, e.code))
+        except Exception as e:
+            stdout = "UNKNOWN: %s failed with: %s" % (entry.mode, e)
+            results.append((host_name, service, stdout, 3))
+    return results
+
+
+def read_instance_list(path):
+    """Read the instance list into (host_name, server) pairs."""
+    instances = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                instances.append((fields[0], fields[-1]))
+    return instances
+
+
+def check_instance(options, host_name, server, entries):
+    """Run the mode or the batch entries on one instance of the fan-out.
+
+    Returns a list of (host_name, service, stdout, code) tuples.
+    """
+    instance_options = Values(options.__dict__)
+    instance_options.hostname = server
+    instance_options.host_name = host_name
+    instance_options.connect_timeout = max(int(options.deadline), 1)
+    if entries is not None:
+        services = [service for service, _ in entries]
+        fresh = any(
+            isinstance(entry, Values) and entry.mode == "time2connect"
+            for _, entry in entries
+        )
+    else:
+        services = [options.service or options.mode]
+        fresh = options.mode == "time2connect"
+
+    try:
+        mssql, total, host = connect_db(instance_options, fresh)
+    except Exception as e:
+        return [(host_name, service, "UNKNOWN: %s" % e, 3) for service in services]
+
+    try:
+        if entries is not None:
+            return run_batch(mssql, instance_options, host, total, entries)
+        try:
+            if options.mode == "time2connect":
+                return_connect_time(instance_options, total)
+            else:
+                execute_query(mssql, instance_options, host)
+        except NagiosReturn as e:
+            return [(host_name, services[0], e.message, e.code)]
+        except Exception as e:
+            stdout = "UNKNOWN: %s failed with: %s" % (options.mode, e)
+            return [(host_name, services[0], stdout, 3)]
+    finally:
+        try:
+            mssql.close()
+        except Exception:
+            pass
+
+
+def run_fanout(options):
+    """Check every instance in the instance list concurrently.
+
+    A fixed pool of daemon threads works through the instances; pymssql
+    releases the GIL while it waits on the network. Instances without a
+    result by --deadline are reported as UNKNOWN, and a hung one is left
+    behind when the process exits. Returns (host_name, service, stdout, code)
+    tuples in list order.
+    """
+    import threading
+
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    instances = read_instance_list(options.instance_list)
+    entries = parse_batch_file(options) if options.batch else None
+    deadline = time.time() + options.deadline
+
+    jobs = queue.Queue()
+    for index in range(len(instances)):
+        jobs.put(index)
+    outcomes = [None] * len(instances)
+
+    def worker():
+        while time.time() < deadline:
+            try:
+                index = jobs.get_nowait()
+            except queue.Empty:
+                return
+            host_name, server = instances[index]
+            outcomes[index] = check_instance(options, host_name, server, entries)
+
+    threads = []
+    for _ in range(min(options.workers, len(instances))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+    if entries is not None:
+        services = [service for service, _ in entries]
+    else:
+        services = [options.service or options.mode]
+    results = []
+    for (host_name, _), outcome in zip(instances, outcomes):
+        if outcome is None:
+            stdout = "UNKNOWN: No result before the deadline of %ss" % options.deadline
+            outcome = [(host_name, service, stdout, 3) for service in services]
+        results.extend(outcome)
+    return results
+
+
+def report_passive(options, results):
+    """Print or submit (host_name, service, stdout, code) tuples as passive
+    check results, raising NagiosReturn with the output of this run."""
+    import nagios_passive
+
+    lines = [
+        nagios_passive.format_service_result(host_name, service, code, stdout)
+        for host_name, service, stdout, code in results
+    ]
+
+    if not options.command_file:
+        raise NagiosReturn("".join(lines).rstrip("\n"), 0)
+
+    try:
+        nagios_passive.submit_results(lines, options.command_file)
+    except (IOError, OSError) as e:
+        raise NagiosReturn(
+            "UNKNOWN: Could not submit results to %s: %s" % (options.command_file, e),
+            3,
+        )
+
+    counts = [0, 0, 0, 0]
+    for _, _, _, code in results:
+        counts[min(max(code, 0), 3)] += 1
+    raise NagiosReturn(
+        "OK: Submitted %d results (%d OK, %d WARNING, %d CRITICAL, %d UNKNOWN)"
+        % ((len(results),) + tuple(counts)),
+        0,
+    )
+
+
+def connection_errors():
+    """Return the pymssql errors to report as UNKNOWN.
+
+    pymssql is only imported by a direct login or a broker error, so a
+    check that never imported it cannot have raised one.
+    """
+    pymssql = sys.modules.get("pymssql")
+    if pymssql is None:
+        return ()
+    return (pymssql.OperationalError, pymssql.InterfaceError)
 
 
 def run_tests(mssql, options, host):
@@ -550,10 +976,7 @@ def run_tests(mssql, options, host):
 if __name__ == "__main__":
     try:
         main()
-    except pymssql.OperationalError as e:
-        print(e)
-        sys.exit(3)
-    except pymssql.InterfaceError as e:
+    except connection_errors() as e:
         print(e)
         sys.exit(3)
     except IOError as e:
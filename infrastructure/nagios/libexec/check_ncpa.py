@@ -4,12 +4,15 @@ SYNOPSIS
 
 
 """
-import sys
 import optparse
-import traceback
 import ssl
+import sys
 
 # Python 2/3 Compatibility imports
+#
+# Nagios starts this plugin for every check, so modules that only some paths
+# need (traceback, shlex, tempfile, hashlib, threading) are imported where
+# they are used instead of here.
 
 try:
     import json
@@ -17,11 +20,8 @@ except ImportError:
     import simplejson as json
 
 try:
-    import urllib.request
     import urllib.parse
-    import urllib.error
 except ImportError:
-    import urllib2
     import urllib
 
 try:
@@ -29,33 +29,33 @@ try:
 except AttributeError:
     urlencode = urllib.urlencode
 
-try:
-    urlopen = urllib.request.urlopen
-except AttributeError:
-    urlopen = urllib2.urlopen
-
 try:
     urlquote = urllib.parse.quote
 except AttributeError:
     urlquote = urllib.quote
 
 try:
-    urlerror = urllib.error.URLError
+    urlsplit = urllib.parse.urlsplit
 except AttributeError:
-    urlerror = urllib2.URLError
+    import urlparse
+
+    urlsplit = urlparse.urlsplit
 
 try:
-    httperror = urllib.error.HTTPError
-except AttributeError:
-    httperror = urllib2.HTTPError
+    import http.client as httplib
+except ImportError:
+    import httplib
 
-import shlex
+import os
 import re
 import signal
-
+import stat
+import time
 
 __VERSION__ = "1.2.5"
 
+RESPONSE_CACHE_DIR = "/opt/nagios/var/check_ncpa"
+
 
 class ConnectionError(Exception):
     error_output_prefix = "UNKNOWN: An error occurred connecting to API. "
@@ -82,10 +82,15 @@ class HTTPError(ConnectionError):
         )
 
 
-def parse_args():
-    version = "check_ncpa.py, version: %s" % __VERSION__
+class BatchOptionParser(optparse.OptionParser):
+    """Option parser for batch file entries, raising instead of exiting."""
+
+    def error(self, msg):
+        raise ValueError(msg)
 
-    parser = optparse.OptionParser()
+
+def build_parser(parser_class=optparse.OptionParser):
+    parser = parser_class()
     parser.add_option("-H", "--hostname", help="The hostname to be connected to.")
     parser.add_option(
         "-M",
@@ -204,21 +209,95 @@ def parse_args():
         help="Print performance data even when there is none. "
         "Will print data matching the return code of this script",
     )
-    options, _ = parser.parse_args()
+    parser.add_option(
+        "--cache-ttl",
+        default=0,
+        type="float",
+        help="Answer from a local cache of API responses up to this many "
+        "seconds old, so overlapping checks share one request. 0 disables "
+        "the cache. [Default: %default]",
+    )
+    parser.add_option(
+        "--cache-dir",
+        default=RESPONSE_CACHE_DIR,
+        help="Directory of the response cache. [Default: %default]",
+    )
+    parser.add_option(
+        "--cache-size",
+        default=10240,
+        type="int",
+        help="Size of the response cache in KiB, the entries closest to "
+        "expiring are evicted beyond it. [Default: %default]",
+    )
+    parser.add_option(
+        "-b",
+        "--batch",
+        default=None,
+        help="File of metrics to check over one connection, one per line as "
+        "'service description; check_ncpa options' (e.g. 'CPU Usage; -M "
+        "cpu/percent -w 80 -c 90'). Connection options are inherited from "
+        "the command line. Prints PROCESS_SERVICE_CHECK_RESULT lines.",
+    )
+    parser.add_option(
+        "-L",
+        "--host-list",
+        default=None,
+        help="File of hosts to check the metric on concurrently, one per line "
+        "as 'host_name [address]'. Prints one PROCESS_SERVICE_CHECK_RESULT "
+        "line per host.",
+    )
+    parser.add_option(
+        "--workers",
+        default=50,
+        type="int",
+        help="With --host-list, the number of hosts checked at once. "
+        "[Default: %default]",
+    )
+    parser.add_option(
+        "--host-timeout",
+        default=None,
+        type="float",
+        help="With --host-list, the timeout in seconds for each host. "
+        "[Default: --timeout split across the waves of workers]",
+    )
+    parser.add_option(
+        "--service",
+        default=None,
+        help="With --host-list, the service description the results belong "
+        "to. [Default: the --metric value]",
+    )
+    parser.add_option(
+        "--command-file",
+        default=None,
+        help="With --batch or --host-list, submit the results to this Nagios "
+        "command file instead of printing them.",
+    )
+    parser.add_option(
+        "--host-name",
+        default=None,
+        help="With --batch, the Nagios host name the results belong to. "
+        "[Default: the --hostname value]",
+    )
+    return parser
 
-    if options.version:
-        print(version)
-        sys.exit(0)
 
+def validate_options(parser, options):
     if options.arguments and options.metric and not "plugin" in options.metric:
         parser.print_help()
         parser.error("You cannot specify arguments without running a custom plugin.")
 
-    if not options.hostname:
+    if options.host_list:
+        if options.batch or options.list:
+            parser.print_help()
+            parser.error("--host-list cannot be combined with --batch or --list.")
+        if options.workers < 1:
+            parser.error("--workers must be at least 1.")
+
+    if not options.hostname and not options.host_list:
         parser.print_help()
         parser.error("Hostname is required for use.")
 
-    elif not options.metric and not options.list:
+    elif not options.metric and not options.list and not options.batch:
         parser.print_help()
         parser.error(
             "No metric given, if you want to list all possible items " "use --list."
@@ -226,9 +305,78 @@ def parse_args():
 
     options.metric = re.sub(r"^/?(api/)?", "", options.metric)
 
+
+def parse_args():
+    version = "check_ncpa.py, version: %s" % __VERSION__
+
+    parser = build_parser()
+    options, _ = parser.parse_args()
+
+    if options.version:
+        print(version)
+        sys.exit(0)
+
+    validate_options(parser, options)
+
     return options
 
 
+# Options a batch file entry inherits from the command line
+BATCH_INHERITED_OPTIONS = (
+    "hostname",
+    "port",
+    "token",
+    "timeout",
+    "secure",
+    "performance",
+    "verbose",
+    "debug",
+    "cache_ttl",
+    "cache_dir",
+    "cache_size",
+)
+
+
+def parse_batch_file(options):
+    """Read the batch file into a list of (service, options) pairs.
+
+    An entry that cannot be parsed is returned with its error message in
+    place of the options, so it can be reported without stopping the batch.
+    """
+    parser = build_parser(BatchOptionParser)
+    parser.set_defaults(
+        **dict((k, getattr(options, k)) for k in BATCH_INHERITED_OPTIONS)
+    )
+
+    import shlex
+
+    entries = []
+    with open(options.batch) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            service, _, arguments = line.partition(";")
+            service = service.strip()
+            try:
+                if not arguments.strip():
+                    raise ValueError("expected 'service description; options'")
+                metric_options, _ = parser.parse_args(shlex.split(arguments))
+                if metric_options.batch or metric_options.list:
+                    raise ValueError("--batch and --list are not allowed in a batch")
+                # Every entry goes over the one connection to -H and -P
+                if (metric_options.hostname, metric_options.port) != (
+                    options.hostname,
+                    options.port,
+                ):
+                    raise ValueError("-H and -P are set for the whole batch")
+                validate_options(parser, metric_options)
+            except ValueError as e:
+                metric_options = "UNKNOWN: Invalid batch entry: %s" % e
+            entries.append((service, metric_options))
+    return entries
+
+
 # ~ The following are all helper functions. I would normally split these out into
 # ~ a new module but this needs to be portable.
 
@@ -269,6 +417,8 @@ def get_check_arguments_from_options(options):
     if arguments is None:
         return ""
     else:
+        import shlex
+
         lex = shlex.shlex(arguments)
         lex.whitespace_split = True
         arguments = "/".join([urlquote(x, safe="") for x in lex])
@@ -310,38 +460,318 @@ def get_arguments_from_options(options, **kwargs):
     return urlencode(args)
 
 
+# SSL contexts keyed by whether certificates are verified, and the last TLS
+# session seen per (context, host, port), shared by every request this
+# process makes so reconnects can resume instead of doing a full handshake.
+SSL_CONTEXTS = {}
+TLS_SESSIONS = {}
+
+
+def get_ssl_context(options):
+    """Return the shared SSL context used for connections to the NCPA API.
+
+    When certificates are not verified the system CA store is never loaded,
+    which is most of the cost of creating a default context.
+    """
+    secure = bool(options.secure)
+    if secure not in SSL_CONTEXTS:
+        if secure or not hasattr(ssl, "PROTOCOL_TLS_CLIENT"):
+            ctx = ssl.create_default_context()
+        else:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if not secure:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        SSL_CONTEXTS[secure] = ctx
+    return SSL_CONTEXTS[secure]
+
+
+class ResumingHTTPSConnection(httplib.HTTPSConnection):
+    """An HTTPS connection that offers the host's last TLS session on connect."""
+
+    tls_socket = None
+
+    def session_key(self):
+        return (id(self._context), self.host, self.port)
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        kwargs = {"server_hostname": self.host}
+        session = TLS_SESSIONS.get(self.session_key())
+        if session is not None:
+            kwargs["session"] = session
+        self.sock = self._context.wrap_socket(self.sock, **kwargs)
+        self.tls_socket = self.sock
+
+    def remember_session(self):
+        """Store the current TLS session so the next connect can resume it.
+
+        TLS 1.3 tickets arrive after the handshake, so this is called once a
+        response has started arriving.
+        """
+        session = getattr(self.tls_socket, "session", None)
+        if session is not None:
+            TLS_SESSIONS[self.session_key()] = session
+
+
+def private_path(st):
+    """Return whether a stat result is owned by us and not writable by others."""
+    return st.st_uid == os.geteuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+class ResponseCache(object):
+    """An on-disk cache of NCPA API response bodies, keyed by request URL.
+
+    Each entry is a file named after a digest of the URL whose modification
+    time is set to when it expires, so expiry and eviction only need a stat.
+    Entries are renamed into place, so concurrent checks never read a partial
+    body. Once the directory grows past max_size bytes, the entries closest
+    to expiring are evicted first.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, url):
+        import hashlib
+
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def private_dir(self):
+        """Create the cache directory and check that only we can write to it.
+
+        Responses can include anything the token can read, and a planted
+        entry would be reported as the host's state, so a directory that is
+        a symlink, owned by another user or writable by others is not used.
+        """
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError:
+            pass
+        try:
+            st = os.lstat(self.directory)
+        except OSError:
+            return False
+        return stat.S_ISDIR(st.st_mode) and private_path(st)
+
+    def get(self, url):
+        """Return the cached body for url, or None if it is missing or expired."""
+        if not self.private_dir():
+            return None
+        try:
+            fd = os.open(self.path(url), os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        except OSError:
+            return None
+        with os.fdopen(fd, "rb") as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or not private_path(st):
+                return None
+            if st.st_mtime < time.time():
+                return None
+            try:
+                return f.read()
+            except (IOError, OSError):
+                return None
+
+    def put(self, url, body, ttl):
+        """Store body for url for ttl seconds, then evict down to max_size."""
+        import tempfile
+
+        if not self.private_dir():
+            raise OSError("Cache directory %s is not private" % self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            expires = time.time() + ttl
+            os.utime(tmp_path, (expires, expires))
+            os.rename(tmp_path, self.path(url))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            # Dot files are writes still in progress
+            if name.startswith("."):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for expires, size, path in entries:
+            if expires >= now and total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def get_response_cache(options):
+    """Return the ResponseCache configured by the options."""
+    return ResponseCache(options.cache_dir, options.cache_size * 1024)
+
+
+def read_cache(options, url):
+    """Return the cached response body for url, or None on a cache miss."""
+    if options.cache_ttl <= 0:
+        return None
+    body = get_response_cache(options).get(url)
+    if options.verbose:
+        print("Cache %s: %s" % ("miss" if body is None else "hit", url))
+    return body
+
+
+def write_cache(options, url, body):
+    """Cache a response body, a failure only costs the next check a request."""
+    if options.cache_ttl <= 0:
+        return
+    try:
+        get_response_cache(options).put(url, body, options.cache_ttl)
+    except (IOError, OSError) as e:
+        if options.verbose:
+            print("Could not cache the response: %s" % e)
+
+
 def get_json(options):
     """Get the page given by the options. This will call down the url and
     encode its finding into a Python object (from JSON).
 
+    A single check goes through urllib's opener, which honours the proxy
+    environment variables and follows redirects. It is imported here since
+    batch and fan-out checks use NCPAConnection instead.
     """
+    try:
+        import urllib.error as urlerrors
+        import urllib.request as urlrequest
+    except ImportError:
+        import urllib2 as urlrequest
+
+        urlerrors = urlrequest
 
     url = get_url_from_options(options)
 
+    body = read_cache(options, url)
+    if body is not None:
+        return parse_json(body, options)
+
     if options.verbose:
         print("Connecting to: " + url)
 
     try:
 
         try:
-            ctx = ssl.create_default_context()
-            if not options.secure:
-                ctx.check_hostname = False
-                ctx.verify_mode = ssl.CERT_NONE
-            ret = urlopen(url, context=ctx)
+            ctx = get_ssl_context(options)
+            ret = urlrequest.urlopen(url, context=ctx)
         except AttributeError:
-            ret = urlopen(url)
+            ret = urlrequest.urlopen(url)
 
-    except httperror as e:
+    except urlerrors.HTTPError as e:
         try:
             raise HTTPError("{0} {1}".format(e.code, e.reason))
         except AttributeError:
             raise HTTPError("{0}".format(e.code))
-    except urlerror as e:
+    except urlerrors.URLError as e:
         raise URLError("{0}".format(e.reason))
 
-    ret = ret.read()
+    body = ret.read()
+    info_json = parse_json(body, options)
+    write_cache(options, url, body)
+    return info_json
 
+
+class NCPAConnection(object):
+    """A keep-alive HTTPS connection to one NCPA host.
+
+    Used by batch mode so that many metrics share a single TLS handshake.
+    A request on a reused connection that the server has since closed is
+    retried once on a fresh connection, resuming the previous TLS session.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.context = get_ssl_context(options)
+        self.connection = None
+        self.tls_socket = None
+        self.requests = 0
+
+    def connect(self):
+        self.connection = ResumingHTTPSConnection(
+            self.options.hostname,
+            self.options.port,
+            timeout=self.options.timeout,
+            context=self.context,
+        )
+        self.requests = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get_json(self, options):
+        """Same as get_json(), but over this connection."""
+        url = get_url_from_options(options)
+        parts = urlsplit(url)
+        path = "%s?%s" % (parts.path, parts.query)
+
+        body = read_cache(options, url)
+        if body is not None:
+            return parse_json(body, options)
+
+        if options.verbose:
+            print("Requesting: " + url)
+
+        while True:
+            if self.connection is None:
+                self.connect()
+            # Batch entries get less time the closer the batch is to --timeout
+            self.connection.timeout = options.timeout
+            if self.connection.sock is not None:
+                self.connection.sock.settimeout(options.timeout)
+            reused = self.requests > 0
+            try:
+                self.connection.request("GET", path)
+                tls_socket = self.connection.tls_socket
+                response = self.connection.getresponse()
+                self.connection.remember_session()
+                ret = response.read()
+            except (httplib.HTTPException, IOError) as e:
+                self.close()
+                if reused:
+                    continue
+                raise URLError("{0}".format(e))
+            if options.verbose and tls_socket is not self.tls_socket:
+                if getattr(tls_socket, "session_reused", False):
+                    print("Resumed TLS session with %s" % options.hostname)
+                else:
+                    print("Full TLS handshake with %s" % options.hostname)
+            self.tls_socket = tls_socket
+            self.requests += 1
+            break
+
+        if response.status >= 400:
+            raise HTTPError("{0} {1}".format(response.status, response.reason))
+
+        info_json = parse_json(ret, options)
+        write_cache(options, url, ret)
+        return info_json
+
+
+def parse_json(ret, options):
+    """Decode a response body from the NCPA API into check results."""
     if options.verbose:
         print("File returned contained:\n" + ret.decode("utf-8"))
 
@@ -381,6 +811,207 @@ def show_list(info_json):
     return json.dumps(info_json, indent=4), 0
 
 
+# Seconds of --timeout kept back from a batch or the fan-out for reporting
+# the results
+FANOUT_MARGIN = 2
+
+
+def run_batch(options):
+    """Check every metric in the batch file over one shared connection.
+
+    The requests share a deadline shortly before --timeout, and each may
+    only take the time left until it. Entries not reached by then are
+    reported as UNKNOWN, so the results already gathered are still printed
+    or submitted.
+
+    Returns a list of (host_name, service, stdout, returncode) tuples in
+    file order.
+    """
+    host_name = options.host_name or options.hostname
+    deadline = time.time() + max(options.timeout - FANOUT_MARGIN / 2.0, 1)
+    connection = NCPAConnection(options)
+    results = []
+    try:
+        for service, metric_options in parse_batch_file(options):
+            if not isinstance(metric_options, optparse.Values):
+                results.append((host_name, service, metric_options, 3))
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                stdout = (
+                    "UNKNOWN: No result before the timeout threshold of %ds"
+                    % options.timeout
+                )
+                results.append((host_name, service, stdout, 3))
+                continue
+            metric_options.timeout = min(metric_options.timeout, remaining)
+            try:
+                info_json = connection.get_json(metric_options)
+                stdout, returncode = check_result(info_json, metric_options)
+            except Exception as e:
+                stdout, returncode = format_error(e, metric_options)
+            results.append((host_name, service, stdout, returncode))
+    finally:
+        connection.close()
+    return results
+
+
+def read_host_list(path):
+    """Read the host list into (host_name, address) pairs."""
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                hosts.append((fields[0], fields[-1]))
+    return hosts
+
+
+def get_host_timeout(options, host_count):
+    """Split the --timeout budget so every wave of workers finishes in time."""
+    if options.host_timeout:
+        return options.host_timeout
+    waves = (host_count + options.workers - 1) // options.workers
+    return max(1.0, float(options.timeout - FANOUT_MARGIN) / max(waves, 1))
+
+
+def check_host(options, address, timeout):
+    """Check the metric on one host of the fan-out, returning (stdout, returncode)."""
+    host_options = optparse.Values(options.__dict__)
+    host_options.hostname = address
+    host_options.timeout = timeout
+    connection = NCPAConnection(host_options)
+    try:
+        info_json = connection.get_json(host_options)
+        return check_result(info_json, host_options)
+    except Exception as e:
+        return format_error(e, host_options)
+    finally:
+        connection.close()
+
+
+def run_fanout(options):
+    """Check the metric on every host in the host list concurrently.
+
+    A fixed pool of daemon threads works through the hosts, each request
+    bounded by the per-host timeout. Hosts still unanswered shortly before
+    --timeout are reported as UNKNOWN so the rest of the results are kept.
+    Returns a list of (host_name, service, stdout, returncode) tuples.
+    """
+    import threading
+
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    hosts = read_host_list(options.host_list)
+    host_timeout = get_host_timeout(options, len(hosts))
+    deadline = time.time() + max(options.timeout - FANOUT_MARGIN / 2.0, 1)
+    service = options.service or options.metric
+
+    if options.verbose:
+        print(
+            "Checking %d hosts with %d workers and a %.1fs timeout per host"
+            % (len(hosts), options.workers, host_timeout)
+        )
+
+    jobs = queue.Queue()
+    for index in range(len(hosts)):
+        jobs.put(index)
+    outcomes = [None] * len(hosts)
+
+    def worker():
+        while time.time() < deadline:
+            try:
+                index = jobs.get_nowait()
+            except queue.Empty:
+                return
+            outcomes[index] = check_host(options, hosts[index][1], host_timeout)
+
+    threads = []
+    for _ in range(min(options.workers, len(hosts))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+    results = []
+    for (host_name, _), outcome in zip(hosts, outcomes):
+        if outcome is None:
+            outcome = (
+                "UNKNOWN: No result before the timeout threshold of %ds"
+                % options.timeout,
+                3,
+            )
+        results.append((host_name, service) + tuple(outcome))
+    return results
+
+
+def report_passive(options, results):
+    """Print or submit (host_name, service, stdout, returncode) tuples as
+    passive check results.
+
+    """
+    import nagios_passive
+
+    lines = [
+        nagios_passive.format_service_result(host_name, service, returncode, stdout)
+        for host_name, service, stdout, returncode in results
+    ]
+
+    if not options.command_file:
+        return "".join(lines).rstrip("\n"), 0
+
+    try:
+        nagios_passive.submit_results(lines, options.command_file)
+    except (IOError, OSError) as e:
+        stdout = "UNKNOWN: Could not submit results to %s: %s" % (
+            options.command_file,
+            e,
+        )
+        return stdout, 3
+
+    counts = [0, 0, 0, 0]
+    for _, _, _, returncode in results:
+        counts[min(max(returncode, 0), 3)] += 1
+    return (
+        "OK: Submitted %d results (%d OK, %d WARNING, %d CRITICAL, %d UNKNOWN)"
+        % ((len(results),) + tuple(counts)),
+        0,
+    )
+
+
+def check_result(info_json, options):
+    """Turn the API response for a metric into (stdout, returncode)."""
+    stdout, returncode = run_check(info_json)
+
+    if options.performance and stdout.find("|") == -1:
+        stdout = "{0} | 'status'={1};1;2;;".format(stdout, returncode)
+    return stdout, returncode
+
+
+def format_error(e, options):
+    """Turn an exception raised while checking into (stdout, returncode)."""
+    if options.debug:
+        import traceback
+
+        return "The stack trace:\n" + traceback.format_exc(), 3
+    elif isinstance(e, ConnectionError):
+        if options.verbose:
+            return "An error occurred:\n" + str(e.error_message), 3
+        return e.error_message, 3
+    elif options.verbose:
+        return "An error occurred:\n" + str(e), 3
+    else:
+        return (
+            "UNKNOWN: Error occurred while running the plugin. Use the verbose flag for more details.",
+            3,
+        )
+
+
 def timeout_handler(threshold):
     def wrapped(signum, frames):
         stdout = "UNKNOWN: Execution exceeded timeout threshold of %ds" % threshold
@@ -403,33 +1034,20 @@ def main():
             stdout = "The version of this plugin is %s" % __VERSION__
             return stdout, 0
 
+        if options.batch:
+            return report_passive(options, run_batch(options))
+
+        if options.host_list:
+            return report_passive(options, run_fanout(options))
+
         info_json = get_json(options)
 
         if options.list:
             return show_list(info_json)
         else:
-            stdout, returncode = run_check(info_json)
-
-            if options.performance and stdout.find("|") == -1:
-                stdout = "{0} | 'status'={1};1;2;;".format(stdout, returncode)
-            return stdout, returncode
-    except (HTTPError, URLError) as e:
-        if options.debug:
-            return "The stack trace:\n" + traceback.format_exc(), 3
-        elif options.verbose:
-            return "An error occurred:\n" + str(e.error_message), 3
-        else:
-            return e.error_message, 3
+            return check_result(info_json, options)
     except Exception as e:
-        if options.debug:
-            return "The stack trace:\n" + traceback.format_exc(), 3
-        elif options.verbose:
-            return "An error occurred:\n" + str(e), 3
-        else:
-            return (
-                "UNKNOWN: Error occurred while running the plugin. Use the verbose flag for more details.",
-                3,
-            )
+        return format_error(e, options)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
+import math
+import time
 import socket
+import stat
+import hashlib
+import tempfile
+import asyncio
 import logging
+import argparse
+import http.client
+from collections import namedtuple
+
+import nagios_passive
 
 # Nagios exit codes
 NAGIOS_OK = 0
@@ -13,63 +26,1007 @@ NAGIOS_UNKNOWN = 3
 # File containing webserver list
 WEBSERVERS_FILE = "/opt/nagios/etc/webservers.txt"
 DEFAULT_TIMEOUT = 5  # Default timeout for server checks
+DEFAULT_CONCURRENCY = 256  # Maximum number of probes in flight at once
+STATUS_PATH = "/status"  # Health endpoint polled by HAProxy (option httpchk)
+
+# Probe daemon settings (--daemon serves verdicts that --client reads)
+DAEMON_SOCKET = "/opt/nagios/var/rw/check_webservers.sock"
+DEFAULT_INTERVAL = 30  # Seconds between daemon probe rounds
+DEFAULT_MAX_AGE = 120  # Oldest daemon verdict the client will accept
+CLIENT_TIMEOUT = 1  # Seconds the client waits on the daemon socket
+# Options that change what the daemon probes. A client asking for other
+# values probes by itself, the daemon applies the rest to its results.
+PROBE_OPTIONS = ("file", "timeout", "deadline", "http", "ttfb")
+
+# Passive submission defaults, matching the active service in webservers.cfg
+PASSIVE_HOST = "localhost"
+PASSIVE_SERVICE = "Web Server Status"
+
+# Parsed inventories are cached here, keyed by the webservers file's mtime.
+# Only the nagios user may write to it, see private_path().
+INVENTORY_CACHE_DIR = "/opt/nagios/var/check_webservers"
+INVENTORY_CACHE_VERSION = 2  # Bump when the entry format changes
+
+STATUS_NAMES = {
+    NAGIOS_OK: "OK",
+    NAGIOS_WARNING: "WARNING",
+    NAGIOS_CRITICAL: "CRITICAL",
+    NAGIOS_UNKNOWN: "UNKNOWN",
+}
+
+# Outcome of probing one host:port entry. Times are in seconds and are None
+# when the server is down or the measurement was not taken. In HTTP mode
+# ``up`` means the /status endpoint answered healthy, ``http_time`` is the
+# full request time and ``error`` explains why a server was marked down.
+ProbeResult = namedtuple(
+    "ProbeResult",
+    ["server", "up", "connect_time", "ttfb", "http_time", "error"],
+    defaults=(None, None),
+)
+
+# One valid line of the webservers file. ``timeout`` is None unless the entry
+# overrides the command line timeout; ``tags`` is a tuple of group names.
+Entry = namedtuple("Entry", ["server", "host", "port", "timeout", "tags"])
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 
-def check_server(host, port, timeout):
-    """Check if a server is reachable on a specific port."""
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check that every server listed in the webservers file is reachable."
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        default=WEBSERVERS_FILE,
+        help="File listing host:port entries (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-g",
+        "--tag",
+        action="append",
+        default=[],
+        help="Only check entries carrying this tag; may be given more than once",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always re-parse the webservers file instead of using the cache",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Connect timeout per server in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-C",
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of concurrent probes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-d",
+        "--deadline",
+        type=float,
+        default=None,
+        help="Overall deadline for all probes in seconds; servers not answered "
+        "by then count as offline (default: longest timeout + 1)",
+    )
+    parser.add_argument(
+        "-w",
+        "--warning",
+        type=float,
+        default=None,
+        help="Response time in seconds above which a server is WARNING",
+    )
+    parser.add_argument(
+        "-c",
+        "--critical",
+        type=float,
+        default=None,
+        help="Response time in seconds above which a server is CRITICAL",
+    )
+    parser.add_argument(
+        "--ttfb",
+        action="store_true",
+        help=f"Also measure time-to-first-byte of GET {STATUS_PATH}; thresholds "
+        "then apply to it instead of the connect time",
+    )
+    parser.add_argument(
+        "--http",
+        action="store_true",
+        help=f"Judge health by GET {STATUS_PATH} returning 200 and "
+        '{"status": "ok"}, like HAProxy does, instead of a TCP connect',
+    )
+    parser.add_argument(
+        "--serial",
+        action="store_true",
+        help="Probe servers one at a time instead of concurrently",
+    )
+    daemon = parser.add_mutually_exclusive_group()
+    daemon.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Run forever, probing every --interval seconds and serving the "
+        "latest verdict on --socket",
+    )
+    daemon.add_argument(
+        "--client",
+        action="store_true",
+        help="Print the verdict of a running --daemon for this -g/-w/-c, probing "
+        "directly if it is unreachable or stale or probes with other options",
+    )
+    parser.add_argument(
+        "--passive",
+        action="store_true",
+        help="Also submit the results as passive checks to the Nagios command file",
+    )
+    parser.add_argument(
+        "--command-file",
+        default=nagios_passive.COMMAND_FILE,
+        help="Nagios external command file for --passive (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--host-name",
+        default=PASSIVE_HOST,
+        help="Host the aggregate passive result belongs to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--service",
+        default=PASSIVE_SERVICE,
+        help="Service the aggregate passive result belongs to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--backend-service",
+        default=None,
+        help="With --passive, also submit one result per backend under this "
+        "service description, using the entry's host as host name",
+    )
+    parser.add_argument(
+        "--socket",
+        default=DAEMON_SOCKET,
+        help="Unix socket shared by --daemon and --client (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help="Seconds between probe rounds in --daemon mode (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE,
+        help="Oldest daemon verdict in seconds --client accepts (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.timeout <= 0:
+        parser.error("Timeout must be greater than zero.")
+    if args.concurrency < 1:
+        parser.error("Concurrency must be at least 1.")
+    if args.daemon and args.serial:
+        parser.error("--daemon always probes concurrently, drop --serial.")
+    if args.interval <= 0:
+        parser.error("Interval must be greater than zero.")
+
+    return args
+
+
+def status_request(host, keep_alive=False):
+    """Build the HTTP request for the status endpoint."""
+    if keep_alive:
+        return (
+            f"GET {STATUS_PATH} HTTP/1.1\r\nHost: {host}\r\n"
+            "Accept: application/json\r\nConnection: keep-alive\r\n\r\n"
+        ).encode()
+    return f"GET {STATUS_PATH} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode()
+
+
+def validate_status(status, body):
+    """Return None if a /status response is healthy, else the reason it is not."""
+    if status != 200:
+        return f"HTTP {status}"
     try:
-        with socket.create_connection((host, int(port)), timeout=timeout):
-            return True
-    except (socket.timeout, ConnectionRefusedError, socket.gaierror):
-        return False
+        payload = json.loads(body)
+    except ValueError:
+        return "invalid JSON"
+    if not isinstance(payload, dict) or payload.get("status") != "ok":
+        return "unhealthy status"
+    return None
+
 
+def describe_error(exc):
+    """Return a short reason for a failed probe."""
+    if isinstance(exc, (asyncio.TimeoutError, socket.timeout)):
+        return "timed out"
+    if isinstance(exc, ConnectionRefusedError):
+        return "connection refused"
+    return str(exc) or type(exc).__name__
 
-def main():
-    timeout = DEFAULT_TIMEOUT
 
+def check_server(host, port, timeout, ttfb=False):
+    """Check if a server is reachable on a specific port and time the connect."""
+    server = f"{host}:{port}"
+    start = time.perf_counter()
     try:
-        with open(WEBSERVERS_FILE, "r") as f:
-            servers = [line.strip() for line in f if line.strip()]
-    except FileNotFoundError:
-        print(f"UNKNOWN - File {WEBSERVERS_FILE} not found")
-        sys.exit(NAGIOS_UNKNOWN)
+        with socket.create_connection((host, int(port)), timeout=timeout) as sock:
+            connect_time = time.perf_counter() - start
+            first_byte = None
+            if ttfb:
+                try:
+                    sock.sendall(status_request(host))
+                    if sock.recv(1):
+                        first_byte = time.perf_counter() - start
+                except OSError:
+                    pass
+            return ProbeResult(server, True, connect_time, first_byte)
+    except (OSError, ValueError) as e:
+        # ValueError: a host that fails IDNA encoding, e.g. "a..b"
+        return ProbeResult(server, False, None, None, None, describe_error(e))
+
+
+def check_http(host, port, timeout):
+    """Check the status endpoint of a server over a plain blocking connection."""
+    server = f"{host}:{port}"
+    start = time.perf_counter()
+    connect_time = None
+    conn = http.client.HTTPConnection(host, int(port), timeout=timeout)
+    try:
+        conn.connect()
+        connect_time = time.perf_counter() - start
+        conn.request("GET", STATUS_PATH, headers={"Accept": "application/json"})
+        response = conn.getresponse()
+        ttfb = time.perf_counter() - start
+        body = response.read()
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        return ProbeResult(server, False, connect_time, None, None, describe_error(e))
+    finally:
+        conn.close()
+    http_time = time.perf_counter() - start
+    error = validate_status(response.status, body)
+    return ProbeResult(server, error is None, connect_time, ttfb, http_time, error)
 
-    if not servers:
-        print(f"UNKNOWN - No servers listed in {WEBSERVERS_FILE}")
-        sys.exit(NAGIOS_UNKNOWN)
 
-    down_servers = []
+class ConnectionPool:
+    """Idle keep-alive connections to the backends, keyed by (host, port).
 
-    for server in servers:
+    A connection is handed back after a complete response that allows
+    keep-alive, so later probes of the same server skip the TCP handshake.
+    A server listed more than once is probed over several connections at
+    the same time, so each key holds a list of them.
+    """
+
+    def __init__(self):
+        self.idle = {}
+
+    async def acquire(self, host, port, timeout):
+        """Return (reader, writer, connect_time); connect_time is None if reused."""
+        conns = self.idle.get((host, port), [])
+        while conns:
+            reader, writer = conns.pop()
+            if not writer.is_closing():
+                return reader, writer, None
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, int(port)), timeout=timeout
+        )
+        return reader, writer, time.perf_counter() - start
+
+    def release(self, host, port, reader, writer):
+        self.idle.setdefault((host, port), []).append((reader, writer))
+
+    def close(self):
+        for conns in self.idle.values():
+            for _, writer in conns:
+                writer.close()
+        self.idle.clear()
+
+
+async def read_http_response(reader):
+    """Read one HTTP response, returning (status, body, keep_alive)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("connection closed by server")
+    version, status = status_line.decode("latin-1").split(None, 2)[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = version == "HTTP/1.1" and headers.get("connection") != "close"
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    return int(status), body, keep_alive
+
+
+async def request_status(host, port, timeout, pool):
+    """Issue GET /status on a pooled connection, retrying once if it was stale."""
+    server = f"{host}:{port}"
+    start = time.perf_counter()
+    for attempt in range(2):
+        reader, writer, connect_time = await pool.acquire(host, port, timeout)
         try:
-            host, port = server.split(":")
-            logging.info(f"Checking {host}:{port} with timeout {timeout}")
-            if not check_server(host, port, timeout=timeout):
-                down_servers.append(server)
-        except ValueError:
-            print(f"UNKNOWN - Invalid server format: {server}")
-            sys.exit(NAGIOS_UNKNOWN)
+            writer.write(status_request(host, keep_alive=True))
+            await writer.drain()
+            status, body, keep_alive = await read_http_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if connect_time is not None or attempt:
+                raise
+            continue
+        except BaseException:
+            writer.close()
+            raise
+        break
+
+    http_time = time.perf_counter() - start
+    if keep_alive:
+        pool.release(host, port, reader, writer)
+    else:
+        writer.close()
+    error = validate_status(status, body)
+    return ProbeResult(server, error is None, connect_time, None, http_time, error)
+
+
+async def probe_http(host, port, timeout, semaphore, pool):
+    """Asynchronously check the status endpoint of a server."""
+    server = f"{host}:{port}"
+    async with semaphore:
+        logging.info(f"Requesting {STATUS_PATH} from {server} with timeout {timeout}")
+        try:
+            return await asyncio.wait_for(
+                request_status(host, port, timeout, pool), timeout=timeout
+            )
+        except (asyncio.TimeoutError, OSError, ValueError, EOFError) as e:
+            return ProbeResult(server, False, None, None, None, describe_error(e))
+
+
+async def probe_server(host, port, timeout, semaphore, ttfb=False):
+    """Asynchronously check if a server is reachable and time the connect."""
+    server = f"{host}:{port}"
+    async with semaphore:
+        logging.info(f"Checking {server} with timeout {timeout}")
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port)), timeout=timeout
+            )
+        except (asyncio.TimeoutError, OSError, ValueError) as e:
+            # ValueError: a host that fails IDNA encoding, e.g. "a..b"
+            return ProbeResult(server, False, None, None, None, describe_error(e))
+        connect_time = time.perf_counter() - start
+        first_byte = None
+        try:
+            if ttfb:
+                remaining = max(timeout - connect_time, 0)
+                writer.write(status_request(host))
+                if await asyncio.wait_for(reader.read(1), timeout=remaining):
+                    first_byte = time.perf_counter() - start
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        return ProbeResult(server, True, connect_time, first_byte)
+
+
+async def probe_servers(
+    targets, timeout, concurrency, deadline, ttfb=False, http=False, pool=None
+):
+    """Probe all (host, port) targets concurrently.
+
+    At most ``concurrency`` connections are open at any time, and any probe
+    still pending when ``deadline`` expires is cancelled and reported as down.
+    With ``http`` the status endpoint is requested instead, reusing idle
+    connections from ``pool`` when one is given.
+    ``targets`` are inventory entries; an entry's own timeout takes precedence
+    over ``timeout``.
+    Returns a list of ProbeResult in the same order as ``targets``.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    if http:
+        owned_pool = pool is None
+        pool = pool or ConnectionPool()
+        probes = [
+            probe_http(e.host, e.port, e.timeout or timeout, semaphore, pool)
+            for e in targets
+        ]
+    else:
+        probes = [
+            probe_server(e.host, e.port, e.timeout or timeout, semaphore, ttfb)
+            for e in targets
+        ]
+    tasks = [asyncio.ensure_future(probe) for probe in probes]
+    _, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.info(
+            f"Deadline of {deadline}s reached with {len(pending)} probes pending"
+        )
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    if http and owned_pool:
+        pool.close()
+
+    results = []
+    for task, entry in zip(tasks, targets):
+        if task in pending:
+            results.append(
+                ProbeResult(entry.server, False, None, None, None, "deadline")
+            )
+        else:
+            results.append(task.result())
+    return results
+
+
+def parse_entry(line):
+    """Parse one webservers line, raising ValueError on a malformed entry.
+
+    Lines look like ``host:port [timeout=SECONDS] [tags=a,b]``; anything after
+    a ``#`` is a comment. Returns None for blank and comment-only lines.
+    """
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+
+    server, *options = line.split()
+    host, sep, port = server.rpartition(":")
+    if not sep or not host:
+        raise ValueError("expected host:port")
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"invalid port {port!r}")
+
+    timeout = None
+    tags = ()
+    for option in options:
+        key, sep, value = option.partition("=")
+        if key == "timeout" and sep:
+            try:
+                timeout = float(value)
+            except ValueError:
+                timeout = 0
+            if timeout <= 0:
+                raise ValueError(f"invalid timeout {value!r}")
+        elif key == "tags" and sep:
+            tags = tuple(tag for tag in value.split(",") if tag)
+        else:
+            raise ValueError(f"unknown option {option!r}")
+
+    return Entry(server, host, port, timeout, tags)
+
+
+def parse_inventory(path):
+    """Parse the webservers file into (entries, errors).
+
+    Malformed lines do not stop parsing; each one is returned in ``errors`` as
+    a (line number, line, reason) tuple.
+    """
+    entries = []
+    errors = []
+    with open(path, "r") as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                entry = parse_entry(line)
+            except ValueError as e:
+                errors.append((lineno, line.strip(), str(e)))
+                continue
+            if entry is not None:
+                entries.append(entry)
+    return entries, errors
+
+
+def inventory_cache_path(path):
+    """Return the cache file used for a given webservers file."""
+    digest = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+    return os.path.join(INVENTORY_CACHE_DIR, f"check_webservers-{digest}.cache")
+
+
+def private_path(st):
+    """Return True if st is owned by this user and nobody else can write it."""
+    return st.st_uid == os.geteuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def private_cache_dir():
+    """Create the inventory cache directory, returning True if it is private."""
+    try:
+        os.makedirs(INVENTORY_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(INVENTORY_CACHE_DIR)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and private_path(st)
+
+
+def read_inventory_cache(cache_path):
+    """Return the cached (key, entries, errors), or None if it can't be trusted."""
+    try:
+        fd = os.open(cache_path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd, "r") as f:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or not private_path(st):
+            logging.info(f"Ignoring inventory cache {cache_path} not private to us")
+            return None
+        try:
+            data = json.load(f)
+            key = tuple(data["key"])
+            entries = [
+                Entry(server, host, port, timeout, tuple(tags))
+                for server, host, port, timeout, tags in data["entries"]
+            ]
+            errors = [tuple(error) for error in data["errors"]]
+        except (ValueError, TypeError, KeyError):
+            return None
+    return key, entries, errors
+
+
+def load_inventory(path, use_cache=True):
+    """Return (entries, errors) for the webservers file.
+
+    The parsed result is stored as JSON in INVENTORY_CACHE_DIR, keyed by the
+    file's mtime and size, so unchanged files are never re-parsed. The cache
+    is only used while that directory and the file in it are owned by this
+    user and writable by nobody else. Raises OSError if the webservers file
+    cannot be read.
+    """
+    stat_result = os.stat(path)
+    key = (INVENTORY_CACHE_VERSION, stat_result.st_mtime_ns, stat_result.st_size)
+    cache_path = inventory_cache_path(path)
+    use_cache = use_cache and private_cache_dir()
+
+    if use_cache:
+        cached = read_inventory_cache(cache_path)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+    entries, errors = parse_inventory(path)
+
+    if use_cache:
+        data = {"key": key, "entries": entries, "errors": errors}
+        try:
+            # mkstemp creates a new 0600 file, it never follows a planted link
+            fd, tmp_path = tempfile.mkstemp(dir=INVENTORY_CACHE_DIR, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            logging.info(f"Could not write inventory cache {cache_path}")
+
+    return entries, errors
 
+
+def describe_invalid(errors):
+    """Summarize invalid inventory lines for the plugin output."""
+    details = ", ".join(
+        f"line {lineno} '{line}' ({reason})" for lineno, line, reason in errors
+    )
+    noun = "entry" if len(errors) == 1 else "entries"
+    return f"{len(errors)} invalid {noun}: {details}"
+
+
+def evaluate(servers, down_servers):
+    """Aggregate the probe results into a Nagios (exit code, output) pair."""
     total_servers = len(servers)
     down_count = len(down_servers)
 
     if down_count == 0:
-        print(f"OK - All {total_servers} servers are online")
-        sys.exit(NAGIOS_OK)
+        return NAGIOS_OK, f"OK - All {total_servers} servers are online"
     elif down_count == 1:
-        print(f"WARNING - 1 server is offline: {down_servers[0]}")
-        sys.exit(NAGIOS_WARNING)
+        return NAGIOS_WARNING, f"WARNING - 1 server is offline: {down_servers[0]}"
     elif down_count == total_servers:
-        print(f"CRITICAL - All servers are offline: {', '.join(down_servers)}")
-        sys.exit(NAGIOS_CRITICAL)
+        return (
+            NAGIOS_CRITICAL,
+            f"CRITICAL - All servers are offline: {', '.join(down_servers)}",
+        )
     else:
-        print(
-            f"WARNING - {down_count}/{total_servers} servers are offline: {', '.join(down_servers)}"
+        return (
+            NAGIOS_WARNING,
+            f"WARNING - {down_count}/{total_servers} servers are offline: {', '.join(down_servers)}",
+        )
+
+
+def response_time(result):
+    """Return the time thresholds are applied to.
+
+    This is the full HTTP request time in HTTP mode, else the TTFB if it was
+    measured, else the connect time.
+    """
+    for value in (result.http_time, result.ttfb, result.connect_time):
+        if value is not None:
+            return value
+    return None
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a non-empty list of values."""
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def evaluate_latency(results, warning=None, critical=None):
+    """Check response times of the online servers against the thresholds.
+
+    Returns a Nagios exit code and a short description of the slow servers.
+    """
+    timed = [r for r in results if r.up and response_time(r) is not None]
+    for code, threshold, name in (
+        (NAGIOS_CRITICAL, critical, "critical"),
+        (NAGIOS_WARNING, warning, "warning"),
+    ):
+        if threshold is None:
+            continue
+        slow = [r for r in timed if response_time(r) > threshold]
+        if slow:
+            details = ", ".join(f"{r.server} ({response_time(r):.3f}s)" for r in slow)
+            return code, f"{len(slow)} above {name} latency of {threshold}s: {details}"
+    return NAGIOS_OK, ""
+
+
+def format_perfdata(results, warning=None, critical=None, timeout=None):
+    """Build Nagios perfdata with per-server timings and min/avg/p95 aggregates."""
+    warn = "" if warning is None else warning
+    crit = "" if critical is None else critical
+    limit = "" if timeout is None else timeout
+
+    perfdata = []
+    for r in results:
+        value = "U" if r.connect_time is None else f"{r.connect_time:.6f}s"
+        perfdata.append(f"'{r.server}_connect'={value};{warn};{crit};0;{limit}")
+        if r.ttfb is not None:
+            perfdata.append(f"'{r.server}_ttfb'={r.ttfb:.6f}s;{warn};{crit};0;{limit}")
+        if r.http_time is not None:
+            perfdata.append(
+                f"'{r.server}_http'={r.http_time:.6f}s;{warn};{crit};0;{limit}"
+            )
+
+    times = [r.connect_time for r in results if r.connect_time is not None]
+    if times:
+        perfdata.append(f"'connect_min'={min(times):.6f}s;;;0;{limit}")
+        perfdata.append(f"'connect_avg'={sum(times) / len(times):.6f}s;;;0;{limit}")
+        perfdata.append(f"'connect_p95'={percentile(times, 95):.6f}s;;;0;{limit}")
+
+    down_count = sum(1 for r in results if not r.up)
+    perfdata.append(f"'down'={down_count};;;0;{len(results)}")
+    return " ".join(perfdata)
+
+
+class NagiosReturn(Exception):
+
+    def __init__(self, message, code):
+        self.message = message
+        self.code = code
+
+
+def load_targets(args):
+    """Return the (servers, errors) to probe, raising NagiosReturn if there are none."""
+    try:
+        servers, errors = load_inventory(args.file, use_cache=not args.no_cache)
+    except FileNotFoundError:
+        raise NagiosReturn(f"UNKNOWN - File {args.file} not found", NAGIOS_UNKNOWN)
+    return select_targets(args, servers, errors)
+
+
+def select_targets(args, servers, errors):
+    """Apply --tag to (servers, errors), raising NagiosReturn if none are left."""
+    if args.tag:
+        servers = [s for s in servers if set(args.tag) & set(s.tags)]
+
+    if not servers:
+        if errors:
+            message = f"UNKNOWN - No valid servers listed in {args.file}; {describe_invalid(errors)}"
+        elif args.tag:
+            message = (
+                f"UNKNOWN - No servers tagged {', '.join(args.tag)} in {args.file}"
+            )
+        else:
+            message = f"UNKNOWN - No servers listed in {args.file}"
+        raise NagiosReturn(message, NAGIOS_UNKNOWN)
+
+    return servers, errors
+
+
+def probe_deadline(args, servers):
+    """Return the overall deadline: the --deadline option or longest timeout + 1."""
+    if args.deadline is not None:
+        return args.deadline
+    return max(entry.timeout or args.timeout for entry in servers) + 1
+
+
+def build_verdict(args, servers, errors, results):
+    """Combine availability, latency and inventory errors into (code, output)."""
+    down_servers = [
+        f"{r.server} ({r.error})" if r.error else r.server for r in results if not r.up
+    ]
+
+    code, output = evaluate(servers, down_servers)
+    latency_code, latency_output = evaluate_latency(
+        results, args.warning, args.critical
+    )
+    if latency_code != NAGIOS_OK:
+        if latency_code > code:
+            code = latency_code
+            output = f"{STATUS_NAMES[code]} - {output.split(' - ', 1)[1]}"
+        output = f"{output}; {latency_output}"
+
+    if errors:
+        if code == NAGIOS_OK:
+            code = NAGIOS_WARNING
+            output = f"{STATUS_NAMES[code]} - {output.split(' - ', 1)[1]}"
+        output = f"{output}; {describe_invalid(errors)}"
+
+    perfdata = format_perfdata(results, args.warning, args.critical, args.timeout)
+    return code, f"{output} | {perfdata}"
+
+
+def backend_verdict(args, result):
+    """Return (code, output) for a single backend, used for passive results."""
+    if not result.up:
+        reason = f" ({result.error})" if result.error else ""
+        return NAGIOS_CRITICAL, f"CRITICAL - {result.server} is offline{reason}"
+
+    code, latency_output = evaluate_latency([result], args.warning, args.critical)
+    output = f"{STATUS_NAMES[code]} - {result.server} is online"
+    if latency_output:
+        output = f"{output}; {latency_output}"
+    perfdata = format_perfdata([result], args.warning, args.critical, args.timeout)
+    return code, f"{output} | {perfdata}"
+
+
+def passive_results(args, code, output, results):
+    """Build the external command lines for the aggregate and backend results."""
+    now = time.time()
+    lines = [
+        nagios_passive.format_service_result(
+            args.host_name, args.service, code, output, now
         )
-        sys.exit(NAGIOS_WARNING)
+    ]
+    if args.backend_service:
+        for result in results:
+            host = result.server.rpartition(":")[0]
+            backend_code, backend_output = backend_verdict(args, result)
+            lines.append(
+                nagios_passive.format_service_result(
+                    host, args.backend_service, backend_code, backend_output, now
+                )
+            )
+    return lines
+
+
+def run_serial(args):
+    """Probe the inventory one server at a time.
+
+    Returns (code, output, results).
+    """
+    servers, errors = load_targets(args)
+    results = []
+    for entry in servers:
+        entry_timeout = entry.timeout or args.timeout
+        logging.info(f"Checking {entry.server} with timeout {entry_timeout}")
+        if args.http:
+            results.append(check_http(entry.host, entry.port, entry_timeout))
+        else:
+            results.append(
+                check_server(entry.host, entry.port, entry_timeout, args.ttfb)
+            )
+    return (*build_verdict(args, servers, errors, results), results)
+
+
+async def probe_targets(args, pool=None):
+    """Probe the inventory concurrently and return (servers, errors, results)."""
+    servers, errors = load_targets(args)
+    results = await probe_servers(
+        servers,
+        args.timeout,
+        args.concurrency,
+        probe_deadline(args, servers),
+        ttfb=args.ttfb,
+        http=args.http,
+        pool=pool,
+    )
+    return servers, errors, results
+
+
+async def run_concurrent(args, pool=None):
+    """Probe the inventory concurrently and return (code, output, results)."""
+    servers, errors, results = await probe_targets(args, pool)
+    return (*build_verdict(args, servers, errors, results), results)
+
+
+def client_request(args):
+    """Return the options a --client asks the daemon to evaluate with."""
+    request = {name: getattr(args, name) for name in PROBE_OPTIONS}
+    request.update(
+        file=os.path.abspath(args.file),
+        tag=args.tag,
+        warning=args.warning,
+        critical=args.critical,
+    )
+    return request
+
+
+def answer_client(args, latest, request):
+    """Return the daemon's verdict on its latest round for a client's options.
+
+    Clients may pick their own --tag subset and -w/-c thresholds. A client
+    that probes differently, or asks for other tags than the daemon probes,
+    gets an ``error`` and probes by itself.
+    """
+    if not latest:
+        return {"error": "probe daemon has no result yet"}
+    ours = client_request(args)
+    for name in PROBE_OPTIONS:
+        if request.get(name) != ours[name]:
+            return {"error": f"probe daemon runs with --{name} {ours[name]}"}
+    if args.tag and request.get("tag") != args.tag:
+        return {"error": f"probe daemon only probes tags {', '.join(args.tag)}"}
+
+    view = argparse.Namespace(**vars(args))
+    view.tag = request.get("tag") or []
+    view.warning = request.get("warning")
+    view.critical = request.get("critical")
+    try:
+        if latest["servers"] is None:
+            raise NagiosReturn(latest["output"], latest["code"])
+        servers, errors = select_targets(view, latest["servers"], latest["errors"])
+        names = {entry.server for entry in servers}
+        results = [r for r in latest["results"] if r.server in names]
+        code, output = build_verdict(view, servers, errors, results)
+    except NagiosReturn as e:
+        code, output = e.code, e.message
+    return {"code": code, "output": output, "time": latest["time"]}
+
+
+async def run_daemon(args):
+    """Probe the inventory every --interval seconds and serve the latest verdict.
+
+    Each connection to the Unix socket sends a line with the client's
+    options as JSON, see client_request(). It receives the verdict of the
+    latest round for those options as a JSON object with ``code``,
+    ``output`` and ``time`` keys, or with an ``error``, then is closed.
+    """
+    latest = {}
+    pool = ConnectionPool() if args.http else None
+
+    async def handle_client(reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT)
+            reply = answer_client(args, latest, json.loads(line))
+        except (asyncio.TimeoutError, ValueError) as e:
+            reply = {"error": f"bad request: {e}"}
+        writer.write(json.dumps(reply).encode())
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = await asyncio.start_unix_server(handle_client, path=args.socket)
+    logging.info(f"Serving probe results on {args.socket}")
+
+    async with server:
+        while True:
+            started = time.monotonic()
+            try:
+                servers, errors, results = await probe_targets(args, pool)
+                code, output = build_verdict(args, servers, errors, results)
+            except NagiosReturn as e:
+                servers, errors, results = None, [], []
+                code, output = e.code, e.message
+            latest.update(
+                code=code,
+                output=output,
+                time=time.time(),
+                servers=servers,
+                errors=errors,
+                results=results,
+            )
+            logging.info(f"Probe round finished: {output}")
+            if args.passive:
+                lines = passive_results(args, code, output, results)
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, nagios_passive.submit_results, lines, args.command_file
+                    )
+                except OSError as e:
+                    logging.error(f"Could not submit passive results: {e}")
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(args.interval - elapsed, 0))
+
+
+def read_daemon(path, max_age, request):
+    """Fetch the daemon's verdict for the request, raising if it is unusable."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CLIENT_TIMEOUT)
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    if not chunks:
+        raise ValueError("probe daemon sent no reply")
+    verdict = json.loads(b"".join(chunks))
+    if "error" in verdict:
+        raise ValueError(verdict["error"])
+    age = time.time() - verdict["time"]
+    if age > max_age:
+        raise ValueError(f"probe daemon result is {age:.0f}s old")
+    return verdict["code"], verdict["output"]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.daemon:
+        asyncio.run(run_daemon(args))
+        return
+
+    if args.client:
+        try:
+            code, output = read_daemon(args.socket, args.max_age, client_request(args))
+        except (OSError, ValueError, KeyError) as e:
+            logging.info(f"Probing directly, daemon unavailable: {e}")
+        else:
+            print(output)
+            sys.exit(code)
+
+    try:
+        if args.serial:
+            code, output, results = run_serial(args)
+        else:
+            code, output, results = asyncio.run(run_concurrent(args))
+    except NagiosReturn as e:
+        code, output, results = e.code, e.message, []
+
+    if args.passive:
+        lines = passive_results(args, code, output, results)
+        try:
+            nagios_passive.submit_results(lines, args.command_file)
+        except OSError as e:
+            print(
+                f"UNKNOWN - Could not submit passive results to {args.command_file}: {e}"
+            )
+            sys.exit(NAGIOS_UNKNOWN)
+        logging.info(f"Submitted {len(lines)} passive results to {args.command_file}")
+
+    print(output)
+    sys.exit(code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+"""Per-second rates of cumulative counters, shared by the libexec plugins.
+
+Every counter keeps a small ring buffer of its most recent (time, value)
+samples and an exponentially weighted moving average (EWMA) of its rate.
+All counters live in one SQLite file, each as a single packed row. This
+makes the state compact, and concurrent checks serialize on SQLite's write
+lock. Keys are stable digests, so rates survive interpreter restarts.
+
+A counter that goes backwards was reset (e.g. the server restarted): there
+is no rate for that interval, and the ring starts again from the new sample.
+Only for a counter given a width in bits is a drop near that limit taken
+as a wrap around it, and counted forward.
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import stat
+import struct
+from collections import namedtuple
+
+STATE_FILE = "/opt/nagios/var/libexec_counter_rates.sqlite"
+RING_SIZE = 8  # Samples kept per counter
+DEFAULT_ALPHA = 0.3  # Weight of the newest rate in the EWMA
+LOCK_TIMEOUT = 10  # Seconds to wait for another check holding the write lock
+
+# Rates of a counter after a sample. ``rate`` is the rate since the previous
+# sample, ``smoothed`` the EWMA of those rates and ``window`` the average rate
+# across the ring. Each is None until there are enough samples.
+Rate = namedtuple("Rate", ["rate", "smoothed", "window"])
+
+# A packed counter: the EWMA (NaN for none), then the ring of samples
+HEADER = struct.Struct("<d")
+SAMPLE = struct.Struct("<dd")
+
+
+def counter_key(*parts):
+    """Return the key of a counter, the same in every interpreter run."""
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def pack(smoothed, samples):
+    header = HEADER.pack(float("nan") if smoothed is None else smoothed)
+    return header + b"".join(SAMPLE.pack(t, v) for t, v in samples)
+
+
+def unpack(data):
+    (smoothed,) = HEADER.unpack_from(data)
+    samples = [
+        SAMPLE.unpack_from(data, offset)
+        for offset in range(HEADER.size, len(data), SAMPLE.size)
+    ]
+    return (None if math.isnan(smoothed) else smoothed), samples
+
+
+def increase(old, new, bits=None):
+    """Return how much a counter grew from old to new, or None on a reset.
+
+    A counter of bits width may have wrapped around 2**bits instead.
+    """
+    if new >= old:
+        return new - old
+    if bits is not None:
+        limit = 2**bits
+        # Only a counter near its limit wraps, a large drop is a reset
+        if old < limit and limit - old + new < limit / 2:
+            return limit - old + new
+    return None
+
+
+def rate_between(first, second, bits=None):
+    """Return the rate from one (time, value) sample to the next, or None."""
+    elapsed = second[0] - first[0]
+    grown = increase(first[1], second[1], bits)
+    if elapsed <= 0 or grown is None:
+        return None
+    return grown / elapsed
+
+
+def window_rate(samples, bits=None):
+    """Return the average rate across the samples, or None with fewer than two."""
+    grown = 0.0
+    for first, second in zip(samples, samples[1:]):
+        step = increase(first[1], second[1], bits)
+        if step is None:
+            return None
+        grown += step
+    elapsed = samples[-1][0] - samples[0][0] if samples else 0
+    if elapsed <= 0:
+        return None
+    return grown / elapsed
+
+
+class RateStore(object):
+    """The ring buffers and smoothed rates of every counter."""
+
+    def __init__(
+        self, path=None, ring_size=RING_SIZE, alpha=DEFAULT_ALPHA, timeout=LOCK_TIMEOUT
+    ):
+        self.path = path or STATE_FILE
+        self.ring_size = ring_size
+        self.alpha = alpha
+        self.timeout = timeout
+
+    def check_private(self):
+        """Create the state file if needed and check that only we can use it.
+
+        Another user able to write the samples could forge the rates that
+        the plugins alert on, so the file must be ours and mode 0600.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0)
+        fd = os.open(self.path, flags, 0o600)
+        try:
+            st = os.fstat(fd)
+        finally:
+            os.close(fd)
+        if (
+            not stat.S_ISREG(st.st_mode)
+            or st.st_uid != os.geteuid()
+            or stat.S_IMODE(st.st_mode) != 0o600
+        ):
+            raise OSError("%s must be a file of ours with mode 0600" % self.path)
+
+    def update(self, key, value, now, bits=None):
+        """Add the (now, value) sample of key and return its Rate.
+
+        The read and the write happen under one write lock, so concurrent
+        checks of a counter each build on the samples stored before theirs.
+        A sample no newer than the last one is ignored. bits is the width of
+        a counter that wraps around, None for one that only resets.
+        """
+        self.check_private()
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None
+        )
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, state BLOB)"
+            )
+            row = connection.execute(
+                "SELECT state FROM counters WHERE key = ?", (key,)
+            ).fetchone()
+            smoothed, samples = unpack(row[0]) if row else (None, [])
+
+            rate = None
+            sample = (float(now), float(value))
+            if samples and sample[0] <= samples[-1][0]:
+                connection.execute("ROLLBACK")
+                return Rate(None, smoothed, window_rate(samples, bits))
+            if samples:
+                rate = rate_between(samples[-1], sample, bits)
+                if rate is None:
+                    # Reset, the older samples no longer count up to this one
+                    samples = []
+                elif smoothed is None:
+                    smoothed = rate
+                else:
+                    smoothed = self.alpha * rate + (1 - self.alpha) * smoothed
+            samples = (samples + [sample])[-self.ring_size :]
+
+            connection.execute(
+                "INSERT OR REPLACE INTO counters (key, state) VALUES (?, ?)",
+                (key, pack(smoothed, samples)),
+            )
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return Rate(rate, smoothed, window_rate(samples, bits))
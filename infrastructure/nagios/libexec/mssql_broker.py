@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""Connection broker for the MSSQL plugins.
+
+Run as a daemon, the broker keeps a bounded pool of logged-in pymssql
+connections per host, user and database, and runs the plugins' queries on
+them over a Unix socket. A plugin started with ``--broker SOCKET`` then
+skips the TDS login on every check. Idle connections are health-checked
+before reuse and closed once they have been idle or alive for too long.
+
+Each client connection is one session, speaking newline-delimited JSON:
+
+    -> {"host": ..., "user": ..., "password": ..., "database": ..., "fresh": false}
+    <- {"time2connect": 0.12, "reused": true}
+    -> {"query": "SELECT ..."}
+    <- {"rows": [[...], ...]}
+
+An error is answered as ``{"error": message, "type": exception name}``. A
+session with ``"fresh": true`` always gets a new login, timed by the broker,
+so the time2connect mode still measures a real connect.
+"""
+
+import argparse
+import decimal
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+BROKER_SOCKET = "/opt/nagios/var/rw/mssql_broker.sock"
+DEFAULT_POOL_SIZE = 4  # Connections per host, user and database
+DEFAULT_WAIT = 10  # Seconds a session waits for a connection from a full pool
+DEFAULT_CHECK_AFTER = 30  # Idle seconds after which a connection is checked
+DEFAULT_IDLE_TIMEOUT = 300  # Idle seconds after which a connection is closed
+DEFAULT_MAX_LIFETIME = 3600  # Seconds after which a connection is replaced
+REAP_INTERVAL = 10  # Seconds between sweeps for idle and old connections
+CLIENT_TIMEOUT = 60  # Seconds the client waits for a broker response
+
+# pymssql errors that leave a connection unusable
+CONNECTION_ERRORS = ("OperationalError", "InterfaceError")
+
+
+class PoolTimeoutError(OSError):
+    """No pooled connection became free within the wait time.
+
+    An OSError, so a plugin told this by the broker logs in by itself.
+    """
+
+
+class PooledConnection(object):
+    """A logged-in connection and when it was made and last used."""
+
+    def __init__(self, connection, time2connect):
+        self.connection = connection
+        self.time2connect = time2connect
+        self.created = self.last_used = time.monotonic()
+
+
+class Pool(object):
+    """A bounded pool of connections made by one connect() callable."""
+
+    def __init__(
+        self,
+        connect,
+        size=DEFAULT_POOL_SIZE,
+        check_after=DEFAULT_CHECK_AFTER,
+        max_lifetime=DEFAULT_MAX_LIFETIME,
+    ):
+        self.connect = connect
+        self.size = size
+        self.check_after = check_after
+        self.max_lifetime = max_lifetime
+        self.idle = []
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, fresh=False, wait=DEFAULT_WAIT):
+        """Return (pooled, reused), logging in when no idle connection fits.
+
+        ``fresh`` skips the idle connections, closing one if the pool is full.
+        Raises PoolTimeoutError if every connection stays in use for ``wait``.
+        """
+        deadline = time.monotonic() + wait
+        pooled = None
+        with self.condition:
+            while True:
+                if self.idle and not fresh:
+                    pooled = self.idle.pop()
+                    break
+                if self.in_use + len(self.idle) < self.size:
+                    break
+                if self.idle:
+                    # Make room for a fresh login with the oldest idle one
+                    self.close(self.idle.pop(0))
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(
+                        f"all {self.size} pooled connections stayed in use for {wait}s"
+                    )
+                self.condition.wait(remaining)
+            self.in_use += 1
+
+        try:
+            if pooled is not None and not self.healthy(pooled):
+                self.close(pooled)
+                pooled = None
+            if pooled is not None:
+                return pooled, True
+            return self.login(), False
+        except BaseException:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+
+    def login(self):
+        start = time.monotonic()
+        connection = self.connect()
+        return PooledConnection(connection, time.monotonic() - start)
+
+    def healthy(self, pooled):
+        """Check an idle connection before it is handed out again."""
+        now = time.monotonic()
+        if now - pooled.created >= self.max_lifetime:
+            return False
+        if now - pooled.last_used < self.check_after:
+            return True
+        try:
+            cursor = pooled.connection.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+        except Exception as e:
+            logging.info(f"Discarding pooled connection that failed a check: {e}")
+            return False
+        return True
+
+    def release(self, pooled, broken=False):
+        with self.condition:
+            self.in_use -= 1
+            if broken:
+                self.close(pooled)
+            else:
+                pooled.last_used = time.monotonic()
+                self.idle.append(pooled)
+            self.condition.notify()
+
+    def reap(self, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """Close idle connections past the idle timeout or their lifetime."""
+        now = time.monotonic()
+        with self.condition:
+            expired = [
+                pooled
+                for pooled in self.idle
+                if now - pooled.last_used >= idle_timeout
+                or now - pooled.created >= self.max_lifetime
+            ]
+            self.idle = [pooled for pooled in self.idle if pooled not in expired]
+            if expired:
+                self.condition.notify_all()
+        for pooled in expired:
+            self.close(pooled)
+        return len(expired)
+
+    def close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+
+class Broker(object):
+    """The pools of every host, user and database the plugins connect to."""
+
+    def __init__(self, connect=None, size=DEFAULT_POOL_SIZE, **pool_options):
+        self.connect = connect or pymssql_connect
+        self.size = size
+        self.pool_options = pool_options
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool(self, host, user, password, database):
+        # The password is part of the key so a session can only borrow
+        # connections logged in with the credentials it presented
+        digest = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        key = (host, user, digest, database)
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = Pool(
+                    lambda: self.connect(
+                        host=host, user=user, password=password, database=database
+                    ),
+                    self.size,
+                    **self.pool_options,
+                )
+            return self.pools[key]
+
+    def reap(self, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        with self.lock:
+            pools = list(self.pools.values())
+        return sum(pool.reap(idle_timeout) for pool in pools)
+
+
+def pymssql_connect(**kwargs):
+    import pymssql
+
+    return pymssql.connect(**kwargs)
+
+
+def to_json(value):
+    """Encode the column types pymssql returns that JSON does not know."""
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def send_message(wfile, message):
+    wfile.write(json.dumps(message, default=to_json).encode() + b"\n")
+    wfile.flush()
+
+
+def receive_message(rfile):
+    line = rfile.readline()
+    if not line:
+        raise EOFError("connection closed")
+    return json.loads(line)
+
+
+def error_message(e):
+    return {"error": str(e), "type": type(e).__name__}
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """Serve one plugin session on a connection checked out of its pool."""
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            request = receive_message(self.rfile)
+            pool = broker.pool(
+                request["host"],
+                request["user"],
+                request["password"],
+                request.get("database", "master"),
+            )
+            pooled, reused = pool.acquire(request.get("fresh", False), self.server.wait)
+        except EOFError:
+            return
+        except Exception as e:
+            send_message(self.wfile, error_message(e))
+            return
+
+        broken = False
+        try:
+            send_message(
+                self.wfile, {"time2connect": pooled.time2connect, "reused": reused}
+            )
+            while not broken:
+                try:
+                    query = receive_message(self.rfile)["query"]
+                except EOFError:
+                    break
+                try:
+                    cursor = pooled.connection.cursor()
+                    cursor.execute(query)
+                    rows = [list(row) for row in cursor.fetchall()]
+                except Exception as e:
+                    broken = type(e).__name__ in CONNECTION_ERRORS
+                    send_message(self.wfile, error_message(e))
+                else:
+                    send_message(self.wfile, {"rows": rows})
+        except (OSError, ValueError, KeyError):
+            # The plugin went away mid-session, its connection is still fine
+            pass
+        finally:
+            pool.release(pooled, broken)
+
+
+class BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, broker, wait=DEFAULT_WAIT):
+        self.broker = broker
+        self.wait = wait
+        if os.path.exists(path):
+            os.unlink(path)
+        # The socket hands out logged-in connections, keep it to our user
+        umask = os.umask(0o177)
+        try:
+            socketserver.ThreadingUnixStreamServer.__init__(self, path, BrokerHandler)
+        finally:
+            os.umask(umask)
+
+
+class BrokerConnection(object):
+    """A pymssql-like connection whose queries run on a brokered connection.
+
+    Connecting raises OSError if the broker is not running, so callers can
+    fall back to logging in themselves.
+    """
+
+    def __init__(
+        self,
+        path,
+        host,
+        user,
+        password,
+        database,
+        fresh=False,
+        timeout=CLIENT_TIMEOUT,
+    ):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+            self.file = self.sock.makefile("rwb")
+            response = self.request(
+                {
+                    "host": host,
+                    "user": user,
+                    "password": password,
+                    "database": database,
+                    "fresh": fresh,
+                }
+            )
+        except BaseException:
+            self.sock.close()
+            raise
+        self.time2connect = response["time2connect"]
+        self.reused = response["reused"]
+
+    def request(self, message):
+        try:
+            send_message(self.file, message)
+            response = receive_message(self.file)
+        except EOFError as e:
+            raise OSError(f"broker closed the session: {e}")
+        if "error" in response:
+            raise broker_error(response)
+        return response
+
+    def execute(self, query):
+        return self.request({"query": query})["rows"]
+
+    def cursor(self):
+        return BrokerCursor(self)
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.sock.close()
+
+
+class BrokerCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query):
+        self.rows = self.connection.execute(query)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+def broker_error(response):
+    """Rebuild an error from the broker as the pymssql exception it was."""
+    if response.get("type") == PoolTimeoutError.__name__:
+        return PoolTimeoutError(response["error"])
+    try:
+        import pymssql
+
+        error_class = getattr(pymssql, response.get("type", ""), Exception)
+    except ImportError:
+        error_class = Exception
+    if not (isinstance(error_class, type) and issubclass(error_class, Exception)):
+        error_class = Exception
+    return error_class(response["error"])
+
+
+def reap_forever(broker, idle_timeout, interval=REAP_INTERVAL):
+    while True:
+        time.sleep(interval)
+        closed = broker.reap(idle_timeout)
+        if closed:
+            logging.info(f"Closed {closed} idle pooled connections")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve pooled SQL Server connections to the MSSQL plugins."
+    )
+    parser.add_argument(
+        "--socket",
+        default=BROKER_SOCKET,
+        help="Unix socket to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help="Connections kept per host, user and database (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--wait",
+        type=float,
+        default=DEFAULT_WAIT,
+        help="Seconds a check waits for a connection from a full pool "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--check-after",
+        type=float,
+        default=DEFAULT_CHECK_AFTER,
+        help="Run SELECT 1 on connections idle this many seconds before reuse "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help="Close connections idle this many seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-lifetime",
+        type=float,
+        default=DEFAULT_MAX_LIFETIME,
+        help="Replace connections older than this many seconds "
+        "(default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    broker = Broker(
+        size=args.pool_size,
+        check_after=args.check_after,
+        max_lifetime=args.max_lifetime,
+    )
+    reaper = threading.Thread(
+        target=reap_forever, args=(broker, args.idle_timeout), daemon=True
+    )
+    reaper.start()
+    with BrokerServer(args.socket, broker, args.wait) as server:
+        logging.info(f"Serving pooled connections on {args.socket}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""Submit passive check results to the Nagios external command file.
+
+Shared by the plugins' batch modes, which run many checks in one process and
+hand every result to Nagios as a PROCESS_SERVICE_CHECK_RESULT command instead
+of Nagios forking one plugin per service.
+"""
+
+import os
+import stat
+import time
+
+# Must match command_file in nagios.cfg
+COMMAND_FILE = "/opt/nagios/var/rw/nagios.cmd"
+DEFAULT_PIPE_BUF = 4096
+
+
+def format_service_result(host, service, code, output, timestamp=None):
+    """Return one PROCESS_SERVICE_CHECK_RESULT external command line."""
+    if timestamp is None:
+        timestamp = time.time()
+    # Nagios reads one command per line, multi-line output must be escaped
+    output = output.rstrip("\n").replace("\n", "\\n")
+    return (
+        f"[{int(timestamp)}] PROCESS_SERVICE_CHECK_RESULT;"
+        f"{host};{service};{code};{output}\n"
+    )
+
+
+def pack_lines(lines, limit):
+    """Group command lines into chunks of at most ``limit`` bytes.
+
+    Writes to a FIFO of up to PIPE_BUF bytes are atomic, so chunking on line
+    boundaries keeps commands from concurrent writers from interleaving. A
+    single line longer than ``limit`` is sent on its own.
+    """
+    chunk = b""
+    for line in lines:
+        data = line.encode("utf-8")
+        if chunk and len(chunk) + len(data) > limit:
+            yield chunk
+            chunk = b""
+        chunk += data
+    if chunk:
+        yield chunk
+
+
+def submit_results(lines, command_file=COMMAND_FILE):
+    """Write external command lines to the Nagios command file in bulk.
+
+    Opening the FIFO is non-blocking so a stopped Nagios raises OSError
+    (ENXIO) instead of hanging the caller. Returns the number of lines sent.
+    """
+    lines = list(lines)
+    if not lines:
+        return 0
+
+    fd = os.open(command_file, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+    try:
+        os.set_blocking(fd, True)
+        limit = DEFAULT_PIPE_BUF
+        if stat.S_ISFIFO(os.fstat(fd).st_mode):
+            try:
+                limit = os.fpathconf(fd, "PC_PIPE_BUF")
+            except (OSError, ValueError):
+                pass
+        for chunk in pack_lines(lines, limit):
+            while chunk:
+                chunk = chunk[os.write(fd, chunk) :]
+    finally:
+        os.close(fd)
+
+    return len(lines)
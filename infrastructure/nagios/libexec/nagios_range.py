@@ -0,0 +1,76 @@
+"""Evaluate Nagios threshold ranges such as ``10``, ``10:``, ``~:10`` or ``@10:20``.
+
+Shared by the MSSQL plugins, which evaluate the warning and critical ranges
+of every result. Each threshold string is parsed once into a NagiosRange and
+kept in an LRU cache, so batch and sweep runs that evaluate thousands of
+values do not parse the same string again.
+
+The grammar follows the Nagios plugin guidelines: ``[@]start:end`` alerts
+when the value is outside start..end (inclusive), or inside it with ``@``.
+An omitted ``start:`` means 0, ``~`` as start means negative infinity and
+an omitted end means positive infinity.
+"""
+
+import re
+from functools import lru_cache
+
+RANGE_CACHE_SIZE = 256
+
+NUMBER = r"[-+]?[0-9]+(?:\.[0-9]+)?"
+RANGE = re.compile(
+    r"^(?P<inside>@)?(?:(?P<start>~|%s):)?(?P<end>%s)?$" % (NUMBER, NUMBER)
+)
+
+
+class NagiosRange(object):
+    """A parsed threshold range."""
+
+    __slots__ = ("start", "end", "inside")
+
+    def __init__(self, start, end, inside=False):
+        self.start = start
+        self.end = end
+        self.inside = inside
+
+    def alert(self, value):
+        """Return True if value should raise this threshold's alert."""
+        within = self.start <= value <= self.end
+        return within if self.inside else not within
+
+    def __repr__(self):
+        return "NagiosRange(%r, %r, inside=%r)" % (self.start, self.end, self.inside)
+
+
+@lru_cache(maxsize=RANGE_CACHE_SIZE)
+def parse_range(text):
+    """Parse a threshold string, raising ValueError if it is not a range."""
+    match = RANGE.match(text)
+    if match is None or (match.group("start") is None and match.group("end") is None):
+        raise ValueError("Improper warning/critical format.")
+
+    start = match.group("start")
+    if start is None:
+        start = 0.0
+    elif start == "~":
+        start = float("-inf")
+    else:
+        start = float(start)
+
+    end = match.group("end")
+    end = float("inf") if end is None else float(end)
+
+    if start > end:
+        raise ValueError("Improper warning/critical format.")
+    return NagiosRange(start, end, bool(match.group("inside")))
+
+
+def is_within_range(nagstring, value, invert=False):
+    """Return True if value raises the alert of the threshold nagstring.
+
+    An empty threshold never alerts. invert flips the result, for callers
+    that treat a lower critical than warning threshold as inverted.
+    """
+    if not nagstring:
+        return False
+    alert = parse_range(nagstring).alert(value)
+    return not alert if invert else alert
@@ -0,0 +1,196 @@
+import importlib.util
+import json
+import shutil
+import signal
+import ssl
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from ..web_server import app as web_app
+
+LIBEXEC_DIR = Path(__file__).resolve().parent.parent / "nagios" / "libexec"
+
+
+MSSQL_LOGIN = ["-H", "sql-01", "-U", "nagios", "-P", "secret"]
+
+
+def run_mssql_plugin(plugin, monkeypatch, *args):
+    """Run an MSSQL plugin's main() and return the (message, code) it raises."""
+    monkeypatch.setattr("sys.argv", ["check_mssql_server.py", *args])
+    with pytest.raises(plugin.NagiosReturn) as excinfo:
+        plugin.main()
+    return excinfo.value.message, excinfo.value.code
+
+
+def run_ncpa_plugin(plugin, monkeypatch, *args):
+    """Run check_ncpa.py's main() with the given command line."""
+    monkeypatch.setattr("sys.argv", ["check_ncpa.py", *args])
+    try:
+        return plugin.main()
+    finally:
+        # main() arms SIGALRM for its --timeout, disarm it for the test run
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+
+@pytest.fixture(autouse=True)
+def metrics_dir(tmp_path, monkeypatch):
+    """Fixture to keep the web server's histograms and load in tmp_path."""
+    directory = str(tmp_path / "metrics")
+    monkeypatch.setenv("METRICS_DIR", directory)
+    monkeypatch.setattr(web_app, "metrics_dir", directory)
+    monkeypatch.setattr(web_app.request_stats.histograms, "directory", directory)
+    monkeypatch.setattr(web_app.request_stats.histograms, "counts", None)
+    monkeypatch.setattr(web_app.request_stats.load, "directory", directory)
+    monkeypatch.setattr(web_app.request_stats.load, "values", None)
+    return directory
+
+
+@pytest.fixture
+def load_plugin(monkeypatch):
+    """Fixture to import a Nagios plugin script from libexec as a module."""
+    # Plugins import their shared helpers from libexec, as when Nagios runs them
+    monkeypatch.syspath_prepend(str(LIBEXEC_DIR))
+
+    def _load(filename):
+        path = LIBEXEC_DIR / filename
+        name = path.stem.replace("-", "_")
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return _load
+
+
+class FakeCursor:
+    """Answer queries from a FakeConnection's canned results."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query):
+        self.connection.queries.append(query)
+        for fragment, rows in self.connection.results.items():
+            if fragment in query:
+                self.rows = rows
+                return
+        raise Exception(f"no result for {query}")
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    """Stand in for a pymssql connection to a SQL Server instance."""
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def mssql_broker(load_plugin, tmp_path):
+    """Fixture to run an mssql_broker whose logins open FakeConnections.
+
+    Yields the socket path, for plugins run in a separate process.
+    """
+    broker = load_plugin("mssql_broker.py")
+    results = {"sys.sysprocesses": [(42,)], "instance_name='sales'": [(88,)]}
+
+    def connect(**kwargs):
+        return FakeConnection(results)
+
+    path = str(tmp_path / "broker.sock")
+    server = broker.BrokerServer(path, broker.Broker(connect, size=2), wait=0.5)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+class FakeNCPAHandler(BaseHTTPRequestHandler):
+    """Answer NCPA API checks over persistent HTTP/1.1 connections."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        self.server.resumed.append(self.request.session_reused)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(url.path)
+        if "missing" in url.path:
+            status, payload = 404, {"error": "not found"}
+        else:
+            returncode = 2 if query.get("critical") == ["1"] else 0
+            status = 200
+            payload = {"returncode": returncode, "stdout": f"CHECKED {url.path}"}
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.close_connections:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    """Fixture to provide a throwaway self-signed certificate and key."""
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is required to generate a test certificate")
+    directory = tmp_path_factory.mktemp("ncpa-cert")
+    cert, key = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=localhost", "-keyout", str(key), "-out", str(cert)],
+        check=True,
+        capture_output=True,
+    )
+    return str(cert), str(key)
+
+
+@pytest.fixture
+def ncpa_server(certificate):
+    """Fixture to serve FakeNCPAHandler over TLS on a localhost port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeNCPAHandler)
+    server.connections = 0
+    server.requests = []
+    server.resumed = []
+    server.close_connections = False
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
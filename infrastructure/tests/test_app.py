@@ -1,6 +1,18 @@
+import multiprocessing
+import os
+import time
+
 import pytest
 
-from ..web_server.app import app
+from ..web_server.app import (
+    LatencyHistograms,
+    RequestStats,
+    WorkerLoad,
+    app,
+    queue_wait,
+    render_index,
+    request_stats,
+)
 
 
 @pytest.fixture
@@ -21,3 +33,194 @@ def test_status_route(client):
     """Test the /status route for correct JSON response."""
     response = client.get("/status")
     assert response.status_code == 200
+
+
+def test_index_shows_visitor_ip(client):
+    """Test that the cached page is filled in with each visitor's IP."""
+    first = client.get("/", environ_base={"REMOTE_ADDR": "10.0.0.7"})
+    second = client.get("/", environ_base={"REMOTE_ADDR": "10.0.0.8"})
+    assert b"Your IP: <strong>10.0.0.7</strong>" in first.data
+    assert b"Your IP: <strong>10.0.0.8</strong>" in second.data
+    assert first.headers["ETag"] != second.headers["ETag"]
+
+
+def test_index_renders_once(client):
+    """Test that the template is rendered once for every request after it."""
+    render_index.cache_clear()
+    for _ in range(3):
+        assert client.get("/").status_code == 200
+    assert render_index.cache_info().misses == 1
+
+
+def test_index_not_modified(client):
+    """Test that a matching If-None-Match gets a 304 without a body."""
+    response = client.get("/")
+    assert response.headers["Cache-Control"] == "private, max-age=0"
+    etag = response.headers["ETag"]
+    cached = client.get("/", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert cached.headers["ETag"] == etag
+    stale = client.get("/", headers={"If-None-Match": '"other"'})
+    assert stale.status_code == 200
+
+
+def test_status_skips_flask(client, monkeypatch):
+    """Test that GET and HEAD /status are answered without the Flask view."""
+
+    def fail():
+        raise AssertionError("Flask handled /status")
+
+    monkeypatch.setitem(app.view_functions, "status", fail)
+    response = client.get("/status")
+    assert response.get_json() == {"status": "ok"}
+    assert response.headers["Content-Length"] == str(len(response.data))
+    assert client.head("/status").data == b""
+    assert client.post("/status").status_code == 405
+
+
+def test_status_deep_reports_worker(client):
+    """Test that /status/deep reports the requests the worker handled."""
+    request_stats.cached = None
+    client.get("/")
+    response = client.get("/status/deep")
+    report = response.get_json()
+    assert response.status_code == 200
+    assert report["status"] == "ok"
+    assert report["in_flight"] == 0
+    assert report["handled"] >= 1
+    assert report["workers"] == 1
+    assert report["p99_ms"] > 0
+
+
+def test_status_deep_is_cached(client, monkeypatch):
+    """Test that the report is reused until its TTL runs out."""
+    monkeypatch.setattr("infrastructure.web_server.app.deep_status_ttl", 60)
+    request_stats.cached = None
+    first = client.get("/status/deep").get_json()
+    client.get("/")
+    assert client.get("/status/deep").get_json() == first
+    request_stats.expires = 0
+    assert client.get("/status/deep").get_json()["handled"] > first["handled"]
+
+
+def test_status_deep_saturated(client, monkeypatch):
+    """Test that a slow worker answers 503 so HAProxy takes it out."""
+    monkeypatch.setattr("infrastructure.web_server.app.max_p99_ms", 0)
+    request_stats.cached = None
+    client.get("/")
+    response = client.get("/status/deep")
+    assert response.status_code == 503
+    assert response.get_json()["status"] == "saturated"
+    request_stats.cached = None
+
+
+def test_status_deep_recovers_when_idle(tmp_path, monkeypatch):
+    """Test that a slow request stops counting once it leaves the window."""
+    monkeypatch.setattr("infrastructure.web_server.app.deep_status_window", 0.3)
+    monkeypatch.setattr("infrastructure.web_server.app.max_p99_ms", 50)
+
+    def slow_app(environ, start_response):
+        time.sleep(0.1)
+        start_response("200 OK", [])
+        return [b""]
+
+    stats = RequestStats(slow_app, WorkerLoad(str(tmp_path)))
+    stats({"PATH_INFO": "/"}, lambda status, headers: None)
+    assert stats.report(0)[0] == 503
+    # Held out by HAProxy, the worker sees no requests but the health checks
+    time.sleep(0.35)
+    code, body = stats.report(0)
+    assert code == 200
+    assert '"p99_ms":null' in body
+
+
+def test_status_deep_adds_up_workers(tmp_path, monkeypatch):
+    """Test that any worker reports the requests of every worker."""
+    monkeypatch.setattr("infrastructure.web_server.app.max_p99_ms", 50)
+    load = WorkerLoad(str(tmp_path), threads=2)
+    stats = RequestStats(None, load)
+    worker = multiprocessing.get_context("fork").Process(
+        target=load.finish, args=(load.start(None), 0.1)
+    )
+    worker.start()
+    worker.join()
+    code, body = stats.report(0)
+    assert code == 503
+    assert '"workers":2,"threads":4,"in_flight":1,"handled":1' in body
+
+
+def test_status_deep_spreads_long_requests(tmp_path, monkeypatch):
+    """Test that a long request's busy time is spread over its slots."""
+    monkeypatch.setattr("infrastructure.web_server.app.deep_status_window", 1.2)
+    load = WorkerLoad(str(tmp_path), slots=12)
+    load.finish(load.start(None), 0.5)
+    busy = load.values[load.stride - 1 : load.header : load.stride].tolist()
+    assert sum(busy) == pytest.approx(0.5)
+    # Epoch seconds leave a few microseconds of rounding in each slot
+    assert max(busy) == pytest.approx(0.1, abs=1e-5)
+    assert load.collect()["utilization"] < 1
+
+
+def test_queue_wait():
+    """Test reading HAProxy's X-Request-Start stamp."""
+    environ = {"HTTP_X_REQUEST_START": "t=1700000000000000"}
+    assert queue_wait(environ, 1700000000.25) == 0.25
+    assert queue_wait({}, 1700000000.25) is None
+    assert queue_wait({"HTTP_X_REQUEST_START": "t=soon"}, 0) is None
+
+
+@pytest.fixture
+def histograms(tmp_path, monkeypatch):
+    """Fixture to record the app's latencies in a fresh metrics directory."""
+    histograms = LatencyHistograms(
+        {rule.rule for rule in app.url_map.iter_rules()}, str(tmp_path)
+    )
+    monkeypatch.setattr(request_stats, "histograms", histograms)
+    return histograms
+
+
+def test_metrics_by_route(client, histograms):
+    """Test that /metrics counts requests under the route they matched."""
+    client.get("/")
+    client.get("/")
+    client.get("/missing")
+    lines = client.get("/metrics").data.decode().splitlines()
+    assert 'http_request_duration_seconds_count{route="/"} 2' in lines
+    assert 'http_request_duration_seconds_count{route="unmatched"} 1' in lines
+    assert 'http_request_duration_seconds_bucket{route="/",le="+Inf"} 2' in lines
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+
+
+def test_metrics_adds_up_workers(histograms):
+    """Test that the histograms of forked workers are added together."""
+    histograms.observe("/", 0.2)
+    worker = multiprocessing.get_context("fork").Process(
+        target=histograms.observe, args=("/", 0.003)
+    )
+    worker.start()
+    worker.join()
+    lines = histograms.export().splitlines()
+    assert 'http_request_duration_seconds_bucket{route="/",le="0.005"} 1' in lines
+    assert 'http_request_duration_seconds_bucket{route="/",le="0.25"} 2' in lines
+    assert 'http_request_duration_seconds_count{route="/"} 2' in lines
+    assert 'http_request_duration_seconds_sum{route="/"} 0.203' in lines
+
+
+def test_metrics_keep_exited_workers(histograms):
+    """Test that an exited worker's counts are merged, not left as its file."""
+    histograms.observe("/", 0.003)
+    worker = multiprocessing.get_context("fork").Process(
+        target=histograms.observe, args=("/", 0.003)
+    )
+    worker.start()
+    worker.join()
+    histograms.retire(worker.pid)
+    assert sorted(histograms.files()) == sorted(
+        ["exited.metrics", "%d.metrics" % os.getpid()]
+    )
+    assert 'http_request_duration_seconds_count{route="/"} 2' in (
+        histograms.export().splitlines()
+    )
+    histograms.clear()
+    assert histograms.files() == []
@@ -0,0 +1,683 @@
+import http.client
+import json
+import os
+import platform
+import runpy
+import selectors
+import socket
+import socketserver
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ..web_server.app import LatencyHistograms, app, request_stats
+from .conftest import LIBEXEC_DIR, FakeConnection
+from .conftest import run_mssql_plugin as run_mssql
+from .conftest import run_ncpa_plugin as run_ncpa
+
+# By default every benchmark runs once at the smallest scale, as an end to
+# end test of the plugin. Set BENCHMARK_RESULTS to a file to run every scale
+# and save the results there as JSON. Set BENCHMARK_BASELINE to an earlier
+# results file to fail on metrics more than BENCHMARK_TOLERANCE worse.
+RESULTS_FILE = os.environ.get("BENCHMARK_RESULTS")
+BASELINE_FILE = os.environ.get("BENCHMARK_BASELINE")
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", "0.25"))
+
+SCALES = (10, 100, 1000) if RESULTS_FILE else (10,)
+COLD_STARTS = 5 if RESULTS_FILE else 2  # Plugin processes started per plugin
+CHECKS = 20 if RESULTS_FILE else 5  # Checks timed in-process per plugin
+PROCESSES = 16  # Plugin processes run at once by Nagios-like fan-out
+REQUESTS = 5000 if RESULTS_FILE else 500  # Requests timed per web endpoint
+LOAD_REQUESTS = 2000 if RESULTS_FILE else 200  # Requests of the gunicorn load test
+CONCURRENCY = 8  # Clients sending those requests at once
+SLOW_CLIENTS = 2  # Clients that trickle their requests in, one per sync worker
+SLOW_SECONDS = 0.2  # Time a slow client takes to send its request
+WEB_SERVER_DIR = LIBEXEC_DIR.parent.parent / "web_server"
+
+LOGIN = ["-U", "nagios", "-P", "secret"]
+
+
+def summarize(durations):
+    """Return the min, median and p95 of durations in milliseconds."""
+    ms = sorted(d * 1000 for d in durations)
+    return {
+        "min": round(ms[0], 2),
+        "median": round(statistics.median(ms), 2),
+        "p95": round(ms[min(int(len(ms) * 0.95), len(ms) - 1)], 2),
+        "p99": round(ms[min(int(len(ms) * 0.99), len(ms) - 1)], 2),
+    }
+
+
+def cold_start(script, *args):
+    """Time COLD_STARTS runs of a plugin in a new interpreter each.
+
+    Returns the summary and the CompletedProcess of the last run.
+    """
+    durations = []
+    for _ in range(COLD_STARTS):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, script, *args],
+            cwd=str(LIBEXEC_DIR),
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        durations.append(time.perf_counter() - start)
+    return summarize(durations), result
+
+
+def check_latency(check):
+    """Time CHECKS in-process calls of check, after one warm-up call."""
+    check()
+    durations = []
+    for _ in range(CHECKS):
+        start = time.perf_counter()
+        check()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def requests_per_second(client, path):
+    """Time REQUESTS requests for path through a Flask test client."""
+    for _ in range(REQUESTS // 10):
+        assert client.get(path).status_code == 200
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        client.get(path)
+    return round(REQUESTS / (time.perf_counter() - start), 1)
+
+
+def throughput(targets, run):
+    """Time run(targets) once, returning its rate and run's result."""
+    start = time.perf_counter()
+    value = run(targets)
+    elapsed = time.perf_counter() - start
+    rate = {
+        "seconds": round(elapsed, 3),
+        "checks_per_second": round(targets / elapsed, 1),
+    }
+    return rate, value
+
+
+def gunicorn_load(worker_class, tmp_path):
+    """Load app.py's gunicorn server while slow clients hold connections.
+
+    Returns the rate of the fast requests and a summary of their latency.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(
+        os.environ,
+        FLASK_ENV="production",
+        PORT=str(port),
+        WORKER_CLASS=worker_class,
+        WEB_WORKERS=str(SLOW_CLIENTS),
+        METRICS_DIR=str(tmp_path / worker_class),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "app.py"],
+        cwd=str(WEB_SERVER_DIR),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    stop = threading.Event()
+
+    def get(_):
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            conn.request("GET", "/")
+            response = conn.getresponse()
+            assert response.status == 200 and response.read()
+        finally:
+            conn.close()
+        return time.perf_counter() - start
+
+    def trickle():
+        while not stop.is_set():
+            with socket.create_connection(("127.0.0.1", port), timeout=30) as sock:
+                sock.sendall(b"GET /status HTTP/1.1\r\nHost: bench\r\n")
+                time.sleep(SLOW_SECONDS)
+                sock.sendall(b"Connection: close\r\n\r\n")
+                while sock.recv(65536):
+                    pass
+
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                get(None)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        with ThreadPoolExecutor(SLOW_CLIENTS + CONCURRENCY) as pool:
+            slow = [pool.submit(trickle) for _ in range(SLOW_CLIENTS)]
+            start = time.perf_counter()
+            latencies = list(pool.map(get, range(LOAD_REQUESTS)))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            for future in slow:
+                future.result()
+    finally:
+        stop.set()
+        server.terminate()
+        server.wait(timeout=30)
+    return round(LOAD_REQUESTS / elapsed, 1), summarize(latencies)
+
+
+@pytest.fixture(scope="module")
+def results():
+    """Fixture to collect every benchmark's results, saved on teardown."""
+    collected = {}
+    yield collected
+    if RESULTS_FILE:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "scales": list(SCALES),
+            "plugins": collected,
+        }
+        with open(RESULTS_FILE, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def find_regressions(baseline, current, tolerance):
+    """Return the metrics of current more than tolerance worse than baseline."""
+    regressions = []
+    for plugin, metrics in current.items():
+        old = baseline.get(plugin, {})
+        for metric in ("cold_start_ms", "check_latency_ms"):
+            if metric in old and metric in metrics:
+                before, after = old[metric]["median"], metrics[metric]["median"]
+                if after > before * (1 + tolerance):
+                    regressions.append(f"{plugin} {metric}: {before} -> {after}")
+        for targets, rate in metrics.get("throughput", {}).items():
+            before = old.get("throughput", {}).get(targets)
+            if before is None:
+                continue
+            before, after = before["checks_per_second"], rate["checks_per_second"]
+            if after < before / (1 + tolerance):
+                regressions.append(
+                    f"{plugin} throughput at {targets}: {before} -> {after}/s"
+                )
+        for name, after in metrics.get("requests_per_second", {}).items():
+            before = old.get("requests_per_second", {}).get(name)
+            if before is not None and after < before / (1 + tolerance):
+                regressions.append(f"{plugin} {name}: {before} -> {after} req/s")
+    return regressions
+
+
+class ListenerPool:
+    """Listening TCP sockets on localhost that accept and drop connections.
+
+    Stands in for a fleet of web servers: targets are spread over the pool's
+    ports, and one thread accepts for all of them.
+    """
+
+    def __init__(self, size):
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        for _ in range(size):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(("127.0.0.1", 0))
+            sock.listen(1024)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.sockets.append(sock)
+        self.ports = [sock.getsockname()[1] for sock in self.sockets]
+        self.accepted = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            for key, _ in self.selector.select(0.05):
+                try:
+                    conn, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                conn.close()
+                self.accepted += 1
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.selector.close()
+        for sock in self.sockets:
+            sock.close()
+
+
+def encode_length(length):
+    """Encode an MQTT remaining length."""
+    encoded = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def topic_matches(topic_filter, topic):
+    """Return True if an MQTT topic filter, with + and # wildcards, matches topic."""
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(levels) or level not in ("+", levels[index]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+class MQTTHandler(socketserver.BaseRequestHandler):
+    """Speak just enough MQTT 3.1.1 for check-mqtt.py.
+
+    Clients connect, subscribe and publish at QoS 0 to 2, and messages are
+    delivered to every matching subscriber at QoS 0.
+    """
+
+    def setup(self):
+        self.lock = threading.Lock()
+        self.reader = self.request.makefile("rb")
+
+    def send(self, header, body=b""):
+        with self.lock:
+            self.request.sendall(bytes([header]) + encode_length(len(body)) + body)
+
+    def read_packet(self):
+        try:
+            header = self.reader.read(1)
+        except ConnectionError:
+            return None, None
+        if not header:
+            return None, None
+        length, shift = 0, 0
+        while True:
+            digit = self.reader.read(1)[0]
+            length += (digit & 0x7F) << shift
+            shift += 7
+            if not digit & 0x80:
+                break
+        return header[0], self.reader.read(length)
+
+    def handle(self):
+        while True:
+            header, body = self.read_packet()
+            if header is None:
+                return
+            kind = header >> 4
+            if kind == 1:  # CONNECT
+                self.send(0x20, b"\x00\x00")
+            elif kind == 3:  # PUBLISH
+                self.publish(header, body)
+            elif kind == 6:  # PUBREL
+                self.send(0x70, body[:2])
+            elif kind == 8:  # SUBSCRIBE
+                self.subscribe(body)
+            elif kind == 12:  # PINGREQ
+                self.send(0xD0)
+            elif kind == 14:  # DISCONNECT
+                return
+
+    def finish(self):
+        self.server.unsubscribe(self)
+        self.reader.close()
+
+    def publish(self, header, body):
+        qos = (header >> 1) & 3
+        (topic_length,) = struct.unpack("!H", body[:2])
+        topic = body[2 : 2 + topic_length]
+        payload = body[2 + topic_length + (2 if qos else 0) :]
+        if qos == 1:
+            self.send(0x40, body[2 + topic_length : 4 + topic_length])
+        elif qos == 2:
+            self.send(0x50, body[2 + topic_length : 4 + topic_length])
+        self.server.deliver(topic.decode(), body[: 2 + topic_length] + payload)
+
+    def subscribe(self, body):
+        offset = 2
+        granted = bytearray()
+        while offset < len(body):
+            (length,) = struct.unpack("!H", body[offset : offset + 2])
+            topic_filter = body[offset + 2 : offset + 2 + length].decode()
+            self.server.subscribe(self, topic_filter)
+            granted.append(0)
+            offset += 3 + length
+        self.send(0x90, body[:2] + bytes(granted))
+
+
+class MQTTBroker(socketserver.ThreadingTCPServer):
+    """An in-process MQTT broker on a localhost port."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MQTTHandler)
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.delivered = 0
+
+    def subscribe(self, handler, topic_filter):
+        with self.lock:
+            self.subscriptions.setdefault(handler, set()).add(topic_filter)
+
+    def unsubscribe(self, handler):
+        with self.lock:
+            self.subscriptions.pop(handler, None)
+
+    def deliver(self, topic, body):
+        with self.lock:
+            handlers = [
+                handler
+                for handler, filters in self.subscriptions.items()
+                if any(topic_matches(f, topic) for f in filters)
+            ]
+            self.delivered += len(handlers)
+        for handler in handlers:
+            try:
+                handler.send(0x30, body)
+            except OSError:
+                pass
+
+
+@pytest.fixture
+def listener_pool():
+    """Fixture to provide a pool of 32 accepting listeners."""
+    pool = ListenerPool(32)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def mqtt_broker():
+    """Fixture to run an MQTTBroker in a thread."""
+    server = MQTTBroker()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_benchmark_webservers(load_plugin, listener_pool, tmp_path, results):
+    """Benchmark check_webservers.py against the listener pool."""
+    plugin = load_plugin("check_webservers.py")
+    inventory = tmp_path / "webservers.txt"
+    inventory.write_text(f"127.0.0.1:{listener_pool.ports[0]}\n")
+
+    def run(*argv):
+        with pytest.raises(SystemExit) as exc:
+            plugin.main(["--no-cache", "-t", "2", *argv])
+        return exc.value.code
+
+    cold, process = cold_start(
+        "check_webservers.py", "--no-cache", "-f", str(inventory)
+    )
+    assert process.stdout.startswith("OK - All 1 servers are online")
+    latency = check_latency(lambda: run("-f", str(inventory)))
+
+    def fleet(targets):
+        path = tmp_path / f"webservers-{targets}.txt"
+        ports = listener_pool.ports
+        path.write_text(
+            "".join(f"127.0.0.1:{ports[i % len(ports)]}\n" for i in range(targets))
+        )
+        return run("-f", str(path))
+
+    rates = {}
+    for targets in SCALES:
+        rates[str(targets)], code = throughput(targets, fleet)
+        assert code == plugin.NAGIOS_OK
+    results["check_webservers.py"] = {
+        "cold_start_ms": cold,
+        "check_latency_ms": latency,
+        "throughput": rates,
+    }
+
+
+def test_benchmark_ncpa(load_plugin, ncpa_server, monkeypatch, tmp_path, results):
+    """Benchmark check_ncpa.py against the fake NCPA API."""
+    plugin = load_plugin("check_ncpa.py")
+    # Let the fan-out's workers connect at once without overflowing the backlog
+    ncpa_server.socket.listen(128)
+    port = str(ncpa_server.server_address[1])
+    check = ["-P", port, "-M", "cpu/percent"]
+
+    cold, process = cold_start("check_ncpa.py", "-H", "127.0.0.1", *check)
+    assert process.returncode == 0
+    latency = check_latency(
+        lambda: run_ncpa(plugin, monkeypatch, "-H", "127.0.0.1", *check)
+    )
+
+    def fleet(targets):
+        hosts = tmp_path / f"hosts-{targets}.txt"
+        hosts.write_text("".join(f"host{i} 127.0.0.1\n" for i in range(targets)))
+        return run_ncpa(plugin, monkeypatch, "-L", str(hosts), *check)
+
+    rates = {}
+    for targets in SCALES:
+        rates[str(targets)], (stdout, code) = throughput(targets, fleet)
+        assert code == 0
+        assert stdout.count(";0;CHECKED /api/cpu/percent/") == targets
+    results["check_ncpa.py"] = {
+        "cold_start_ms": cold,
+        "check_latency_ms": latency,
+        "throughput": rates,
+    }
+
+
+def test_benchmark_mssql_server(
+    load_plugin, mssql_broker, monkeypatch, tmp_path, results
+):
+    """Benchmark check_mssql_server.py with pymssql mocked."""
+    plugin = load_plugin("check_mssql_server.py")
+    monkeypatch.setattr(
+        "pymssql.connect",
+        lambda **kwargs: FakeConnection({"sys.sysprocesses": [(42,)]}),
+    )
+
+    cold, process = cold_start(
+        "check_mssql_server.py",
+        *["-H", "sql-01", *LOGIN, "--connections", "--broker", mssql_broker],
+    )
+    assert process.stdout.startswith("OK: Number of open connections is 42.0")
+    latency = check_latency(
+        lambda: run_mssql(plugin, monkeypatch, "-H", "sql-01", *LOGIN, "--connections")
+    )
+
+    def fleet(targets):
+        instances = tmp_path / f"instances-{targets}.txt"
+        instances.write_text("".join(f"sql-{i}\n" for i in range(targets)))
+        return run_mssql(
+            plugin, monkeypatch, *LOGIN, "-L", str(instances), "--connections"
+        )
+
+    rates = {}
+    for targets in SCALES:
+        rates[str(targets)], (message, code) = throughput(targets, fleet)
+        assert code == 0
+        assert message.count("OK: Number of open connections is 42.0") == targets
+    results["check_mssql_server.py"] = {
+        "cold_start_ms": cold,
+        "check_latency_ms": latency,
+        "throughput": rates,
+    }
+
+
+def test_benchmark_mssql_database(load_plugin, mssql_broker, monkeypatch, results):
+    """Benchmark check_mssql_database.py with pymssql mocked."""
+    plugin = load_plugin("check_mssql_database.py")
+    check = ["-H", "sql-01", *LOGIN, "--logfileusage", "-w", "90", "-c", "95"]
+    connections = {"instance_name='sales'": [(88,)]}
+    monkeypatch.setattr("pymssql.connect", lambda **kwargs: FakeConnection(connections))
+
+    cold, process = cold_start(
+        "check_mssql_database.py", *check, "-T", "sales", "--broker", mssql_broker
+    )
+    assert process.stdout.startswith("OK: Log File Usage is 88.0%")
+    latency = check_latency(
+        lambda: run_mssql(plugin, monkeypatch, *check, "-T", "sales")
+    )
+
+    def sweep(targets):
+        connections["instance_name<>'_Total'"] = [
+            (f"db{i}".ljust(128), "Percent Log Used".ljust(128), i % 100)
+            for i in range(targets)
+        ]
+        return run_mssql(plugin, monkeypatch, *check, "--sweep")
+
+    rates = {}
+    for targets in SCALES:
+        rates[str(targets)], (message, code) = throughput(targets, sweep)
+        assert f"of {targets} databases" in message
+        assert len(message.splitlines()) == targets + 1
+    results["check_mssql_database.py"] = {
+        "cold_start_ms": cold,
+        "check_latency_ms": latency,
+        "throughput": rates,
+    }
+
+
+def test_benchmark_mqtt(mqtt_broker, monkeypatch, capsys, results):
+    """Benchmark check-mqtt.py against the in-process MQTT broker."""
+    script = str(LIBEXEC_DIR / "check-mqtt.py")
+    check = ["-H", "127.0.0.1", "-P", str(mqtt_broker.server_address[1])]
+
+    def run():
+        monkeypatch.setattr("sys.argv", [script, *check])
+        with pytest.raises(SystemExit) as exc:
+            runpy.run_path(script, run_name="__main__")
+        return exc.value.code
+
+    cold, process = cold_start("check-mqtt.py", *check)
+    assert process.stdout.startswith("OK - message from nagios/test")
+    latency = check_latency(run)
+    assert run() == 0
+
+    def fleet(targets):
+        with ThreadPoolExecutor(PROCESSES) as executor:
+            return list(
+                executor.map(
+                    lambda _: subprocess.run(
+                        [sys.executable, script, *check],
+                        capture_output=True,
+                        timeout=60,
+                    ).returncode,
+                    range(targets),
+                )
+            )
+
+    rates = {}
+    for targets in SCALES:
+        rates[str(targets)], codes = throughput(targets, fleet)
+        assert codes == [0] * targets
+    results["check-mqtt.py"] = {
+        "cold_start_ms": cold,
+        "check_latency_ms": latency,
+        "throughput": rates,
+    }
+
+
+def test_benchmark_status(monkeypatch, results):
+    """Benchmark GET /status through Flask and through StatusMiddleware."""
+    middleware = requests_per_second(app.test_client(), "/status")
+    monkeypatch.setattr(app, "wsgi_app", app.wsgi_app.wsgi_app)
+    flask = requests_per_second(app.test_client(), "/status")
+    # Timings only mean something in a dedicated benchmark run
+    if RESULTS_FILE:
+        assert middleware > flask
+    results["web_server /status"] = {
+        "requests_per_second": {"flask": flask, "middleware": middleware}
+    }
+
+
+def test_benchmark_metrics(monkeypatch, tmp_path, results):
+    """Benchmark GET / with and without the /metrics latency histograms."""
+    histograms = LatencyHistograms(
+        {rule.rule for rule in app.url_map.iter_rules()}, str(tmp_path)
+    )
+    monkeypatch.setattr(request_stats, "histograms", histograms)
+    with_metrics = requests_per_second(app.test_client(), "/")
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        histograms.observe("/", 0.003)
+    observe_us = (time.perf_counter() - start) / REQUESTS * 1e6
+    monkeypatch.setattr(request_stats, "histograms", None)
+    without = requests_per_second(app.test_client(), "/")
+    # Warm-up and timed requests, then the timed observe() calls
+    count = REQUESTS // 10 + REQUESTS * 2
+    assert f'http_request_duration_seconds_count{{route="/"}} {count}' in (
+        histograms.export().splitlines()
+    )
+    if RESULTS_FILE:
+        # Recording a request must cost under 5% of handling the cheapest one
+        assert observe_us < 0.05 * 1e6 / without
+    results["web_server /metrics"] = {
+        "requests_per_second": {"without": without, "with": with_metrics},
+        "observe_us": round(observe_us, 3),
+    }
+
+
+def test_benchmark_worker_classes(tmp_path, results):
+    """Load test gunicorn's sync and gthread workers with slow clients."""
+    rates, latencies = {}, {}
+    for worker_class in ("sync", "gthread"):
+        rates[worker_class], latencies[worker_class] = gunicorn_load(
+            worker_class, tmp_path
+        )
+    if RESULTS_FILE:
+        # Slow clients hold every sync worker up, gthread keeps serving
+        assert latencies["gthread"]["p99"] < latencies["sync"]["p99"]
+    results["web_server gunicorn"] = {
+        "requests_per_second": rates,
+        "latency_ms": latencies,
+    }
+
+
+@pytest.mark.skipif(not BASELINE_FILE, reason="BENCHMARK_BASELINE is not set")
+def test_no_regressions(results):
+    """Test the results against the baseline given by BENCHMARK_BASELINE."""
+    with open(BASELINE_FILE) as f:
+        baseline = json.load(f)["plugins"]
+    assert find_regressions(baseline, results, TOLERANCE) == []
+
+
+def test_find_regressions():
+    """Test that only metrics worse than the tolerance are regressions."""
+    baseline = {
+        "check_ncpa.py": {
+            "cold_start_ms": {"median": 100.0},
+            "check_latency_ms": {"median": 10.0},
+            "throughput": {"10": {"checks_per_second": 100.0}},
+        }
+    }
+    current = {
+        "check_ncpa.py": {
+            "cold_start_ms": {"median": 120.0},
+            "check_latency_ms": {"median": 20.0},
+            "throughput": {
+                "10": {"checks_per_second": 70.0},
+                "100": {"checks_per_second": 1.0},
+            },
+        }
+    }
+    assert find_regressions(baseline, current, 0.25) == [
+        "check_ncpa.py check_latency_ms: 10.0 -> 20.0",
+        "check_ncpa.py throughput at 10: 100.0 -> 70.0/s",
+    ]
@@ -0,0 +1,125 @@
+import pytest
+
+from .conftest import FakeConnection
+from .conftest import run_mssql_plugin as run_plugin
+
+LOGIN = ["-H", "sql-01", "-U", "nagios", "-P", "secret"]
+
+
+@pytest.fixture
+def plugin(load_plugin, monkeypatch, tmp_path):
+    """Fixture to provide the check_mssql_database plugin module."""
+    module = load_plugin("check_mssql_database.py")
+    state_file = str(tmp_path / "state.sqlite")
+    monkeypatch.setattr("counter_rate.STATE_FILE", state_file)
+    return module
+
+
+@pytest.fixture
+def connections(plugin, monkeypatch):
+    """Fixture to record every login, answering for three databases."""
+    made = []
+
+    def padded(name):
+        return name.ljust(128)
+
+    results = {
+        "instance_name='sales'": [(88,)],
+        "'Percent Log Used' AND instance_name<>'_Total'": [
+            (padded("sales"), padded("Percent Log Used"), 88),
+            (padded("crm"), padded("Percent Log Used"), 97),
+            (padded("hr"), padded("Percent Log Used"), 12),
+        ],
+        "'Log Cache Hit Ratio%' AND instance_name<>'_Total'": [
+            (padded("sales"), padded("Log Cache Hit Ratio Base"), 100),
+            (padded("sales"), padded("Log Cache Hit Ratio"), 99),
+            (padded("crm"), padded("Log Cache Hit Ratio Base"), 100),
+            (padded("crm"), padded("Log Cache Hit Ratio"), 40),
+        ],
+    }
+
+    def connect(**kwargs):
+        made.append(FakeConnection(results))
+        made[-1].database = kwargs["database"]
+        return made[-1]
+
+    monkeypatch.setattr("pymssql.connect", connect)
+    return made
+
+
+def test_single_database(plugin, connections, monkeypatch):
+    """Test a regular check of the database given with -T."""
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *LOGIN,
+        "-T",
+        "sales",
+        "--logfileusage",
+        "-w",
+        "80",
+        "-c",
+        "90",
+    )
+    assert (message, code) == (
+        "WARNING: Log File Usage is 88.0%|log_file_usage=88.0%;80;90;;",
+        1,
+    )
+    assert connections[0].database == "sales"
+
+
+def test_sweep_checks_every_database(plugin, connections, monkeypatch):
+    """Test that one query evaluates every database, worst first."""
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *LOGIN,
+        *["--sweep", "--logfileusage", "-w", "80", "-c", "90", "--top", "2"],
+    )
+    lines = message.splitlines()
+    assert code == 2
+    assert lines[0].startswith(
+        "CRITICAL: 1 CRITICAL, 1 WARNING, 0 UNKNOWN of 3 databases; "
+        "worst: crm 97.0%, sales 88.0%|'crm log_file_usage'=97.0%;80;90;;"
+    )
+    assert lines[1:] == [
+        "crm: CRITICAL: Log File Usage is 97.0%",
+        "sales: WARNING: Log File Usage is 88.0%",
+        "hr: OK: Log File Usage is 12.0%",
+    ]
+    assert len(connections[0].queries) == 1
+    assert connections[0].database == "master"
+
+
+def test_sweep_ratio_modes(plugin, connections, monkeypatch):
+    """Test that ratios are paired with their base per database."""
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *LOGIN,
+        *["--sweep", "--logcachehit", "-w", "90", "-c", "50"],
+    )
+    lines = message.splitlines()
+    assert code == 2
+    assert "worst: crm 40.0%, sales 99.0%" in lines[0]
+    assert lines[1] == "crm: CRITICAL: Log Cache Hit Ratio is 40.0%"
+
+
+def test_sweep_needs_a_query_mode(plugin, monkeypatch, capsys):
+    """Test that --sweep is rejected without a mode that runs a query."""
+    monkeypatch.setattr("sys.argv", ["check_mssql_database.py", *LOGIN, "--sweep"])
+    with pytest.raises(SystemExit):
+        plugin.parse_args()
+    assert "--sweep needs a Mode Option" in capsys.readouterr().err
+
+
+def test_range_thresholds(plugin, connections, monkeypatch):
+    """Test thresholds using the range grammar rather than plain numbers."""
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *LOGIN,
+        *["-T", "sales", "--logfileusage", "-w", "~:80", "-c", "@90:100"],
+    )
+    assert code == 1
+    assert message.startswith("WARNING: Log File Usage is 88.0%")
@@ -0,0 +1,252 @@
+import time
+
+import pymssql
+import pytest
+
+from .conftest import MSSQL_LOGIN as LOGIN
+from .conftest import FakeConnection
+from .conftest import run_mssql_plugin as run_plugin
+
+
+@pytest.fixture
+def plugin(load_plugin, monkeypatch, tmp_path):
+    """Fixture to provide the check_mssql_server plugin module."""
+    module = load_plugin("check_mssql_server.py")
+    state_file = str(tmp_path / "state.sqlite")
+    monkeypatch.setattr("counter_rate.STATE_FILE", state_file)
+    return module
+
+
+@pytest.fixture
+def connections(plugin, monkeypatch):
+    """Fixture to record every login made through pymssql.connect()."""
+    made = []
+    results = {
+        "SELECT counter_name, instance_name": [
+            ("Buffer cache hit ratio".ljust(128), "".ljust(128), 90),
+            ("Buffer cache hit ratio base".ljust(128), "".ljust(128), 100),
+            ("Page lookups/sec".ljust(128), "".ljust(128), 1000),
+            ("Page life expectancy".ljust(128), "".ljust(128), 300),
+            ("Page life expectancy".ljust(128), "000".ljust(128), 200),
+            ("Lock Waits/sec".ljust(128), "Object".ljust(128), 4),
+            ("Lock Waits/sec".ljust(128), "_Total".ljust(128), 9),
+        ],
+        "sys.sysprocesses": [(42,)],
+        "'Number of Deadlocks/sec'": [(0,)],
+        "dm_os_sys_memory": [(91.5,)],
+        "'Buffer cache hit ratio": [(90,), (100,)],
+    }
+
+    def connect(**kwargs):
+        made.append(FakeConnection(results))
+        return made[-1]
+
+    monkeypatch.setattr("pymssql.connect", connect)
+    return made
+
+
+def test_single_mode(plugin, connections, monkeypatch):
+    """Test a regular single-mode check."""
+    message, code = run_plugin(
+        plugin, monkeypatch, *LOGIN, "--connections", "-w", "50", "-c", "100"
+    )
+    assert code == 0
+    assert message == "OK: Number of open connections is 42.0|connections=42.0;50;100;;"
+
+
+def test_batch_uses_one_connection(plugin, connections, monkeypatch, tmp_path):
+    """Test that a batch evaluates every mode with its own thresholds."""
+    batch = tmp_path / "sql-01.batch"
+    batch.write_text(
+        "# service description; mode and thresholds\n"
+        "SQL Connections; --connections -w 50 -c 100\n"
+        "SQL Memory; --memory -w 80 -c 90\n"
+        "SQL Buffer Hit Ratio; --bufferhitratio -w 95: -c 90:\n"
+        "SQL Login Time; --time2connect -w 1 -c 5\n"
+        "Broken; --connections --memory\n"
+        "Unknown Query; --cpu\n"
+    )
+    message, code = run_plugin(
+        plugin, monkeypatch, *LOGIN, "-b", str(batch), "--host-name", "SQL01"
+    )
+    lines = message.splitlines()
+    assert code == 0
+    assert len(connections) == 1
+    assert ";SQL01;SQL Connections;0;OK: Number of open connections is 42.0" in lines[0]
+    assert ";SQL01;SQL Memory;2;CRITICAL: Server using 91.5% of memory" in lines[1]
+    assert ";SQL01;SQL Buffer Hit Ratio;1;WARNING: Buffer Cache Hit Ratio" in lines[2]
+    assert ";SQL01;SQL Login Time;0;OK: Time to connect was" in lines[3]
+    assert ";SQL01;Broken;3;UNKNOWN: Invalid batch entry: Must choose one" in lines[4]
+    assert ";SQL01;Unknown Query;3;UNKNOWN: cpu failed with" in lines[5]
+
+
+def test_batch_submits_to_command_file(plugin, connections, monkeypatch, tmp_path):
+    """Test that --command-file submits the batch and returns a summary."""
+    batch = tmp_path / "sql-01.batch"
+    batch.write_text("SQL Connections; --connections -w 10 -c 100\n")
+    command_file = tmp_path / "nagios.cmd"
+    command_file.touch()
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *LOGIN,
+        *["-b", str(batch), "--command-file", str(command_file)],
+    )
+    assert (message, code) == (
+        "OK: Submitted 1 results (0 OK, 1 WARNING, 0 CRITICAL, 0 UNKNOWN)",
+        0,
+    )
+    assert ";sql-01;SQL Connections;1;WARNING:" in command_file.read_text()
+
+
+def test_perf_counters_parse(plugin):
+    """Test that counters are read from the modes' sysperfinfo queries."""
+    parse = plugin.PerfCounters.parse
+    assert parse(plugin.MODES["freepages"]["query"]) == ("free pages", "", False)
+    assert parse(plugin.MODES["deadlocks"]["query"]) == (
+        "number of deadlocks/sec",
+        "_total",
+        False,
+    )
+    assert parse(plugin.MODES["pagesplits"]["query"]) == (
+        "page splits/sec",
+        None,
+        False,
+    )
+    assert parse(plugin.MODES["cachehit"]["query"]) == (
+        "cache hit ratio",
+        "_total",
+        True,
+    )
+    assert parse(plugin.MODES["cpu"]["query"]) is None
+
+
+def test_batch_collects_counters_in_one_query(
+    plugin, connections, monkeypatch, tmp_path
+):
+    """Test that every sysperfinfo mode of a batch is fed from one query."""
+    batch = tmp_path / "sql-01.batch"
+    batch.write_text(
+        "SQL Connections; --connections -w 50 -c 100\n"
+        "SQL Buffer Hit Ratio; --bufferhitratio -w 95: -c 90:\n"
+        "SQL Page Life; --pagelife -w 400: -c 100:\n"
+        "SQL Lock Waits; --lockwaits\n"
+        "SQL Page Lookups; --pagelooks\n"
+    )
+    message, code = run_plugin(plugin, monkeypatch, *LOGIN, "-b", str(batch))
+    lines = message.splitlines()
+    queries = connections[0].queries
+    assert len(queries) == 2
+    assert "counter_name IN ('lock waits/sec', 'page life expectancy'" in queries[0]
+    assert "OR counter_name LIKE 'buffer cache hit ratio%'" in queries[0]
+    assert "sys.sysprocesses" in queries[1]
+    assert (
+        ";SQL Buffer Hit Ratio;1;WARNING: Buffer Cache Hit Ratio is 90.0%" in lines[1]
+    )
+    assert ";SQL Page Life;1;WARNING: Page Life Expectancy is 300.0/sec" in lines[2]
+    assert len(lines) == 5
+    # The first sample of a delta has no rate to compare thresholds with
+    assert ";SQL Page Lookups;0;OK: Page Lookups Per Second is None" in lines[4]
+
+
+def test_batch_falls_back_to_per_mode_queries(
+    plugin, connections, monkeypatch, tmp_path
+):
+    """Test that a failed bulk query leaves each mode to run its own query."""
+    monkeypatch.setattr(plugin.PerfCounters, "collect", lambda *args: 1 / 0)
+    batch = tmp_path / "sql-01.batch"
+    batch.write_text("SQL Buffer Hit Ratio; --bufferhitratio -w 95: -c 90:\n")
+    message, code = run_plugin(plugin, monkeypatch, *LOGIN, "-b", str(batch))
+    assert ";SQL Buffer Hit Ratio;1;WARNING: Buffer Cache Hit Ratio is 90.0%" in message
+    assert "LIKE 'Buffer cache hit ratio%'" in connections[0].queries[0]
+
+
+def test_delta_rate_across_runs(plugin, connections, monkeypatch):
+    """Test that a delta mode computes its rate from the previous run's sample."""
+    clock = [1000.0]
+    monkeypatch.setattr(plugin.time, "time", lambda: clock[0])
+    run_plugin(plugin, monkeypatch, *LOGIN, "--deadlocks")
+    clock[0] += 10
+    connections[-1].results["'Number of Deadlocks/sec'"] = [(50,)]
+    message, code = run_plugin(plugin, monkeypatch, *LOGIN, "--deadlocks", "-w", "2")
+    assert code == 1
+    assert message.startswith("WARNING: Deadlocks / Sec is 5.0/sec")
+
+
+def test_fanout_checks_every_instance(plugin, monkeypatch, tmp_path):
+    """Test per-instance results, with hung and failing instances isolated."""
+    logins = []
+
+    def connect(host, **kwargs):
+        logins.append((host, kwargs["login_timeout"]))
+        if host == "sql-hung":
+            time.sleep(10)
+        if host == "sql-down":
+            raise pymssql.OperationalError("Adaptive Server is unavailable")
+        return FakeConnection({"sys.sysprocesses": [(len(host),)]})
+
+    monkeypatch.setattr("pymssql.connect", connect)
+    instances = tmp_path / "instances.txt"
+    instances.write_text(
+        "# host_name server\n"
+        "SQL01 sql-01\\PROD\n"
+        "SQL02 sql-02:1433\n"
+        "sql-down\n"
+        "SQL03 sql-hung\n"
+    )
+    start = time.monotonic()
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *["-U", "nagios", "-P", "secret", "-L", str(instances), "--deadline", "1"],
+        *["--connections", "-w", "10", "--service", "SQL Connections"],
+    )
+    lines = message.splitlines()
+    assert time.monotonic() - start < 2
+    assert code == 0
+    assert (
+        ";SQL01;SQL Connections;1;WARNING: Number of open connections is 11.0"
+        in lines[0]
+    )
+    assert (
+        ";SQL02;SQL Connections;1;WARNING: Number of open connections is 11.0"
+        in lines[1]
+    )
+    assert ";sql-down;SQL Connections;3;UNKNOWN: Adaptive Server" in lines[2]
+    assert ";SQL03;SQL Connections;3;UNKNOWN: No result before the deadline" in lines[3]
+    assert ("sql-01\\PROD", 1) in logins
+
+
+def test_fanout_runs_batch_per_instance(plugin, connections, monkeypatch, tmp_path):
+    """Test that a batch file is run over one connection per instance."""
+    instances = tmp_path / "instances.txt"
+    instances.write_text("SQL01 sql-01\nSQL02 sql-02\n")
+    batch = tmp_path / "modes.batch"
+    batch.write_text(
+        "SQL Connections; --connections -w 50\nSQL Memory; --memory -w 95\n"
+    )
+    message, code = run_plugin(
+        plugin,
+        monkeypatch,
+        *["-U", "nagios", "-P", "secret", "-L", str(instances), "-b", str(batch)],
+    )
+    lines = sorted(message.splitlines())
+    assert len(connections) == 2
+    assert len(lines) == 4
+    assert ";SQL01;SQL Connections;0;" in lines[0]
+    assert ";SQL02;SQL Memory;0;" in lines[3]
+
+
+def test_delta_smoothed_rate(plugin, monkeypatch):
+    """Test that --smooth evaluates the EWMA of the rates across runs."""
+    clock = [1000.0]
+    monkeypatch.setattr(plugin.time, "time", lambda: clock[0])
+    for value in (0, 100, 400):
+        results = {"'Number of Deadlocks/sec'": [(value,)]}
+        monkeypatch.setattr("pymssql.connect", lambda **kwargs: FakeConnection(results))
+        message, code = run_plugin(
+            plugin, monkeypatch, *LOGIN, "--deadlocks", "--smooth"
+        )
+        clock[0] += 10
+    # Rates of 10/sec then 30/sec, smoothed with the default alpha of 0.3
+    assert message.startswith("OK: Deadlocks / Sec is 16.0/sec")
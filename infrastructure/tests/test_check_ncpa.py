@@ -0,0 +1,206 @@
+import os
+import time
+
+import pytest
+
+from .conftest import run_ncpa_plugin as run_plugin
+
+
+@pytest.fixture
+def plugin(load_plugin):
+    """Fixture to provide the check_ncpa plugin module."""
+    return load_plugin("check_ncpa.py")
+
+
+def test_single_metric(plugin, ncpa_server, monkeypatch):
+    """Test a regular single-metric check against the fake NCPA API."""
+    port = str(ncpa_server.server_address[1])
+    stdout, returncode = run_plugin(
+        plugin, monkeypatch, "-H", "127.0.0.1", "-P", port, "-M", "cpu/percent"
+    )
+    assert (stdout, returncode) == ("CHECKED /api/cpu/percent/", 0)
+
+
+def test_batch_uses_one_connection(plugin, ncpa_server, monkeypatch, tmp_path):
+    """Test that a batch checks every metric over a single TLS connection."""
+    batch = tmp_path / "batch.txt"
+    batch.write_text(
+        "# host metrics\n"
+        "CPU Usage; -M cpu/percent -w 80 -c 1\n"
+        "Memory Usage; -M memory/virtual -u Gi\n"
+        "Broken; -M disk -Z\n"
+        "Missing; -M missing/metric\n"
+        "Elsewhere; -H 10.0.0.9 -M cpu/percent\n"
+    )
+    port = str(ncpa_server.server_address[1])
+    stdout, returncode = run_plugin(
+        plugin, monkeypatch, "-H", "127.0.0.1", "-P", port, "-b", str(batch)
+    )
+    lines = stdout.splitlines()
+    assert returncode == 0
+    assert len(lines) == 5
+    assert ";127.0.0.1;CPU Usage;2;CHECKED /api/cpu/percent/" in lines[0]
+    assert ";127.0.0.1;Memory Usage;0;CHECKED /api/memory/virtual/" in lines[1]
+    assert ";127.0.0.1;Broken;3;UNKNOWN: Invalid batch entry" in lines[2]
+    assert ";127.0.0.1;Missing;3;UNKNOWN: An error occurred" in lines[3]
+    assert "Elsewhere;3;UNKNOWN: Invalid batch entry: -H and -P" in lines[4]
+    assert ncpa_server.connections == 1
+
+
+def test_batch_deadline(plugin, monkeypatch, tmp_path):
+    """Test that entries not reached before --timeout are reported as UNKNOWN."""
+    batch = tmp_path / "batch.txt"
+    batch.write_text("".join("Disk %d; -M disk/%d\n" % (i, i) for i in range(3)))
+    timeouts = []
+
+    def hang(connection, options):
+        timeouts.append(options.timeout)
+        time.sleep(options.timeout)
+        raise IOError("timed out")
+
+    monkeypatch.setattr(plugin.NCPAConnection, "get_json", hang)
+    start = time.monotonic()
+    stdout, returncode = run_plugin(
+        plugin, monkeypatch, "-H", "127.0.0.1", "-b", str(batch), "-T", "3"
+    )
+    lines = stdout.splitlines()
+    assert time.monotonic() - start < 3
+    assert len(timeouts) == 1 and timeouts[0] <= 2
+    assert ";Disk 0;3;UNKNOWN: Error occurred" in lines[0]
+    assert ";Disk 1;3;UNKNOWN: No result before the timeout" in lines[1]
+    assert ";Disk 2;3;UNKNOWN: No result before the timeout" in lines[2]
+
+
+def test_batch_submits_to_command_file(plugin, ncpa_server, monkeypatch, tmp_path):
+    """Test that --command-file submits the batch and prints a summary."""
+    batch = tmp_path / "batch.txt"
+    batch.write_text("CPU Usage; -M cpu/percent\n")
+    command_file = tmp_path / "nagios.cmd"
+    command_file.touch()
+    port = str(ncpa_server.server_address[1])
+    stdout, returncode = run_plugin(
+        plugin,
+        monkeypatch,
+        *["-H", "127.0.0.1", "-P", port, "-b", str(batch)],
+        *["--command-file", str(command_file), "--host-name", "win-01"],
+    )
+    assert returncode == 0
+    assert stdout.startswith("OK: Submitted 1 results (1 OK")
+    assert ";win-01;CPU Usage;0;" in command_file.read_text()
+
+
+def test_batch_resumes_tls_sessions(plugin, ncpa_server, monkeypatch, tmp_path):
+    """Test that reconnects within a batch resume the previous TLS session."""
+    ncpa_server.close_connections = True
+    batch = tmp_path / "batch.txt"
+    batch.write_text("".join(f"Metric {i}; -M cpu/percent\n" for i in range(3)))
+    port = str(ncpa_server.server_address[1])
+    stdout, returncode = run_plugin(
+        plugin, monkeypatch, "-H", "127.0.0.1", "-P", port, "-b", str(batch)
+    )
+    assert len(stdout.splitlines()) == 3
+    assert ncpa_server.resumed == [False, True, True]
+
+
+def test_ssl_context_is_shared(plugin):
+    """Test that SSL contexts are created once per verification mode."""
+    insecure = plugin.get_ssl_context(type("Options", (), {"secure": False}))
+    secure = plugin.get_ssl_context(type("Options", (), {"secure": True}))
+    assert plugin.get_ssl_context(type("Options", (), {"secure": False})) is insecure
+    assert insecure.verify_mode == plugin.ssl.CERT_NONE
+    assert secure.verify_mode == plugin.ssl.CERT_REQUIRED
+
+
+def test_fanout_checks_every_host(plugin, ncpa_server, monkeypatch, tmp_path):
+    """Test one result per host, with unreachable hosts reported individually."""
+    hosts = tmp_path / "hosts.txt"
+    hosts.write_text(
+        "# host_name address\n"
+        + "".join(f"win-{i:02d} 127.0.0.1\n" for i in range(20))
+        + "win-down 127.0.0.2\n"
+    )
+    port = str(ncpa_server.server_address[1])
+    stdout, returncode = run_plugin(
+        plugin,
+        monkeypatch,
+        *["-P", port, "-M", "memory/virtual", "-L", str(hosts), "--workers", "4"],
+    )
+    lines = stdout.splitlines()
+    assert returncode == 0
+    assert len(lines) == 21
+    assert ";win-00;memory/virtual;0;CHECKED /api/memory/virtual/" in lines[0]
+    assert ";win-19;memory/virtual;0;" in lines[19]
+    assert ";win-down;memory/virtual;3;UNKNOWN: An error occurred" in lines[20]
+
+
+def test_fanout_deadline(plugin, monkeypatch, tmp_path):
+    """Test that hosts unanswered by the deadline are reported as UNKNOWN."""
+    hosts = tmp_path / "hosts.txt"
+    hosts.write_text("slow-01\nslow-02\n")
+
+    def hang(options, address, timeout):
+        time.sleep(10)
+
+    monkeypatch.setattr(plugin, "check_host", hang)
+    start = time.monotonic()
+    stdout, returncode = run_plugin(
+        plugin, monkeypatch, "-M", "cpu/percent", "-L", str(hosts), "-T", "2"
+    )
+    assert time.monotonic() - start < 2
+    assert stdout.count("UNKNOWN: No result before the timeout") == 2
+
+
+def test_host_timeout_fits_budget(plugin):
+    """Test that the per-host timeout is split across waves of workers."""
+    options = plugin.optparse.Values(
+        {"host_timeout": None, "workers": 50, "timeout": 58}
+    )
+    assert plugin.get_host_timeout(options, 1000) == pytest.approx(56 / 20)
+    assert plugin.get_host_timeout(options, 10) == 56
+    options.host_timeout = 5
+    assert plugin.get_host_timeout(options, 1000) == 5
+
+
+def test_response_cache_hit(plugin, ncpa_server, monkeypatch, tmp_path, capsys):
+    """Test that a repeated check within --cache-ttl is answered locally."""
+    port = str(ncpa_server.server_address[1])
+    args = ["-H", "127.0.0.1", "-P", port, "-M", "cpu/percent", "-v"]
+    args += ["--cache-ttl", "30", "--cache-dir", str(tmp_path)]
+    first = run_plugin(plugin, monkeypatch, *args)
+    second = run_plugin(plugin, monkeypatch, *args)
+    assert first == second == ("CHECKED /api/cpu/percent/", 0)
+    assert ncpa_server.requests == ["/api/cpu/percent/"]
+    output = capsys.readouterr().out
+    assert "Cache miss: https://127.0.0.1" in output
+    assert "Cache hit: https://127.0.0.1" in output
+
+
+def test_response_cache_expiry_and_eviction(plugin, tmp_path):
+    """Test that expired entries are misses and the cache stays within size."""
+    cache = plugin.ResponseCache(str(tmp_path), 250)
+    cache.put("https://a/api/", b"a" * 100, 60)
+    cache.put("https://b/api/", b"b" * 100, 30)
+    cache.put("https://c/api/", b"c" * 100, -1)
+    assert cache.get("https://a/api/") == b"a" * 100
+    assert cache.get("https://c/api/") is None
+    cache.put("https://d/api/", b"d" * 100, 90)
+    # The entry closest to expiring goes first
+    assert cache.get("https://b/api/") is None
+    assert cache.get("https://d/api/") == b"d" * 100
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 250
+
+
+def test_response_cache_must_be_private(plugin, tmp_path):
+    """Test that a shared cache directory or a symlinked entry is not used."""
+    cache = plugin.ResponseCache(str(tmp_path), 1024)
+    cache.put("https://a/api/", b"a", 60)
+    target = tmp_path / "planted"
+    target.write_bytes(b"planted")
+    link = cache.path("https://b/api/")
+    os.symlink(str(target), link)
+    os.utime(link, (time.time() + 60,) * 2)
+    assert cache.get("https://b/api/") is None
+    tmp_path.chmod(0o777)
+    assert cache.get("https://a/api/") is None
+    with pytest.raises(OSError):
+        cache.put("https://c/api/", b"c", 60)
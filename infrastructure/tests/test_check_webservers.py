@@ -0,0 +1,388 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from werkzeug.serving import make_server
+
+from ..web_server.app import app
+
+
+@pytest.fixture
+def plugin(load_plugin, tmp_path, monkeypatch):
+    """Fixture to provide the check_webservers plugin module."""
+    module = load_plugin("check_webservers.py")
+    monkeypatch.setattr(module, "INVENTORY_CACHE_DIR", str(tmp_path))
+    return module
+
+
+@pytest.fixture
+def listener():
+    """Fixture to provide a listening TCP socket on localhost."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def web_server():
+    """Fixture to serve the Flask app on a localhost port in a thread."""
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+class KeepAliveStatusHandler(BaseHTTPRequestHandler):
+    """Serve a healthy /status response over persistent HTTP/1.1 connections."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def keep_alive_server():
+    """Fixture to serve KeepAliveStatusHandler on a localhost port in a thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveStatusHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def closed_port():
+    """Return a localhost port with nothing listening on it."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_evaluate_keeps_aggregation_rules(plugin):
+    """Test the OK/WARNING/CRITICAL rules for the down-server count."""
+    servers = ["a:1", "b:2", "c:3"]
+    assert plugin.evaluate(servers, [])[0] == plugin.NAGIOS_OK
+    assert plugin.evaluate(servers, ["a:1"])[0] == plugin.NAGIOS_WARNING
+    assert plugin.evaluate(servers, ["a:1", "b:2"])[0] == plugin.NAGIOS_WARNING
+    assert plugin.evaluate(servers, servers)[0] == plugin.NAGIOS_CRITICAL
+
+
+def test_probe_servers_concurrently(plugin, listener):
+    """Test that open and closed ports are reported in target order."""
+    port = listener.getsockname()[1]
+    targets = [
+        plugin.parse_entry(f"127.0.0.1:{port}"),
+        plugin.parse_entry(f"127.0.0.1:{closed_port()}"),
+    ]
+    results = asyncio.run(plugin.probe_servers(targets, 1, 10, 2))
+    assert [r.up for r in results] == [True, False]
+    assert results[0].connect_time is not None
+    assert results[1].connect_time is None
+
+
+def test_unencodable_host_is_down(plugin, listener, tmp_path, capsys):
+    """Test that a host failing IDNA encoding is down without stopping others."""
+    port = listener.getsockname()[1]
+    targets = [plugin.parse_entry("a..b:80"), plugin.parse_entry(f"127.0.0.1:{port}")]
+    results = asyncio.run(plugin.probe_servers(targets, 1, 10, 2))
+    assert [r.up for r in results] == [False, True]
+    assert "idna" in results[0].error
+    assert not plugin.check_server("a..b", "80", 1).up
+    assert not plugin.check_http("a..b", "80", 1).up
+
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text(f"a..b:80\n127.0.0.1:{port}\n")
+    for serial in ([], ["--serial"]):
+        with pytest.raises(SystemExit) as exc:
+            plugin.main(["-f", str(servers_file), "-t", "1", *serial])
+        assert exc.value.code == plugin.NAGIOS_WARNING
+        assert "a..b:80" in capsys.readouterr().out
+
+
+def test_probe_servers_deadline(plugin, listener, monkeypatch):
+    """Test that probes still pending at the deadline count as offline."""
+
+    async def hang(*args):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(plugin, "probe_server", hang)
+    start = time.monotonic()
+    targets = [plugin.parse_entry("127.0.0.1:1")] * 50
+    results = asyncio.run(plugin.probe_servers(targets, 5, 10, 0.2))
+    assert not any(r.up for r in results)
+    assert time.monotonic() - start < 2
+
+
+def test_main_reports_ok(plugin, listener, tmp_path, capsys):
+    """Test a full run against a webservers file of reachable servers."""
+    port = listener.getsockname()[1]
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text(f"127.0.0.1:{port}\nlocalhost:{port}\n")
+    with pytest.raises(SystemExit) as exc:
+        plugin.main(["-f", str(servers_file), "-t", "1"])
+    assert exc.value.code == plugin.NAGIOS_OK
+    output = capsys.readouterr().out
+    assert output.startswith("OK - All 2 servers are online |")
+    assert "'connect_p95'=" in output
+
+
+def test_evaluate_latency_thresholds(plugin):
+    """Test that slow but online servers raise WARNING or CRITICAL."""
+    results = [
+        plugin.ProbeResult("a:1", True, 0.01, None),
+        plugin.ProbeResult("b:2", True, 0.5, None),
+        plugin.ProbeResult("c:3", False, None, None),
+    ]
+    assert plugin.evaluate_latency(results)[0] == plugin.NAGIOS_OK
+    assert plugin.evaluate_latency(results, 0.1, 1)[0] == plugin.NAGIOS_WARNING
+    code, output = plugin.evaluate_latency(results, 0.1, 0.2)
+    assert code == plugin.NAGIOS_CRITICAL
+    assert "b:2" in output and "a:1" not in output
+
+
+def test_format_perfdata(plugin):
+    """Test per-server perfdata and the min/avg/p95 aggregates."""
+    results = [
+        plugin.ProbeResult("a:1", True, 0.1, 0.3),
+        plugin.ProbeResult("b:2", False, None, None),
+    ]
+    perfdata = plugin.format_perfdata(results, 0.5, 1, 5)
+    assert "'a:1_connect'=0.100000s;0.5;1;0;5" in perfdata
+    assert "'a:1_ttfb'=0.300000s;0.5;1;0;5" in perfdata
+    assert "'b:2_connect'=U;0.5;1;0;5" in perfdata
+    assert "'connect_p95'=0.100000s" in perfdata
+    assert "'down'=1;;;0;2" in perfdata
+
+
+def test_probe_http_status(plugin, web_server, listener):
+    """Test that /status is validated and a silent TCP listener is unhealthy."""
+    targets = [
+        plugin.parse_entry(f"127.0.0.1:{web_server.port}"),
+        plugin.parse_entry(f"127.0.0.1:{listener.getsockname()[1]}"),
+    ]
+    results = asyncio.run(plugin.probe_servers(targets, 0.5, 10, 2, http=True))
+    assert results[0].up and results[0].http_time is not None
+    assert not results[1].up and results[1].error == "timed out"
+
+
+def test_probe_http_reuses_connections(plugin, keep_alive_server):
+    """Test that keep-alive connections in the pool are reused across rounds."""
+    targets = [plugin.parse_entry(f"127.0.0.1:{keep_alive_server.server_port}")]
+    pool = plugin.ConnectionPool()
+
+    async def run():
+        first = await plugin.probe_servers(targets, 1, 10, 2, http=True, pool=pool)
+        second = await plugin.probe_servers(targets, 1, 10, 2, http=True, pool=pool)
+        pool.close()
+        return first[0], second[0]
+
+    first, second = asyncio.run(run())
+    assert first.up and first.connect_time is not None
+    assert second.up and second.connect_time is None
+
+
+def test_pool_keeps_every_connection(plugin, keep_alive_server):
+    """Test that connections released to the same server are all kept and closed."""
+    port = keep_alive_server.server_port
+    pool = plugin.ConnectionPool()
+
+    async def run():
+        first = await pool.acquire("127.0.0.1", port, 1)
+        second = await pool.acquire("127.0.0.1", port, 1)
+        pool.release("127.0.0.1", port, *first[:2])
+        pool.release("127.0.0.1", port, *second[:2])
+        assert len(pool.idle[("127.0.0.1", port)]) == 2
+        reused = await pool.acquire("127.0.0.1", port, 1)
+        assert reused[2] is None
+        pool.release("127.0.0.1", port, *reused[:2])
+        pool.close()
+        return first[1], second[1]
+
+    writers = asyncio.run(run())
+    assert all(writer.is_closing() for writer in writers)
+
+
+def test_check_http_serial(plugin, web_server):
+    """Test the blocking HTTP probe used by --serial --http."""
+    result = plugin.check_http("127.0.0.1", web_server.port, 1)
+    assert result.up and result.error is None
+
+
+def test_validate_status(plugin):
+    """Test validation of the /status response body."""
+    assert plugin.validate_status(200, b'{"status": "ok"}') is None
+    assert plugin.validate_status(503, b"") == "HTTP 503"
+    assert plugin.validate_status(200, b"<html>") == "invalid JSON"
+    assert plugin.validate_status(200, b'{"status": "down"}') == "unhealthy status"
+
+
+def test_parse_entry(plugin):
+    """Test comments, per-entry timeouts, tags and malformed entries."""
+    assert plugin.parse_entry("  # just a comment") is None
+    entry = plugin.parse_entry("web-a:5001 timeout=2.5 tags=web,blue  # primary")
+    assert entry == plugin.Entry("web-a:5001", "web-a", "5001", 2.5, ("web", "blue"))
+    for line in ("web-a", "web-a:http", "web-a:5001 timeout=0", "web-a:1 color=red"):
+        with pytest.raises(ValueError):
+            plugin.parse_entry(line)
+
+
+def test_load_inventory_uses_cache(plugin, tmp_path, monkeypatch):
+    """Test that an unchanged file is served from the cache, not re-parsed."""
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text("web-a:5001\nbogus\nweb-b:5002 tags=web\n")
+    entries, errors = plugin.load_inventory(str(servers_file))
+    assert [e.server for e in entries] == ["web-a:5001", "web-b:5002"]
+    assert errors == [(2, "bogus", "expected host:port")]
+
+    def fail(path):
+        raise AssertionError("inventory was re-parsed")
+
+    monkeypatch.setattr(plugin, "parse_inventory", fail)
+    assert plugin.load_inventory(str(servers_file)) == (entries, errors)
+
+
+def test_load_inventory_distrusts_shared_cache(plugin, tmp_path, monkeypatch):
+    """Test that a cache others can write, or a planted symlink, is not used."""
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text("web-a:5001\n")
+    entries, errors = plugin.load_inventory(str(servers_file))
+    cache = plugin.inventory_cache_path(str(servers_file))
+    assert json.loads(open(cache).read())["entries"] == [
+        ["web-a:5001", "web-a", "5001", None, []]
+    ]
+
+    parsed = []
+    parse_inventory = plugin.parse_inventory
+    monkeypatch.setattr(
+        plugin,
+        "parse_inventory",
+        lambda path: parsed.append(path) or parse_inventory(path),
+    )
+    os.chmod(cache, 0o666)
+    assert plugin.load_inventory(str(servers_file)) == (entries, errors)
+    assert len(parsed) == 1
+
+    target = tmp_path / "target"
+    target.write_text("untouched")
+    os.remove(cache)
+    os.symlink(target, cache)
+    assert plugin.load_inventory(str(servers_file)) == (entries, errors)
+    assert len(parsed) == 2
+    assert target.read_text() == "untouched"
+    assert not os.path.islink(cache)
+
+
+def test_main_reports_invalid_entries(plugin, listener, tmp_path, capsys):
+    """Test that invalid lines are reported while valid servers are probed."""
+    port = listener.getsockname()[1]
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text(f"# backends\n127.0.0.1:{port}\nweb-c\n")
+    with pytest.raises(SystemExit) as exc:
+        plugin.main(["-f", str(servers_file), "-t", "1"])
+    assert exc.value.code == plugin.NAGIOS_WARNING
+    output = capsys.readouterr().out
+    assert output.startswith("WARNING - All 1 servers are online;")
+    assert "line 3 'web-c'" in output
+
+
+def test_daemon_serves_verdict(plugin, listener, tmp_path):
+    """Test that --client reads the verdict of a running --daemon for its options."""
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text(f"127.0.0.1:{listener.getsockname()[1]}\n")
+    socket_path = str(tmp_path / "probe.sock")
+    args = plugin.parse_args(
+        ["-f", str(servers_file), "--daemon", "--socket", socket_path]
+    )
+
+    def client(*options):
+        client_args = plugin.parse_args(["-f", str(servers_file), *options])
+        return plugin.client_request(client_args)
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(plugin.run_daemon(args))
+
+    def serve():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        for _ in range(50):
+            try:
+                code, output = plugin.read_daemon(socket_path, 60, client())
+                break
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        assert code == plugin.NAGIOS_OK
+        assert output.startswith("OK - All 1 servers are online")
+        code, output = plugin.read_daemon(socket_path, 60, client("-w", "0"))
+        assert code == plugin.NAGIOS_WARNING
+        assert "1 above warning latency of 0.0s" in output
+        code, output = plugin.read_daemon(socket_path, 60, client("-g", "db"))
+        assert output.startswith("UNKNOWN - No servers tagged db")
+        with pytest.raises(ValueError, match="runs with --timeout 5"):
+            plugin.read_daemon(socket_path, 60, client("-t", "9"))
+        with pytest.raises(ValueError):
+            plugin.read_daemon(socket_path, -1, client())
+    finally:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+        loop.close()
+
+
+def test_client_falls_back_to_probing(plugin, listener, tmp_path, capsys):
+    """Test that --client probes directly when no daemon is listening."""
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text(f"127.0.0.1:{listener.getsockname()[1]}\n")
+    missing_socket = str(tmp_path / "missing.sock")
+    with pytest.raises(SystemExit) as exc:
+        plugin.main(["-f", str(servers_file), "--client", "--socket", missing_socket])
+    assert exc.value.code == plugin.NAGIOS_OK
+    assert capsys.readouterr().out.startswith("OK - All 1 servers are online")
+
+
+def test_main_submits_passive_results(plugin, listener, tmp_path, capsys):
+    """Test that --passive writes aggregate and per-backend results."""
+    port = listener.getsockname()[1]
+    servers_file = tmp_path / "webservers.txt"
+    servers_file.write_text(f"127.0.0.1:{port}\n127.0.0.1:{closed_port()}\n")
+    command_file = tmp_path / "nagios.cmd"
+    command_file.touch()
+    with pytest.raises(SystemExit) as exc:
+        plugin.main(
+            [
+                "-f",
+                str(servers_file),
+                "--passive",
+                "--command-file",
+                str(command_file),
+                "--backend-service",
+                "HTTP Status",
+            ]
+        )
+    assert exc.value.code == plugin.NAGIOS_WARNING
+    lines = command_file.read_text().splitlines()
+    assert len(lines) == 3
+    assert ";localhost;Web Server Status;1;WARNING - 1 server is offline" in lines[0]
+    assert ";127.0.0.1;HTTP Status;0;OK - 127.0.0.1:" in lines[1]
+    assert ";127.0.0.1;HTTP Status;2;CRITICAL - 127.0.0.1:" in lines[2]
@@ -0,0 +1,102 @@
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def rates(load_plugin):
+    """Fixture to provide the counter_rate helper module."""
+    return load_plugin("counter_rate.py")
+
+
+@pytest.fixture
+def store(rates, tmp_path):
+    """Fixture to provide a RateStore in a temporary file."""
+    return rates.RateStore(str(tmp_path / "rates.sqlite"), ring_size=4, alpha=0.5)
+
+
+def test_counter_key_is_stable(rates):
+    """Test that keys do not depend on the interpreter's hash seed."""
+    key = rates.counter_key("sql-01", "master", "SELECT 1;")
+    assert key == rates.counter_key("sql-01", "master", "SELECT 1;")
+    assert key != rates.counter_key("sql-01", "tempdb", "SELECT 1;")
+
+
+def test_rates_persist_and_smooth(rates, store, tmp_path):
+    """Test instantaneous, smoothed and window rates across store instances."""
+    assert store.update("c", 100, 1000) == (None, None, None)
+    assert store.update("c", 200, 1010) == (10.0, 10.0, 10.0)
+    reopened = rates.RateStore(store.path, ring_size=4, alpha=0.5)
+    assert reopened.update("c", 500, 1020) == (30.0, 20.0, 20.0)
+
+
+def test_ring_is_bounded(store):
+    """Test that the window rate only spans the newest samples."""
+    for second, value in enumerate([0, 0, 0, 0, 10, 20, 30]):
+        rate = store.update("c", value, second)
+    # The ring holds the samples at 3..6 seconds, 30 over 3 seconds
+    assert rate.window == 10.0
+
+
+def test_wraparound_counts_forward(rates, store):
+    """Test that a 32-bit counter wrapping around keeps a positive rate."""
+    store.update("c", 2**32 - 10, 0, bits=32)
+    assert store.update("c", 10, 2, bits=32).rate == 10.0
+    store.update("d", 2**32 - 10, 0)
+    assert store.update("d", 10, 2).rate is None
+
+
+def test_reset_above_32_bits(rates, store):
+    """Test that a 64-bit counter dropping from above 2**31 is a reset."""
+    assert rates.increase(3_000_000_000, 100) is None
+    assert rates.increase(3_000_000_000, 100, bits=64) is None
+    store.update("c", 3_000_000_000, 0, bits=64)
+    assert store.update("c", 100, 10, bits=64).rate is None
+
+
+def test_reset_restarts_the_ring(store):
+    """Test that a counter reset gives no rate and keeps the smoothed one."""
+    store.update("c", 1000, 0)
+    store.update("c", 2000, 10)
+    assert store.update("c", 5, 20) == (None, 100.0, None)
+    assert store.update("c", 105, 30) == (10.0, 55.0, 10.0)
+
+
+def test_stale_sample_is_ignored(store):
+    """Test that a sample no newer than the last one changes nothing."""
+    store.update("c", 0, 10)
+    store.update("c", 100, 20)
+    assert store.update("c", 5000, 20) == (None, 10.0, 10.0)
+    assert store.update("c", 200, 30).rate == 10.0
+
+
+def test_concurrent_updates_keep_every_sample(rates, tmp_path):
+    """Test that concurrent writers build on each other's samples."""
+    path = str(tmp_path / "rates.sqlite")
+    store = rates.RateStore(path, ring_size=32)
+
+    def update(second):
+        rates.RateStore(path, ring_size=32).update("c", second * 10, second)
+
+    threads = [threading.Thread(target=update, args=(i,)) for i in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Whatever the order, the newest samples still rise 10 per second
+    assert store.update("c", 1000, 100).rate == pytest.approx(10.0)
+
+
+def test_state_file_must_be_private(store, tmp_path):
+    """Test that a state file others can read or that is a symlink is refused."""
+    store.update("c", 1, 1)
+    os.chmod(store.path, 0o644)
+    with pytest.raises(OSError):
+        store.update("c", 2, 2)
+    os.chmod(store.path, 0o600)
+    link = tmp_path / "link.sqlite"
+    link.symlink_to(store.path)
+    store.path = str(link)
+    with pytest.raises(OSError):
+        store.update("c", 3, 3)
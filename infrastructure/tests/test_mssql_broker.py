@@ -0,0 +1,201 @@
+import decimal
+import threading
+import time
+
+import pytest
+
+from .conftest import MSSQL_LOGIN as LOGIN
+from .conftest import FakeConnection
+from .conftest import run_mssql_plugin as run_plugin
+
+
+class OperationalError(Exception):
+    """Named like the pymssql error for a connection that went away."""
+
+
+@pytest.fixture
+def broker(load_plugin):
+    """Fixture to provide the mssql_broker module."""
+    return load_plugin("mssql_broker.py")
+
+
+@pytest.fixture
+def logins():
+    """Fixture to record every login the broker makes."""
+    return []
+
+
+@pytest.fixture
+def broker_socket(broker, logins, tmp_path):
+    """Fixture to run a broker whose logins open FakeConnections."""
+    results = {
+        "SELECT 1": [(1,)],
+        "dm_os_sys_memory": [(decimal.Decimal("91.5"),)],
+        "sys.sysprocesses": [(42,)],
+    }
+
+    def connect(**kwargs):
+        time.sleep(0.05)
+        logins.append(FakeConnection(results))
+        return logins[-1]
+
+    path = str(tmp_path / "broker.sock")
+    server = broker.BrokerServer(path, broker.Broker(connect, size=2), wait=0.5)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def open_session(broker, path, fresh=False, password="secret"):
+    return broker.BrokerConnection(
+        path, "sql-01", "nagios", password, "master", fresh=fresh
+    )
+
+
+def test_sessions_share_a_login(broker, broker_socket, logins):
+    """Test that consecutive sessions reuse the pooled connection."""
+    first = open_session(broker, broker_socket)
+    cursor = first.cursor()
+    cursor.execute("SELECT count(*) FROM sys.sysprocesses;")
+    assert cursor.fetchone() == [42]
+    first.close()
+
+    second = open_session(broker, broker_socket)
+    cursor = second.cursor()
+    cursor.execute("SELECT memory FROM sys.dm_os_sys_memory;")
+    assert cursor.fetchall() == [[91.5]]
+    second.close()
+
+    assert (first.reused, second.reused) == (False, True)
+    assert len(logins) == 1
+
+
+def test_fresh_session_times_a_real_login(broker, broker_socket, logins):
+    """Test that a fresh session logs in again and reports the login time."""
+    open_session(broker, broker_socket).close()
+    session = open_session(broker, broker_socket, fresh=True)
+    session.close()
+    assert session.reused is False
+    assert session.time2connect >= 0.05
+    assert len(logins) == 2
+
+
+def test_credentials_are_part_of_the_pool_key(broker, broker_socket, logins):
+    """Test that a different password never borrows a pooled connection."""
+    open_session(broker, broker_socket).close()
+    session = open_session(broker, broker_socket, password="guess")
+    session.close()
+    assert session.reused is False
+
+
+def test_query_errors_are_raised(broker, broker_socket):
+    """Test that a failed query raises without ending the session."""
+    session = open_session(broker, broker_socket)
+    with pytest.raises(Exception, match="no result for SELECT nothing"):
+        session.cursor().execute("SELECT nothing;")
+    assert session.execute("SELECT 1;") == [[1]]
+    session.close()
+
+
+def test_pool_is_bounded(broker):
+    """Test that a full pool makes sessions wait, then time out."""
+    pool = broker.Pool(lambda: FakeConnection({}), size=1)
+    pooled, _ = pool.acquire()
+    with pytest.raises(broker.PoolTimeoutError):
+        pool.acquire(wait=0.1)
+    threading.Timer(0.1, pool.release, (pooled,)).start()
+    assert pool.acquire(wait=2) == (pooled, True)
+
+
+def test_failed_health_check_replaces_connection(broker):
+    """Test that an idle connection failing SELECT 1 is not handed out."""
+    pool = broker.Pool(lambda: FakeConnection({}), check_after=0)
+    pooled, _ = pool.acquire()
+    pool.release(pooled)
+    replacement, reused = pool.acquire()
+    assert replacement is not pooled and reused is False
+    assert pooled.connection.closed
+
+
+def test_broken_connection_is_discarded(broker):
+    """Test that a connection error takes the connection out of the pool."""
+    pool = broker.Pool(lambda: FakeConnection({}))
+    pooled, _ = pool.acquire()
+    pool.release(pooled, broken=True)
+    assert pool.idle == [] and pool.in_use == 0
+    assert pooled.connection.closed
+
+
+def test_reap_closes_idle_connections(broker):
+    """Test that connections idle past the timeout are closed."""
+    pool = broker.Pool(lambda: FakeConnection({}))
+    pooled, _ = pool.acquire()
+    pool.release(pooled)
+    assert pool.reap(idle_timeout=60) == 0
+    assert pool.reap(idle_timeout=0) == 1
+    assert pool.idle == [] and pooled.connection.closed
+
+
+def test_broker_error_types(broker, monkeypatch):
+    """Test that pymssql errors from the broker keep their type."""
+    import pymssql
+
+    error = broker.broker_error({"error": "gone", "type": "OperationalError"})
+    assert isinstance(error, pymssql.OperationalError)
+    error = broker.broker_error({"error": "odd", "type": "__class__"})
+    assert type(error) is Exception
+    error = broker.broker_error({"error": "full", "type": "PoolTimeoutError"})
+    assert isinstance(error, OSError)
+
+
+def test_plugin_uses_broker(load_plugin, broker_socket, logins, monkeypatch, tmp_path):
+    """Test that plugin runs with --broker share one login."""
+    plugin = load_plugin("check_mssql_server.py")
+    monkeypatch.setattr("pymssql.connect", None)
+    args = [*LOGIN, "--broker", broker_socket, "--connections", "-w", "50"]
+    assert run_plugin(plugin, monkeypatch, *args)[1] == 0
+    assert run_plugin(plugin, monkeypatch, *args)[1] == 0
+    message, code = run_plugin(plugin, monkeypatch, *LOGIN, "--broker", broker_socket)
+    assert message.startswith("OK: Time to connect was 0.05")
+    assert len(logins) == 2
+
+
+def test_plugin_without_broker_logs_in(load_plugin, monkeypatch, tmp_path):
+    """Test that the plugin logs in directly when the broker is not running."""
+    plugin = load_plugin("check_mssql_server.py")
+    made = []
+
+    def connect(**kwargs):
+        made.append(FakeConnection({"sysprocesses": [(7,)]}))
+        return made[-1]
+
+    monkeypatch.setattr("pymssql.connect", connect)
+    args = ["--broker", str(tmp_path / "missing.sock"), "--connections"]
+    message, code = run_plugin(plugin, monkeypatch, *LOGIN, *args)
+    assert message.startswith("OK: Number of open connections is 7.0")
+    assert len(made) == 1
+
+
+def test_plugin_logs_in_when_pool_is_full(
+    broker, broker_socket, load_plugin, monkeypatch
+):
+    """Test that the plugin logs in directly when the broker's pool is full."""
+    plugin = load_plugin("check_mssql_server.py")
+    sessions = [open_session(broker, broker_socket) for _ in range(2)]
+    made = []
+
+    def connect(**kwargs):
+        made.append(FakeConnection({"sysprocesses": [(7,)]}))
+        return made[-1]
+
+    monkeypatch.setattr("pymssql.connect", connect)
+    args = ["--broker", broker_socket, "--connections"]
+    message = run_plugin(plugin, monkeypatch, *LOGIN, *args)[0]
+    assert message.startswith("OK: Number of open connections is 7.0")
+    assert len(made) == 1
+    for session in sessions:
+        session.close()
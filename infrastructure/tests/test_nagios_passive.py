@@ -0,0 +1,59 @@
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def passive(load_plugin):
+    """Fixture to provide the nagios_passive helper module."""
+    return load_plugin("nagios_passive.py")
+
+
+def test_format_service_result(passive):
+    """Test the external command line format and newline escaping."""
+    line = passive.format_service_result("web-a", "HTTP", 2, "down\nline 2\n", 100)
+    assert line == "[100] PROCESS_SERVICE_CHECK_RESULT;web-a;HTTP;2;down\\nline 2\n"
+
+
+def test_pack_lines_respects_limit(passive):
+    """Test that chunks stay within the atomic write size on line boundaries."""
+    lines = [f"{'x' * 9}\n" for _ in range(25)]
+    chunks = list(passive.pack_lines(lines, 35))
+    assert all(len(chunk) <= 35 and chunk.endswith(b"\n") for chunk in chunks)
+    assert b"".join(chunks) == "".join(lines).encode()
+
+
+def test_submit_results_to_fifo(passive, tmp_path):
+    """Test that all lines reach a reader of the command FIFO."""
+    fifo = str(tmp_path / "nagios.cmd")
+    os.mkfifo(fifo)
+    received = []
+
+    def read():
+        with open(fifo, "rb") as f:
+            received.append(f.read())
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    lines = [
+        passive.format_service_result("web-a", f"svc{i}", 0, "OK", 1)
+        for i in range(500)
+    ]
+    # Opening the FIFO fails until the reader has it open, as with Nagios down
+    for _ in range(100):
+        try:
+            assert passive.submit_results(lines, fifo) == 500
+            break
+        except OSError:
+            threading.Event().wait(0.01)
+    reader.join()
+    assert received[0] == "".join(lines).encode()
+
+
+def test_submit_results_without_reader(passive, tmp_path):
+    """Test that a FIFO with no reader fails fast instead of blocking."""
+    fifo = str(tmp_path / "nagios.cmd")
+    os.mkfifo(fifo)
+    with pytest.raises(OSError):
+        passive.submit_results(["[1] TEST\n"], fifo)
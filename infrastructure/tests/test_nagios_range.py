@@ -0,0 +1,48 @@
+import pytest
+
+
+@pytest.fixture
+def ranges(load_plugin):
+    """Fixture to provide the nagios_range helper module."""
+    return load_plugin("nagios_range.py")
+
+
+@pytest.mark.parametrize(
+    "threshold, alerting, quiet",
+    [
+        ("10", [-1, 10.5, 11], [0, 5, 10]),
+        ("10:", [-5, 9.9], [10, 1e9]),
+        ("~:10", [10.1, 1e9], [-1e9, 10]),
+        ("10:20", [9, 21], [10, 15, 20]),
+        ("@10:20", [10, 15, 20], [9, 21]),
+        ("@10", [0, 10], [-1, 11]),
+        ("@~:10", [-1e9, 10], [11]),
+        ("-10:-5", [-11, 0], [-10, -5]),
+        ("0.5:1.5", [0.4, 1.6], [0.5, 1.5]),
+        ("~:", [], [-1e9, 0, 1e9]),
+    ],
+)
+def test_range_grammar(ranges, threshold, alerting, quiet):
+    """Test every form of the Nagios range grammar."""
+    for value in alerting:
+        assert ranges.is_within_range(threshold, value), value
+    for value in quiet:
+        assert not ranges.is_within_range(threshold, value), value
+
+
+@pytest.mark.parametrize("threshold", ["@", "abc", "10:5", ":10", "1e3", "10:20:30"])
+def test_improper_ranges(ranges, threshold):
+    """Test that malformed thresholds are rejected."""
+    with pytest.raises(ValueError, match="Improper warning/critical format"):
+        ranges.is_within_range(threshold, 1)
+
+
+def test_ranges_are_parsed_once(ranges):
+    """Test that each threshold string is parsed once, then cached."""
+    ranges.parse_range.cache_clear()
+    for value in range(100):
+        ranges.is_within_range("80:90", value)
+        ranges.is_within_range("@85", value, invert=True)
+    info = ranges.parse_range.cache_info()
+    assert (info.misses, info.hits) == (2, 198)
+    assert not ranges.is_within_range("", 100)
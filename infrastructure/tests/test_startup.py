@@ -0,0 +1,114 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from .conftest import LIBEXEC_DIR
+
+# The budgets are only enforced in a dedicated benchmark run, see test_benchmark
+RESULTS_FILE = os.environ.get("BENCHMARK_RESULTS")
+
+# Runs per measurement, the fastest is kept to filter out a busy machine
+RUNS = 3
+
+# Milliseconds of imports each plugin may add to the bare interpreter's,
+# about twice what they take on an idle machine to allow for a busy one
+STARTUP_BUDGET_MS = {
+    "check_ncpa.py": 120,
+    "check_mssql_server.py": 60,
+    "check_mssql_database.py": 60,
+    "check-mqtt.py": 200,
+}
+
+# Modules that a plugin must not import on the path measured
+DEFERRED_MODULES = {
+    "check_ncpa.py": ["shlex", "threading", "traceback"],
+    "check_mssql_server.py": ["pymssql", "counter_rate", "sqlite3", "shlex"],
+    "check_mssql_database.py": ["pymssql", "counter_rate", "sqlite3"],
+    "check-mqtt.py": ["jsonpath_rw", "subprocess"],
+}
+
+
+def import_times(*args):
+    """Run python -X importtime with args, returning {module: cumulative µs}."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=str(LIBEXEC_DIR),
+        capture_output=True,
+        text=True,
+        timeout=30,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Only count modules imported at the top level, not their dependencies
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+        else:
+            times.setdefault(name.strip(), 0)
+    return times
+
+
+def startup_cost(*args):
+    """Return (milliseconds, modules) the plugin imports beyond the interpreter."""
+    best = None
+    for _ in range(RUNS):
+        baseline = import_times("-c", "pass")
+        times = import_times(*args)
+        cost = sum(t for name, t in times.items() if name not in baseline) / 1000.0
+        best = cost if best is None else min(best, cost)
+    return best, set(times)
+
+
+def closed_port():
+    """Return a localhost port that nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return str(sock.getsockname()[1])
+
+
+def check_budget(plugin, *args):
+    cost, modules = startup_cost(plugin, *args)
+    # Timings only mean something in a dedicated benchmark run
+    if RESULTS_FILE:
+        assert cost <= STARTUP_BUDGET_MS[plugin], (
+            f"{plugin} imports took {cost:.1f}ms, "
+            f"over its {STARTUP_BUDGET_MS[plugin]}ms budget"
+        )
+    assert not modules.intersection(DEFERRED_MODULES[plugin])
+
+
+def test_ncpa_startup(ncpa_server):
+    """Test the imports of a single NCPA check against the budget."""
+    port = str(ncpa_server.server_address[1])
+    check_budget("check_ncpa.py", "-H", "127.0.0.1", "-P", port, "-M", "cpu/percent")
+    assert ncpa_server.requests == ["/api/cpu/percent/"] * RUNS
+
+
+def test_mssql_server_startup(mssql_broker):
+    """Test the imports of a brokered server check against the budget."""
+    args = ["-H", "sql-01", "-U", "nagios", "-P", "secret", "--connections"]
+    check_budget("check_mssql_server.py", *args, "--broker", mssql_broker)
+
+
+def test_mssql_database_startup(mssql_broker):
+    """Test the imports of a brokered database check against the budget."""
+    args = ["-H", "sql-01", "-U", "nagios", "-P", "secret", "-T", "master"]
+    check_budget("check_mssql_database.py", *args, "--broker", mssql_broker)
+
+
+def test_mqtt_startup():
+    """Test the imports of an MQTT check with --jsonpath against the budget."""
+    args = ["-H", "127.0.0.1", "-P", closed_port(), "-j", "$.value"]
+    check_budget("check-mqtt.py", *args)
+
+
+@pytest.mark.parametrize("plugin", sorted(STARTUP_BUDGET_MS))
+def test_help_skips_deferred_modules(plugin):
+    """Test that printing the help imports none of the deferred modules."""
+    _, modules = startup_cost(plugin, "--help")
+    assert not modules.intersection(DEFERRED_MODULES[plugin])
@@ -1,7 +1,18 @@
+import hashlib
+import json
+import mmap
 import os
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
 
 from dotenv import load_dotenv
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, jsonify, request
+from markupsafe import escape
 
 app = Flask(__name__)
 
@@ -12,6 +23,51 @@ load_dotenv()
 web_env = os.getenv("ENV", "development")
 message = os.getenv("MESSAGE", "default")
 port = os.getenv("PORT")
+# Seconds a browser may reuse the index page before revalidating it
+index_max_age = int(os.getenv("INDEX_MAX_AGE", "0"))
+
+# Gunicorn's workers in production: "gthread" serves WORKER_THREADS requests
+# at once per worker, "sync" one, so a slow client holds a sync worker up
+worker_class = os.getenv("WORKER_CLASS", "gthread")
+if worker_class not in ("gthread", "sync"):
+    raise ValueError(f"WORKER_CLASS must be gthread or sync, not {worker_class}")
+# Requests a worker handles at once, gunicorn's --threads
+worker_threads = (
+    int(os.getenv("WORKER_THREADS", "4")) if worker_class == "gthread" else 1
+)
+# Seconds /status/deep reuses its report, so health checks stay cheap
+deep_status_ttl = float(os.getenv("DEEP_STATUS_TTL", "1"))
+# Seconds of recent requests /status/deep reports on
+deep_status_window = float(os.getenv("DEEP_STATUS_WINDOW", "60"))
+# Limits past which /status/deep reports the workers as saturated
+max_utilization = float(os.getenv("DEEP_STATUS_MAX_UTILIZATION", "0.9"))
+max_p99_ms = float(os.getenv("DEEP_STATUS_MAX_P99_MS", "1000"))
+max_queue_ms = float(os.getenv("DEEP_STATUS_MAX_QUEUE_MS", "500"))
+
+# Where every worker keeps the latency histograms /metrics adds up, and the
+# recent load /status/deep adds up
+metrics_dir = os.getenv(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "web_server_metrics")
+)
+# Upper bounds in seconds of the latency buckets, +Inf is added to them
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Time slots the /status/deep window is split into
+LOAD_SLOTS = 12
+
+
+def cpu_count():
+    """Return the number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Gunicorn worker processes, by default the 2 * CPUs + 1 its docs suggest
+web_workers = int(os.getenv("WEB_WORKERS", "0")) or 2 * cpu_count() + 1
+
+# Stands in for the visitor's IP when the index page is rendered for the cache
+IP_MARKER = uuid.uuid4().hex
 
 # Configure Flask based on the environment
 if web_env == "development":
@@ -20,23 +76,531 @@ else:
     app.config["DEBUG"] = False
 
 
+class StatusMiddleware:
+    """Answer the health check before the request reaches Flask.
+
+    HAProxy and Nagios poll /status constantly. The answer never changes, so
+    the body and headers are built once and the same objects are returned
+    on every request, without routing or a response object.
+    """
+
+    def __init__(self, wsgi_app, path="/status", payload=None):
+        self.wsgi_app = wsgi_app
+        self.path = path
+        body = json.dumps(payload or {"status": "ok"}, separators=(",", ":"))
+        self.body = [body.encode() + b"\n"]
+        self.headers = [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(self.body[0]))),
+        ]
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == self.path:
+            method = environ.get("REQUEST_METHOD")
+            if method == "GET":
+                start_response("200 OK", self.headers)
+                return self.body
+            if method == "HEAD":
+                start_response("200 OK", self.headers)
+                return []
+        return self.wsgi_app(environ, start_response)
+
+
+def bucket_percentile(bounds, counts, fraction):
+    """Return the value below which the fraction of a histogram falls, or None.
+
+    counts holds a count per bound, then one for +Inf. The value is
+    interpolated within its bucket, as Prometheus' histogram_quantile() does.
+    """
+    rank = fraction * sum(counts)
+    if not rank:
+        return None
+    lower = 0.0
+    for bound, count in zip(bounds, counts):
+        if count and rank <= count:
+            return lower + (bound - lower) * rank / count
+        rank -= count
+        lower = bound
+    return lower
+
+
+def queue_wait(environ, now):
+    """Return the seconds a request waited since HAProxy accepted it, or None.
+
+    HAProxy stamps X-Request-Start as ``t=<microseconds since the epoch>``.
+    """
+    stamp = environ.get("HTTP_X_REQUEST_START", "")
+    try:
+        started = float(stamp.partition("t=")[2] or stamp) / 1e6
+    except ValueError:
+        return None
+    return max(0.0, now - started)
+
+
+def map_worker_file(directory, suffix, size):
+    """Map this worker's file in directory as doubles, zeroed if it is new."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%d%s" % (os.getpid(), suffix))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+        return memoryview(mmap.mmap(fd, size)).cast("d")
+    finally:
+        os.close(fd)
+
+
+class LatencyHistograms:
+    """Per-route latency histograms shared by gunicorn's workers.
+
+    Every worker maps a file of its own in directory, holding each route's
+    bucket counts and latency sum as doubles, so recording a request needs
+    no lock. /metrics adds up the files of every worker. The counts of a
+    worker that exited are merged into one file, so they never go
+    backwards and the directory does not grow with every restart.
+    """
+
+    EXITED = "exited.metrics"
+
+    def __init__(self, routes, directory, buckets=LATENCY_BUCKETS):
+        self.routes = sorted(routes) + ["unmatched"]
+        self.directory = directory
+        self.buckets = tuple(buckets)
+        # Each route: a count per bucket, one for +Inf, then the sum
+        self.stride = len(self.buckets) + 2
+        self.offsets = {route: i * self.stride for i, route in enumerate(self.routes)}
+        self.unmatched = self.offsets["unmatched"]
+        self.size = len(self.routes) * self.stride * 8
+        self.counts = None
+        # A forked worker must not write into the file of its parent
+        os.register_at_fork(after_in_child=self.forget)
+
+    def forget(self):
+        self.counts = None
+
+    def open(self):
+        """Map this worker's file, creating it with zeroed counts."""
+        self.counts = map_worker_file(self.directory, ".metrics", self.size)
+        return self.counts
+
+    def clear(self):
+        """Remove the files of an earlier run, before the workers start."""
+        for name in self.files():
+            os.remove(os.path.join(self.directory, name))
+
+    def retire(self, pid):
+        """Merge the counts of the exited worker pid into the exited file."""
+        path = os.path.join(self.directory, "%d.metrics" % pid)
+        exited = os.path.join(self.directory, self.EXITED)
+        totals = self.read(exited) or array("d", bytes(self.size))
+        counts = self.read(path)
+        if counts is not None:
+            for i, value in enumerate(counts):
+                totals[i] += value
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                totals.tofile(f)
+            os.replace(tmp_path, exited)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def observe(self, route, seconds):
+        """Count a request to route (None if unmatched) that took seconds."""
+        counts = self.counts or self.open()
+        base = self.offsets.get(route, self.unmatched)
+        counts[base + bisect_left(self.buckets, seconds)] += 1
+        counts[base + self.stride - 1] += seconds
+
+    def files(self):
+        """Return the names of the metrics files in the directory."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [name for name in names if name.endswith(".metrics")]
+
+    def read(self, path):
+        """Return the counts in a metrics file, or None if there are none."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Left by a version of the app with other routes or buckets
+        if len(data) != self.size:
+            return None
+        return array("d", data)
+
+    def collect(self):
+        """Return the counts of every worker added up."""
+        totals = array("d", bytes(self.size))
+        for name in self.files():
+            counts = self.read(os.path.join(self.directory, name))
+            if counts is None:
+                continue
+            for i, value in enumerate(counts):
+                totals[i] += value
+        return totals
+
+    def export(self):
+        """Return the histograms in the Prometheus text format."""
+        totals = self.collect()
+        name = "http_request_duration_seconds"
+        lines = [
+            "# HELP %s Time taken to handle requests, by route." % name,
+            "# TYPE %s histogram" % name,
+        ]
+        bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for route, base in self.offsets.items():
+            label = 'route="%s"' % route.replace("\\", "\\\\").replace('"', '\\"')
+            count = 0
+            for i, bound in enumerate(bounds):
+                count += totals[base + i]
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, bound, count))
+            lines.append(
+                "%s_sum{%s} %r" % (name, label, totals[base + self.stride - 1])
+            )
+            lines.append("%s_count{%s} %d" % (name, label, count))
+        return "\n".join(lines) + "\n"
+
+
+class WorkerLoad:
+    """The recent requests and busy threads of every gunicorn worker.
+
+    /status/deep judges the whole server, not just the worker that happens
+    to answer HAProxy's check. Every worker maps a file of its own in
+    directory holding a ring of time slots that together span
+    deep_status_window. Each slot counts the latencies and queue waits of
+    the requests that finished in it and the seconds threads were busy in
+    it. A long request's busy time is spread over the slots it covered, so
+    it does not all land in the slot where it finished. After the slots
+    come the worker's thread count and the start time of the request each
+    thread is handling, so requests still in flight count as busy too.
+    """
+
+    def __init__(self, directory, threads=1, slots=LOAD_SLOTS, buckets=LATENCY_BUCKETS):
+        self.directory = directory
+        self.threads = threads
+        self.slots = slots
+        self.buckets = tuple(buckets)
+        # Each slot: its number, the latency then the queue wait count per
+        # bucket and +Inf, then the busy seconds
+        self.width = len(self.buckets) + 1
+        self.stride = 2 * self.width + 2
+        self.header = slots * self.stride
+        self.size = (self.header + 1 + threads) * 8
+        self.lock = threading.Lock()
+        self.values = None
+        # A forked worker must not write into the file of its parent
+        os.register_at_fork(after_in_child=self.forget)
+
+    def forget(self):
+        self.values = None
+
+    def open(self):
+        """Map this worker's file, creating it with zeroed slots."""
+        self.values = map_worker_file(self.directory, ".load", self.size)
+        self.values[self.header] = self.threads
+        return self.values
+
+    def clear(self):
+        """Remove the files of an earlier run, before the workers start."""
+        for name in self.files():
+            os.remove(os.path.join(self.directory, name))
+
+    def retire(self, pid):
+        """Remove the file of the exited worker pid."""
+        path = os.path.join(self.directory, "%d.load" % pid)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def files(self):
+        """Return the names of the load files in the directory."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [name for name in names if name.endswith(".load")]
+
+    def slot(self, values, number):
+        """Return the offset of slot number, or None if it was overwritten."""
+        base = (number % self.slots) * self.stride
+        if values[base] != number:
+            if values[base] > number:
+                return None
+            for i in range(base + 1, base + self.stride):
+                values[i] = 0.0
+            values[base] = number
+        return base
+
+    def start(self, waited):
+        """Count a request that waited seconds (or None) as started.
+
+        Returns the token to pass to finish().
+        """
+        now = time.time()
+        with self.lock:
+            values = self.values or self.open()
+            base = self.slot(values, int(now // (deep_status_window / self.slots)))
+            if waited is not None and base is not None:
+                bucket = bisect_left(self.buckets, waited)
+                values[base + 1 + self.width + bucket] += 1
+            for thread in range(self.header + 1, self.header + 1 + self.threads):
+                if not values[thread]:
+                    values[thread] = now
+                    return thread
+        # More requests at once than threads, the extra ones are not seen
+        return None
+
+    def finish(self, thread, elapsed):
+        """Count a request started as thread that took elapsed seconds."""
+        end = time.time()
+        begin = end - elapsed
+        length = deep_status_window / self.slots
+        with self.lock:
+            values = self.values or self.open()
+            if thread is not None:
+                values[thread] = 0.0
+            last = int(end // length)
+            base = self.slot(values, last)
+            if base is not None:
+                values[base + 1 + bisect_left(self.buckets, elapsed)] += 1
+            for number in range(
+                max(int(begin // length), last - self.slots + 1), last + 1
+            ):
+                base = self.slot(values, number)
+                if base is not None:
+                    covered = min(end, (number + 1) * length) - max(
+                        begin, number * length
+                    )
+                    values[base + self.stride - 1] += covered
+
+    def read(self, path):
+        """Return the values in a load file, or None if there are none."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Left by a version of the app with other buckets or threads
+        if len(data) < self.header * 8 + 8:
+            return None
+        values = array("d", data)
+        if len(values) != self.header + 1 + int(values[self.header]):
+            return None
+        return values
+
+    def collect(self):
+        """Return the load of every worker over the window."""
+        now = time.time()
+        length = deep_status_window / self.slots
+        first = int(now // length) - self.slots + 1
+        since = first * length
+        if self.values is None:
+            with self.lock:
+                self.values or self.open()
+        latencies = [0.0] * self.width
+        queue_waits = [0.0] * self.width
+        workers = threads = in_flight = 0
+        busy = 0.0
+        for name in self.files():
+            values = self.read(os.path.join(self.directory, name))
+            if values is None:
+                continue
+            workers += 1
+            threads += int(values[self.header])
+            for base in range(0, self.header, self.stride):
+                if values[base] < first:
+                    continue
+                for i in range(self.width):
+                    latencies[i] += values[base + 1 + i]
+                    queue_waits[i] += values[base + 1 + self.width + i]
+                busy += values[base + self.stride - 1]
+            for started in values[self.header + 1 :]:
+                if started:
+                    in_flight += 1
+                    busy += now - max(started, since)
+        return {
+            "workers": workers,
+            "threads": threads,
+            "in_flight": in_flight,
+            "handled": int(sum(latencies)),
+            "utilization": min(busy / ((now - since) * threads or 1), 1.0),
+            "p99": bucket_percentile(self.buckets, latencies, 0.99),
+            "queue_p99": bucket_percentile(self.buckets, queue_waits, 0.99),
+        }
+
+
+class RequestStats:
+    """Count and time the requests a worker handles, for /status/deep.
+
+    Requests are recorded in the worker's WorkerLoad, and the report adds up
+    every worker's, so whichever worker answers gives the same verdict on
+    the server. Only requests from the last deep_status_window seconds
+    count. A server that went idle after slow requests is therefore healthy
+    again once the window has passed, even though no new requests arrive
+    while HAProxy holds it out.
+    """
+
+    def __init__(self, wsgi_app, load, skip=("/status/deep",), histograms=None):
+        self.wsgi_app = wsgi_app
+        self.load = load
+        self.histograms = histograms
+        self.skip = skip
+        self.cached = None
+        self.expires = 0.0
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") in self.skip:
+            return self.wsgi_app(environ, start_response)
+        thread = self.load.start(queue_wait(environ, time.time()))
+        start = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.histograms is not None:
+                self.histograms.observe(environ.get("web_server.route"), elapsed)
+            self.load.finish(thread, elapsed)
+
+    def measure(self):
+        """Return the load of all workers and whether they are saturated."""
+        load = self.load.collect()
+        p99, queue_p99 = load.pop("p99"), load.pop("queue_p99")
+        saturated = (
+            load["utilization"] >= max_utilization
+            or (p99 is not None and p99 * 1000 >= max_p99_ms)
+            or (queue_p99 is not None and queue_p99 * 1000 >= max_queue_ms)
+        )
+        load["utilization"] = round(load["utilization"], 3)
+        return {
+            "status": "saturated" if saturated else "ok",
+            "pid": os.getpid(),
+            **load,
+            "p99_ms": None if p99 is None else round(p99 * 1000, 3),
+            "queue_p99_ms": None if queue_p99 is None else round(queue_p99 * 1000, 3),
+        }
+
+    def report(self, ttl):
+        """Return the (HTTP status, JSON body) of the report, reused for ttl."""
+        now = time.monotonic()
+        if self.cached is None or now >= self.expires:
+            report = self.measure()
+            code = 503 if report["status"] == "saturated" else 200
+            self.cached = code, json.dumps(report, separators=(",", ":"))
+            self.expires = now + ttl
+        return self.cached
+
+
+@lru_cache(maxsize=16)
+def render_index(template, message):
+    """Render the index page once per template and message.
+
+    Returns the markup before and after the visitor's IP, and a digest of
+    the page for building ETags.
+    """
+    page = template.render(message=message, visitor_ip=IP_MARKER)
+    head, _, tail = page.partition(IP_MARKER)
+    return head, tail, hashlib.sha1(page.encode()).hexdigest()
+
+
+@app.before_request
+def remember_route():
+    # Flask drops its request on return, RequestStats needs the route after
+    if request.url_rule is not None:
+        request.environ["web_server.route"] = request.url_rule.rule
+
+
 @app.route("/")
 def index():
     visitor_ip = request.remote_addr  # Get the visitor's IP address
-    return render_template("index.html", message=message, visitor_ip=visitor_ip)
+    # Jinja hands back a new template object once index.html is reloaded
+    template = app.jinja_env.get_template("index.html")
+    head, tail, digest = render_index(template, message)
+
+    etag = '"%s"' % hashlib.sha1(f"{digest}:{visitor_ip}".encode()).hexdigest()
+    # The page shows the visitor's IP, so shared caches must not keep it
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={index_max_age}"}
+    if "If-None-Match" in request.headers and request.if_none_match.contains_weak(
+        etag.strip('"')
+    ):
+        response = app.response_class(status=304, headers=headers)
+    else:
+        response = app.response_class(
+            f"{head}{escape(visitor_ip)}{tail}", headers=headers
+        )
+    return response
 
 
+# GET and HEAD are answered by StatusMiddleware. The route stays so Flask
+# still knows it, e.g. for url_for() and the 405 on other methods.
 @app.route("/status", methods=["GET"])
 def status():
     return jsonify({"status": "ok"}), 200
 
 
+@app.route("/status/deep", methods=["GET"])
+def status_deep():
+    code, body = request_stats.report(deep_status_ttl)
+    return app.response_class(body, status=code, mimetype="application/json")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return app.response_class(
+        request_stats.histograms.export(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+request_stats = RequestStats(
+    app.wsgi_app,
+    WorkerLoad(metrics_dir, threads=worker_threads),
+    histograms=LatencyHistograms(
+        {rule.rule for rule in app.url_map.iter_rules()}, metrics_dir
+    ),
+)
+app.wsgi_app = StatusMiddleware(request_stats)
+
+
+def run_gunicorn():
+    """Serve the app with gunicorn, configured from the environment."""
+    # Only the production image installs gunicorn
+    from gunicorn.app.base import BaseApplication
+
+    def child_exit(server, worker):
+        request_stats.histograms.retire(worker.pid)
+        request_stats.load.retire(worker.pid)
+
+    options = {
+        "bind": f"0.0.0.0:{port or 80}",
+        "workers": web_workers,
+        "worker_class": worker_class,
+        "threads": worker_threads,
+        "child_exit": child_exit,
+    }
+    # The workers of an earlier run have exited, count from zero again
+    request_stats.histograms.clear()
+    request_stats.load.clear()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
 if __name__ == "__main__":
     # Check the environment to determine the server to use
     is_production = os.getenv("FLASK_ENV") == "production"
     if is_production:
         # Use Gunicorn for production
         print("Running in production mode...")
+        run_gunicorn()
     else:
         # Use Flask's development server
         print("Running in development mode...")